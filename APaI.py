@@ -1,21 +1,33 @@
 from __future__ import annotations
 
-import os
+import argparse
 import shutil
 import sys
+import time
 from pathlib import Path
+from typing import TYPE_CHECKING
 
 from rich.console import Console
+from rich.table import Table
 from rich.text import Text
 
 from environment import Environment
 
+if TYPE_CHECKING:
+    from files import FileInput
 
-def main_loop(console: Console, env: Environment) -> None:  # noqa: C901, PLR0915
+
+def main_loop(  # noqa: C901, PLR0915
+    console: Console,
+    env: Environment,
+    *,
+    exit_at_prompt: bool = False,
+) -> None:
     agent = env.init_agent()
     console.print(agent.get_info_table())
 
     def exit_program() -> None:
+        env.close()
         console.print("Bye!", style="bold green")
         sys.exit(0)
 
@@ -25,15 +37,60 @@ def main_loop(console: Console, env: Environment) -> None:  # noqa: C901, PLR091
         console.print("reset:  Reset agent's memory", style="bold green")
         console.print("retry:  Retry the last question", style="bold green")
         console.print("undo:   Undo the last question", style="bold green")
-        console.print("log:    Open log file", style="bold green")
-        console.print("clean:  Clean log file", style="bold green")
+        console.print(
+            "tree:   Show the branches of this conversation",
+            style="bold green",
+        )
+        console.print(
+            "branch: Branch off after a turn (branch <turn>)",
+            style="bold green",
+        )
+        console.print("checkout: Switch to a branch (checkout <n>)", style="bold green")
+        console.print(
+            "log:    Open the current log segment (log <date> [<date>] for older)",
+            style="bold green",
+        )
+        console.print(
+            "clean:  Clean log files (clean | clean 30d | clean 500mb)",
+            style="bold green",
+        )
         console.print("save:   Save the current conversation", style="bold green")
         console.print("load:   Load a previous conversation", style="bold green")
         console.print("model:  Change the model", style="bold green")
+        console.print(
+            "models: List models (models <filter> | models refresh)",
+            style="bold green",
+        )
         console.print("instr:  Change the instruction", style="bold green")
-        console.print("length: Change the context length", style="bold green")
-        console.print("file:   Input file content", style="bold green")
-        console.print("md:     Render last output as markdown", style="bold green")
+        console.print(
+            "length: Change the context length (e.g. 10 or 32k tokens)",
+            style="bold green",
+        )
+        console.print(
+            "file:   Input file content (file [paths or globs...])",
+            style="bold green",
+        )
+        console.print(
+            "md:     Render last output as markdown (md live | md plain to stream)",
+            style="bold green",
+        )
+        console.print(
+            "cache:  Response cache (cache on|off|stats|clear)",
+            style="bold green",
+        )
+        console.print(
+            "compare: Ask several models at once (compare <model> <model> ...)",
+            style="bold green",
+        )
+        console.print("stats:  Show latency statistics per model", style="bold green")
+        console.print(
+            "search: Search past conversations (search <query>)",
+            style="bold green",
+        )
+        console.print(
+            "reindex: Index existing logs and saves for search",
+            style="bold green",
+        )
         console.print("help:   Show this help message", style="bold green")
         console.print("others: Send a message to the agent", style="bold green")
         console.print(
@@ -56,15 +113,65 @@ def main_loop(console: Console, env: Environment) -> None:  # noqa: C901, PLR091
         agent.undo(console)
         console.print("Last dialog undone.", style="green")
 
-    def open_log() -> None:
-        if agent.open_log():
-            console.print("Log file opened.", style="green")
+    def show_tree() -> None:
+        if not agent.log.offsets:
+            console.print("No dialog yet.", style="yellow")
+            return
+        console.print(agent.get_tree())
+
+    def checkout(number: str) -> None:
+        branches = agent.branches()
+        if not number.isdigit() or not 1 <= int(number) <= len(branches):
+            console.print(f"Branch must be 1-{len(branches)}.", style="red")
+            return
+        agent.checkout(branches[int(number) - 1])
+        console.print(
+            f"Switched to branch {number} ({agent.dialog_count} dialogs).",
+            style="green",
+        )
+        show_last_dialog()
+
+    def branch(turn: str) -> None:
+        if agent.dialog_count == 0:
+            console.print("No dialog to branch from.", style="red")
+            return
+        if not turn.isdigit() or not agent.fork(int(turn)):
+            console.print(f"Turn must be 0-{agent.dialog_count - 1}.", style="red")
+            return
+        console.print(
+            f"Next question will branch off after turn {turn}.",
+            style="green",
+        )
+
+    def open_log(start: str = "", end: str = "") -> None:
+        count = agent.open_log(start, end)
+        if count:
+            console.print(f"{count} log file(s) opened.", style="green")
         else:
             console.print("Log file not found.", style="red")
 
-    def clean_log() -> None:
-        agent.clean_log()
-        console.print("Log file cleaned.", style="green")
+    # 30d: 删除30天前的分段, 500mb: 删除最旧的分段直到总大小不超过500MB
+    def clean_log(policy: str = "") -> None:
+        policy = policy.lower()
+        try:
+            if not policy:
+                count = agent.clean_log()
+            elif policy.endswith("d"):
+                count = agent.clean_log(max_days=int(policy[:-1]))
+            elif policy.endswith("gb"):
+                count = agent.clean_log(max_mb=int(float(policy[:-2]) * 1024))
+            elif policy.endswith("mb"):
+                count = agent.clean_log(max_mb=int(policy[:-2]))
+            else:
+                raise ValueError
+        except ValueError:
+            console.print("Usage: clean [<days>d | <size>mb | <size>gb]", style="red")
+            return
+        size = agent.log.store.total_size() / 1024 / 1024
+        console.print(
+            f"{count} log segment(s) removed, {size:.1f} MB left.",
+            style="green",
+        )
 
     def change_model(model_id: str) -> None:
         nonlocal agent
@@ -76,6 +183,32 @@ def main_loop(console: Console, env: Environment) -> None:  # noqa: C901, PLR091
         else:
             console.print("Model not found, please try again.", style="red")
 
+    # models refresh: 重新获取各服务商的模型列表; 其余参数作为模糊过滤条件
+    def list_models(query: str = "") -> None:
+        if query.lower() == "refresh":
+            console.print("Fetching model lists...", style="dim green")
+            try:
+                env.apply_catalog(env.refresh_catalog().result())
+            except OSError as e:
+                console.print(f"Failed to save model list: {e}", style="red")
+                return
+            for provider, error in env.open_catalog().errors.items():
+                console.print(f"{provider}: {error}", style="red")
+        names = env.model_index.closest(query, 20) if query else env.model_id_list
+        table = Table(show_header=True, header_style="bold magenta")
+        table.add_column("Model ID")
+        table.add_column("Provider")
+        table.add_column("Source")
+        for name in names:
+            found = env.find_api(name)
+            table.add_row(
+                name,
+                found[0] if found else "-",
+                "config" if name in env.configured_models else "discovered",
+            )
+        console.print(table)
+        console.print(f"{len(env.model_id_list)} model(s) available.", style="green")
+
     def change_instr(instr_key: str) -> None:
         nonlocal agent
         instr_key = env.match_instr_key(instr_key)
@@ -86,52 +219,243 @@ def main_loop(console: Console, env: Environment) -> None:  # noqa: C901, PLR091
         else:
             console.print("Instruction not found, please try again.", style="red")
 
-    def change_context_len(context_len: int) -> None:
+    # 纯数字按问答数计算上下文, 以k结尾(如32k)则按token数计算
+    def change_context_len(length: str) -> None:
         nonlocal agent
-        env.change_context_len(context_len)
+        try:
+            if length[-1].lower() == "k":
+                env.change_context_tokens(int(float(length[:-1]) * 1000))
+            else:
+                env.change_context_len(int(length))
+        except ValueError:
+            console.print(f"Invalid context length '{length}'.", style="red")
+            return
         agent = env.init_agent()
-        console.print(f"Context length changed to {context_len}.", style="green")
+        console.print(f"Context length changed to {length}.", style="green")
         console.print(agent.get_info_table())
 
     def save(save_name: str) -> None:
         nonlocal agent
         save_path = Path("saves") / f"{save_name}.apai"
         old_path = agent.log.save_path
+        agent.log.flush()
         shutil.copy(old_path, save_path)
         agent.change_log(save_path)
         console.print(f"Conversation saved to {save_path}.", style="green")
 
     def load(save_name: str) -> None:
+        load_save(Path("saves") / f"{save_name}.apai")
+
+    def load_save(save_path: Path) -> None:
         nonlocal agent
-        save_path = Path("saves") / f"{save_name}.apai"
         if not save_path.exists():
             console.print(f"Save file {save_path} does not exist.", style="red")
             return
         agent = env.read_save(save_path)
         console.print(f"Conversation loaded from {save_path}.", style="green")
         console.print(agent.get_info_table())
+        show_last_dialog()
+
+    def show_last_dialog() -> None:
         if agent.dialog_count > 0:
             console.print("last dialog:", style="dim green")
-            console.print(f"{agent.message.dialogs[-2]['role']:}", style="dim bold")
-            console.print(f"{agent.message.dialogs[-2]['content']}", style="dim blue")
-            console.print(f"{agent.message.dialogs[-1]['role']:}", style="dim bold")
-            console.print(f"{agent.message.dialogs[-1]['content']}", style="dim cyan")
+            ask, answer = agent.message.get_dialog(-2), agent.message.get_dialog(-1)
+            console.print(f"{ask['role']:}", style="dim bold")
+            console.print(f"{ask['content']}", style="dim blue")
+            console.print(f"{answer['role']:}", style="dim bold")
+            console.print(f"{answer['content']}", style="dim cyan")
+
+    def show_markdown(mode: str = "") -> None:
+        mode = mode.lower()
+        if mode in ("live", "plain"):
+            env.change_live_markdown(mode == "live")
+            agent.live_markdown = mode == "live"
+            console.print(f"Answers will stream as {mode} text.", style="green")
+        elif mode:
+            console.print("Usage: md [live|plain]", style="red")
+        else:
+            agent.show_markdown(console)
+
+    def cache_command(action: str) -> None:
+        action = action.lower()
+        if action in ("on", "off"):
+            env.change_cache(action == "on")
+            if action == "on":
+                agent.cache = env.open_cache()
+            else:
+                agent.cache = None
+            console.print(f"Response cache turned {action}.", style="green")
+        elif action == "stats":
+            cache = env.open_cache()
+            state = "on" if env.config.cache else "off"
+            console.print(f"Response cache ({state}):", style="green")
+            for key, value in cache.stats().items():
+                console.print(f"  {key}: {value}", style="green")
+        elif action == "clear":
+            env.open_cache().clear()
+            console.print("Response cache cleared.", style="green")
+        else:
+            console.print("Usage: cache [on|off|stats|clear]", style="red")
+
+    def show_stats() -> None:
+        from metrics import stats_table
 
-    def show_markdown(console: Console) -> None:
-        agent.show_markdown(console)
+        records = env.metrics.load()
+        if not records:
+            console.print("No metrics recorded yet.", style="red")
+            return
+        console.print(stats_table(records))
+
+    def search(*words: str) -> None:
+        if not words:
+            console.print("Usage: search <query>", style="red")
+            return
+        index = env.open_search()
+        agent.log.flush()
+        start = time.perf_counter()
+        hits = index.search(" ".join(words))
+        elapsed = (time.perf_counter() - start) * 1000
+        if index.error is not None:
+            console.print(f"Search index error: {index.error}", style="red")
+            index.error = None
+        if not hits:
+            console.print(f"No results ({elapsed:.1f} ms).", style="yellow")
+            return
+        table = Table(show_header=True, header_style="bold magenta")
+        table.add_column("#", justify="right")
+        table.add_column("Time")
+        table.add_column("Model ID")
+        table.add_column("Role")
+        table.add_column("Save")
+        table.add_column("Snippet")
+        for i, hit in enumerate(hits, 1):
+            table.add_row(
+                str(i),
+                hit.time,
+                hit.model_id,
+                hit.role,
+                Path(hit.save).stem if hit.save else "-",
+                hit.snippet.replace("\n", " "),
+            )
+        console.print(table)
+        console.print(f"{len(hits)} result(s) in {elapsed:.1f} ms", style="green")
+        choice = console.input(
+            Text(
+                f"Load which save? (1-{len(hits)}, Enter to skip): ",
+                style="bold yellow",
+            ),
+        ).strip()
+        if choice.isdigit() and 1 <= int(choice) <= len(hits):
+            hit = hits[int(choice) - 1]
+            if hit.save is None:
+                console.print("This dialog is only kept in the log.", style="red")
+            else:
+                load_save(Path(hit.save))
+
+    def reindex() -> None:
+        index = env.open_search()
+        agent.log.flush()
+        start = time.perf_counter()
+        files, entries = index.reindex()
+        elapsed = time.perf_counter() - start
+        console.print(
+            f"Indexed {entries} dialog(s) from {files} changed file(s)"
+            f" in {elapsed:.2f} s.",
+            style="green",
+        )
+
+    def compare_models(*model_names: str) -> None:
+        from compare import CompareTarget, compare
+
+        targets = []
+        for name in model_names:
+            model_id = env.match_model_id(name)
+            found = env.find_api(model_id)
+            if found is None:
+                console.print(f"Model {name} not found.", style="red")
+                return
+            provider, api = found
+            targets.append(CompareTarget(provider, api.api, api.url, model_id))
+        if not targets:
+            console.print("Available models:", style="yellow")
+            console.print(env.model_id_list)
+            return
+        ask = console.input("compare> ")
+        if ask.strip() == "":
+            ask = get_multi_line_input()
+        if ask.strip() == "":
+            return
+        agent.message.add_dialog("user", ask)
+        messages = agent.current_messages()
+        agent.message.pop_dialog()
+        results = compare(targets, messages, console)
+        choice = console.input(
+            Text(
+                f"Adopt which answer? (1-{len(results)}, Enter to skip): ",
+                style="bold yellow",
+            ),
+        ).strip()
+        if choice.isdigit() and 1 <= int(choice) <= len(results):
+            result = results[int(choice) - 1]
+            if not result.error:
+                agent.adopt(ask, result.answer + "\n")
+                console.print(
+                    f"Answer from {result.target.model_id} adopted.",
+                    style="green",
+                )
+
+    def chunk_budget() -> int:
+        tokens = env.config.file_chunk_tokens
+        if agent.context_tokens > 0:
+            tokens = min(tokens, agent.context_tokens // 2)
+        return tokens
+
+    # 超出分块预算的文件不在编辑器中打开, 直接分块提问; 返回是否已处理
+    def ask_large_file(file_path: Path) -> bool:
+        if not file_path.is_file():
+            return False
+        from mapreduce import estimate_file_tokens
+
+        size = file_path.stat().st_size
+        if estimate_file_tokens(file_path, chunk_budget()) <= chunk_budget():
+            return False
+        console.print(
+            f"{file_path} ({size / 1024 / 1024:.1f} MB) is too large for one"
+            " request and will be processed in chunks.",
+            style="yellow",
+        )
+        ask = console.input(Text("Question about the file: ", style="bold"))
+        if ask.strip() == "":
+            ask = get_multi_line_input()
+        if ask.strip():
+            agent.chat_chunked(
+                ask,
+                file_path,
+                console,
+                chunk_budget(),
+                env.config.file_workers,
+            )
+        return True
 
     def get_file_input(file_path: Path = Path(".in.txt")) -> tuple[str, str]:
+        from files import open_path
+
         if not file_path.exists():
             if file_path == Path(".in.txt"):
                 file_path.touch()
             else:
                 console.print(f"File {file_path} does not exist.", style="red")
                 return "", ""
-        os.startfile(file_path)  # noqa: S606
-        console.print(
-            f"{file_path} opened, input your content here and save it\n",
-            style="green",
-        )
+        if open_path(file_path):
+            console.print(
+                f"{file_path} opened, input your content here and save it\n",
+                style="green",
+            )
+        else:
+            console.print(
+                f"Edit {file_path} in your editor and save it\n",
+                style="green",
+            )
         terminal_input = console.input(
             Text(
                 "You can add some content in terminal and press Enter to continue\n",
@@ -142,6 +466,32 @@ def main_loop(console: Console, env: Environment) -> None:  # noqa: C901, PLR091
             file_content = f.read()
         return file_content, terminal_input
 
+    # 多个文件与通配符: 并行读取, 跳过过大与二进制的文件; 返回 (文件, 提问)
+    def get_files_input(patterns: list[str]) -> tuple[list[FileInput], str]:
+        from files import expand_paths, read_files
+
+        paths, missing = expand_paths(patterns)
+        for pattern in missing:
+            console.print(f"No file matches {pattern}", style="red")
+        start = time.perf_counter()
+        files = read_files(paths, env.config.file_max_kb * 1024)
+        elapsed = time.perf_counter() - start
+        for file in files:
+            if file.skipped:
+                console.print(f"Skipped {file.path}: {file.skipped}", style="yellow")
+        read = [file for file in files if not file.skipped]
+        if not read:
+            return [], ""
+        size = sum(file.size for file in read)
+        console.print(
+            f"{len(read)} file(s), {size / 1024:.1f} KB read in {elapsed:.2f}s",
+            style="green",
+        )
+        ask = console.input(Text("Question about the files: ", style="bold"))
+        if ask.strip() == "":
+            ask = get_multi_line_input()
+        return files, ask
+
     def get_multi_line_input() -> str:
         console.print("[Multi-line mode]\n", style="magenta", end="")
         lines = []
@@ -179,16 +529,34 @@ def main_loop(console: Console, env: Environment) -> None:  # noqa: C901, PLR091
         "reset": lambda: reset_agent(),
         "retry": lambda: retry(),
         "undo": lambda: undo(),
-        "log": lambda: open_log(),
-        "clean": lambda: clean_log(),
+        "tree": lambda: show_tree(),
+        "branch": lambda turn: branch(turn),
+        "checkout": lambda number: checkout(number),
+        "log": lambda *dates: open_log(*dates),
+        "clean": lambda *policy: clean_log(*policy),
         "save": lambda name: save(name),
         "load": lambda name: load(name),
         "model": lambda name: change_model(name),
+        "models": lambda *query: list_models(" ".join(query)),
         "instr": lambda key: change_instr(key),
-        "length": lambda length: change_context_len(int(length)),
-        "md": lambda: show_markdown(console),
+        "length": lambda length: change_context_len(length),
+        "md": lambda *mode: show_markdown(*mode),
+        "compare": lambda *names: compare_models(*names),
+        "cache": lambda action: cache_command(action),
+        "stats": lambda: show_stats(),
+        "search": lambda *words: search(*words),
+        "reindex": lambda: reindex(),
     }
 
+    # 启动计时用: 到达提示符后立即退出
+    if exit_at_prompt:
+        from startup import PROMPT_MARKER
+
+        print(PROMPT_MARKER, flush=True)  # noqa: T201
+        env.close()
+        return
+
+    install_completion(env, list(command_map))
     while True:
         ask = ""
         file = ""
@@ -211,7 +579,14 @@ def main_loop(console: Console, env: Environment) -> None:  # noqa: C901, PLR091
                         console.print(env.instr_key_list)
                 continue
             if cmd == "file":
-                file, ask = get_file_input(Path(args[0]) if args else Path(".in.txt"))
+                if len(args) == 1 and ask_large_file(Path(args[0])):
+                    continue
+                if args:
+                    files, ask = get_files_input(args)
+                    if files:
+                        agent.chat(ask, "", console, files)
+                    continue
+                file, ask = get_file_input()
                 if file == "" and ask == "":
                     continue
                 file += "\n"
@@ -221,8 +596,117 @@ def main_loop(console: Console, env: Environment) -> None:  # noqa: C901, PLR091
             agent.chat(ask, file, console)
 
 
+# Tab补全指令名, 以及model/compare/instr的参数; 没有readline的平台(如Windows)跳过
+def install_completion(env: Environment, commands: list[str]) -> None:
+    try:
+        import readline
+    except ImportError:
+        return
+    matches: list[str] = []
+
+    def complete(text: str, state: int) -> str | None:
+        nonlocal matches
+        if state == 0:
+            words = readline.get_line_buffer()[: readline.get_begidx()].split()
+            if not words:
+                matches = [cmd for cmd in commands if cmd.startswith(text.lower())]
+            elif words[0].lower() in ("model", "compare"):
+                matches = env.model_index.complete(text)
+            elif words[0].lower() == "instr":
+                matches = env.instr_index.complete(text)
+            else:
+                matches = []
+        return matches[state] if state < len(matches) else None
+
+    # 模型名中可能含有 - / : 等字符, 只按空白分词
+    readline.set_completer_delims(" \t\n")
+    readline.set_completer(complete)
+    readline.parse_and_bind("tab: complete")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="apai")
+    subparsers = parser.add_subparsers(dest="command")
+    batch = subparsers.add_parser("batch", help="Run prompts from a JSONL file")
+    batch.add_argument("input", type=Path, help="JSONL file of prompts")
+    batch.add_argument("--model", help="Model ID (fuzzy matched)")
+    batch.add_argument("--instr", help="Instruction key (fuzzy matched)")
+    batch.add_argument("--workers", type=int, default=4)
+    batch.add_argument("--output", type=Path, help="JSONL file of results")
+    batch.add_argument("--rpm", type=int, default=0, help="Requests per minute")
+    batch.add_argument("--tpm", type=int, default=0, help="Tokens per minute")
+    serve = subparsers.add_parser("serve", help="Serve sessions over HTTP/WebSocket")
+    serve.add_argument("--host", help="Address to listen on")
+    serve.add_argument("--port", type=int, help="Port to listen on")
+    serve.add_argument("--idle-minutes", type=float, help="Unload idle sessions")
+    parser.add_argument(
+        "--import-profile",
+        action="store_true",
+        help="Measure time to prompt and the slowest imports",
+    )
+    parser.add_argument("--exit-at-prompt", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+# 批量模式下的模型与指令只对本次运行生效, 不写回config.toml
+def run_batch(console: Console, env: Environment, args: argparse.Namespace) -> None:
+    if args.model and not env.change_model(
+        env.match_model_id(args.model),
+        persist=False,
+    ):
+        console.print(f"Model {args.model} not found.", style="red")
+        return
+    if args.instr and not env.change_instr_key(
+        env.match_instr_key(args.instr),
+        persist=False,
+    ):
+        console.print(f"Instruction {args.instr} not found.", style="red")
+        return
+    if env.config.model_id == "":
+        console.print("No model selected, use --model.", style="red")
+        return
+    from batch import BatchRunner
+
+    output = args.output or args.input.with_suffix(".out.jsonl")
+    runner = BatchRunner(env, args.workers, args.rpm, args.tpm, console)
+    try:
+        runner.run(args.input, output)
+    finally:
+        env.close()
+    console.print(f"Results written to {output}.", style="green")
+
+
+def run_serve(console: Console, env: Environment, args: argparse.Namespace) -> None:
+    import asyncio
+
+    from server import serve
+
+    config = env.config
+    idle_minutes = args.idle_minutes or config.serve_idle_minutes
+    try:
+        asyncio.run(
+            serve(
+                env,
+                args.host or config.serve_host,
+                args.port or config.serve_port,
+                idle_minutes * 60,
+                console,
+            ),
+        )
+    except KeyboardInterrupt:
+        console.print("Server stopped.", style="yellow")
+    finally:
+        env.close()
+
+
 def main() -> None:
+    args = parse_args()
     console = Console()
+    if args.import_profile:
+        from startup import profile_startup
+
+        profile_startup(console)
+        return
     console.print("This is APaI v0.2.0", style="bold green")
     console.print("Type 'help' for help, or read README.md.", style="dim green")
 
@@ -236,6 +720,12 @@ def main() -> None:
         console.print("No model found in api_bin.toml", style="red")
         console.print("Read the README.md file for more information.", style="red")
         return
+    if args.command == "batch":
+        run_batch(console, env, args)
+        return
+    if args.command == "serve":
+        run_serve(console, env, args)
+        return
     while env.config.model_id == "":
         console.print("Please select a model from the following list:", style="yellow")
         console.print(env.model_id_list)
@@ -243,7 +733,7 @@ def main() -> None:
         if not env.change_model(env.match_model_id(model_id)):
             console.print("Model not found, please try again.", style="yellow")
 
-    main_loop(console, env)
+    main_loop(console, env, exit_at_prompt=args.exit_at_prompt)
 
 
 if __name__ == "__main__":
@@ -1,61 +1,348 @@
-import os
+from __future__ import annotations
+
+import re
 from pathlib import Path
+from typing import TYPE_CHECKING
 
-from openai import OpenAI, Stream
-from rich.console import Console
-from rich.markdown import Markdown
 from rich.table import Table
 
+from hedge import Route, StreamRace
 from log import Log
 from message import Message
+from render import MarkdownRenderer, StreamRenderer
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable, Iterator
+    from concurrent.futures import Future
+
+    from openai import OpenAI, Stream
+    from openai.types.chat import ChatCompletionChunk
+    from rich.console import Console
+    from rich.tree import Tree
+
+    from cache import ResponseCache
+    from files import FileInput
+    from metrics import MetricsStore, TurnMetrics
+    from search import SearchIndex
+    from segments import LogStore
+    from summary import Summarizer
+    from writer import LogWriter
+
+# SSE的结束行; 结束行可能被拆在两个块中, 匹配时带上前一块末尾的DONE_TAIL个字节
+DONE_LINE = re.compile(rb"[\r\n]data: ?\[DONE\]")
+DONE_TAIL = 16
+
+
+# 同步的Stream读到[DONE]就关闭响应, HTTP/1.1下没读完的响应体会让连接被丢弃,
+# 下一轮又要重新握手; 读到[DONE]的块时顺带读完响应体, 连接才能回到连接池
+# 只认行首的 data: [DONE], 回答内容在JSON字符串中, 不会出现在行首
+def keep_connection(stream: Stream) -> None:
+    response = stream.response
+    if response.http_version != "HTTP/1.1":
+        return
+    iter_bytes = response.iter_bytes
+
+    def iter_drained(*args: object, **kwargs: object) -> Iterator[bytes]:
+        chunks = iter_bytes(*args, **kwargs)
+        tail = b"\n"
+        for chunk in chunks:
+            if DONE_LINE.search(tail + chunk):
+                chunk += b"".join(chunks)  # noqa: PLW2901
+            else:
+                tail = (tail + chunk)[-DONE_TAIL:]
+            yield chunk
+
+    response.iter_bytes = iter_drained
+
+
+# 把流式响应转换为 (类型, 文本) 增量, 类型为reasoning或content
+def iter_deltas(stream: Stream, metrics: TurnMetrics) -> Iterator[tuple[str, str]]:
+    for chunk in stream:
+        delta = chunk_delta(chunk, metrics)
+        if delta is not None:
+            yield delta
+
+
+# 同步与异步的流共用
+def chunk_delta(
+    chunk: ChatCompletionChunk,
+    metrics: TurnMetrics,
+) -> tuple[str, str] | None:
+    # 开启include_usage时最后一个块只带用量, choices为空
+    if getattr(chunk, "usage", None):
+        metrics.on_usage(chunk.usage)
+    if not chunk.choices:
+        return None
+    delta = chunk.choices[0].delta
+    reasoning = getattr(delta, "reasoning_content", None)
+    if reasoning:
+        metrics.on_chunk("reasoning")
+        return "reasoning", reasoning
+    if delta.content:
+        metrics.on_chunk("content")
+        return "content", delta.content
+    return None
 
 
 class Agent:
+    temperature = 1.0
+    top_p = 1.0
+
     def __init__(
         self,
-        client: OpenAI,
+        client: Future[OpenAI],
         api_provider: str,
         model_id: str,
         instr_kv: tuple[str, str],
         context_len: int,
+        context_tokens: int,
+        writer: LogWriter,
+        log_store: LogStore,
+        cache: ResponseCache | None = None,
+        metrics: MetricsStore | None = None,
+        *,
+        stream_usage: bool = True,
+        live_markdown: bool = False,
+        window_block: int = 0,
+        summarizer: Summarizer | None = None,
+        summary_age: int = 0,
+        search: SearchIndex | None = None,
+        backups: list[Route] | None = None,
+        ttft_timeout: float = 0,
+        stall_timeout: float = 0,
+        save_path: Path = Log.autosave_path,
     ) -> None:
-        self.client = client
+        # 客户端在后台线程中创建, 第一次发请求时才等待它就绪
+        self.client_future = client
+        # 提供同一模型的其他服务商, 用于对冲请求与故障切换
+        self.routes = [Route(api_provider, client), *(backups or [])]
+        self.ttft_timeout = ttft_timeout
+        self.stall_timeout = stall_timeout
+        # reset后重新开始的存档
+        self.save_path = save_path
         self.api_provider = api_provider
         self.model_id = model_id
         self.instr_key = instr_kv[0]
         self.instruction = instr_kv[1]
         self.context_len = context_len
+        self.context_tokens = context_tokens
+        self.cache = cache
+        self.cache_key = ""
+        self.cache_hit = False
+        self.metrics = metrics
+        self.stream_usage = stream_usage
+        # 回答流式输出时即渲染为Markdown
+        self.live_markdown = live_markdown
+        self.retried: tuple[dict, int] | None = None
+        # 上一次附加的文件中因已在窗口内而只发送引用的个数
+        self.referenced_files = 0
+        # 窗口超出上限时一次丢弃的比例(%), 0为每轮滑动
+        self.window_block = window_block
+        # 本次会话的提示token总数与其中命中前缀缓存的部分
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.turn_metrics: TurnMetrics | None = None
+        # 本轮回答被Ctrl-C中断, 只保留了已输出的部分
+        self.interrupted = False
+        self.summarizer = summarizer
+        self.summary_age = summary_age
+        self.search = search
 
-        self.log = Log(model_id, instr_kv[0], Path("logs") / f"{model_id}.log")
-        self.message = Message(self.instruction)
+        self.log = Log(
+            model_id,
+            instr_kv[0],
+            log_store,
+            writer,
+            save_path,
+            index=search,
+        )
+        self.message = Message(self.instruction, self.log.read_dialogs)
         self.dialog_count = 0
         self.last_answer = ""
+        self.last_reasoning = ""
+        self.render_stats: dict = {}
+
+    @property
+    def client(self) -> OpenAI:
+        return self.client_future.result()
 
     def add_dialog(self, role: str, content: str) -> None:
         self.message.add_dialog(role, content)
         self.log.write_dialog(role, content)
 
     def reset_message(self) -> None:
+        self.log.flush()
+        if self.summarizer is not None:
+            self.summarizer.cancel()
         self.dialog_count = 0
-        self.message = Message(self.instruction)
         self.log = Log(
             self.model_id,
             self.instr_key,
-            Path("logs") / f"{self.model_id}.log",
+            self.log.store,
+            self.log.writer,
+            self.save_path,
+            index=self.search,
         )
+        self.message = Message(self.instruction, self.log.read_dialogs)
+
+    def clean_log(self, max_days: int = 0, max_mb: int = 0) -> int:
+        return self.log.clean(max_days, max_mb)
 
-    def clean_log(self) -> None:
-        self.log.clean()
+    # 不指定日期时只打开当前分段; 指定日期区间时打开与之重叠的分段, 压缩的分段先解压到临时目录
+    def open_log(self, start: str = "", end: str = "") -> int:
+        self.log.flush()
+        store = self.log.store
+        if not start:
+            paths = [store.current] if store.current.exists() else []
+        else:
+            paths = []
+            for segment in store.find(start, end):
+                path = store.directory / segment.file
+                if segment.compressed and path.exists():
+                    path = self.extract_segment(path)
+                if path.exists():
+                    paths.append(path)
+        from files import open_path
 
-    def open_log(self) -> bool:
-        if self.log.log_path.exists():
-            os.startfile(self.log.log_path)  # noqa: S606
-            return True
-        return False
+        return sum(open_path(path) for path in paths)
+
+    @staticmethod
+    def extract_segment(path: Path) -> Path:
+        import gzip
+        import shutil
+        import tempfile
+
+        target = Path(tempfile.gettempdir()) / "apai" / path.name.removesuffix(".gz")
+        target.parent.mkdir(parents=True, exist_ok=True)
+        with gzip.open(path, "rb") as src, target.open("wb") as dst:
+            shutil.copyfileobj(src, dst, 1 << 20)
+        return target
 
     def change_log(self, save_path: Path) -> None:
-        self.log.save_path = save_path
-        self.log.header_written = self.dialog_count > 0
+        self.log.move_save(save_path, self.log.header_written)
+
+    # 关联已有存档, 只载入上下文窗口内的对话
+    def attach_save(self, save_path: Path) -> None:
+        self.log.change_save(save_path, header_written=True)
+        self.load_branch()
+
+    # 按当前分支重建上下文, 各分支共用的对话不重复占用内存
+    def load_branch(self) -> None:
+        self.message = Message(self.instruction, self.log.read_dialogs)
+        self.message.attach(
+            self.log.read_dialogs,
+            len(self.log.path),
+            self.context_len * 2 if self.context_tokens <= 0 else 2,
+        )
+        self.message.set_summary(self.log.summary, self.log.summary_covered)
+        self.dialog_count = len(self.message) // 2
+        self.last_answer = ""
+        if self.dialog_count > 0:
+            self.last_answer = self.message.get_dialog(-1)["content"]
+
+    # 切换到以node结尾的分支; 只读回新分支上下文窗口内的对话
+    def checkout(self, node: int) -> None:
+        if self.summarizer is not None:
+            self.summarizer.cancel()
+        self.log.checkout(node)
+        self.load_branch()
+
+    # 全部分支(对话树的叶子)按创建顺序编号, 从1开始
+    def branches(self) -> list[int]:
+        return self.log.leaves()
+
+    # 把第turn轮问答作为当前分支的末尾, 之后的提问从这里分出新的分支
+    def fork(self, turn: int) -> bool:
+        if not 0 <= turn < self.dialog_count:
+            return False
+        self.checkout(self.log.path[turn * 2 - 1] if turn > 0 else -1)
+        return True
+
+    # 把上一次请求时已滑出窗口的问答(以及早于summary_age轮的问答)交给后台摘要
+    def schedule_summary(self) -> None:
+        if self.summarizer is None or self.summarizer.busy():
+            return
+        target = self.message.window_start - self.message.window_start % 2
+        if self.summary_age > 0:
+            target = max(target, (len(self.message) // 2 - self.summary_age) * 2)
+        covered = self.message.summary_covered
+        if target <= covered:
+            return
+        self.summarizer.submit(
+            self.message.summary,
+            self.message.read_range(covered, target),
+            target,
+        )
+
+    # 后台摘要完成时替换旧摘要, 未完成则本轮照常发送, 不等待
+    def apply_summary(self, console: Console) -> None:
+        if self.summarizer is None:
+            return
+        result = self.summarizer.poll()
+        if result is None:
+            if self.summarizer.error is not None:
+                console.print(f"Summary failed: {self.summarizer.error}", style="red")
+                self.summarizer.error = None
+            return
+        summary, covered = result
+        if summary and covered <= len(self.message):
+            self.message.set_summary(summary, covered)
+            self.log.write_summary(summary, covered)
+
+    # 对话树: 只有一个子记录的记录连成一段, 每段显示起止轮次与第一条记录的开头
+    def get_tree(self) -> Tree:
+        from rich.text import Text
+        from rich.tree import Tree
+
+        log = self.log
+        children: dict[int, list[int]] = {}
+        depth = []
+        for node, parent in enumerate(log.parents):
+            children.setdefault(parent, []).append(node)
+            depth.append(depth[parent] + 1 if parent >= 0 else 0)
+        numbers = {leaf: i for i, leaf in enumerate(self.branches(), 1)}
+        # (起点, 终点, 上一段的序号)
+        segments: list[tuple[int, int, int]] = []
+        current = -1
+        stack = [(start, -1) for start in reversed(children.get(-1, []))]
+        while stack:
+            start, above = stack.pop()
+            end = start
+            while True:
+                if end == log.head:
+                    current = len(segments)
+                if len(children.get(end, [])) != 1:
+                    break
+                end = children[end][0]
+            segments.append((start, end, above))
+            index = len(segments) - 1
+            stack += [(child, index) for child in reversed(children.get(end, []))]
+        records = log.read_nodes([start for start, _, _ in segments])
+        on_path = set(log.path)
+        tree = Tree(Text("conversation", style="bold"))
+        nodes: list[Tree] = []
+        for index, (start, end, above) in enumerate(segments):
+            record = records[index]
+            first, last = depth[start] // 2 + 1, depth[end] // 2 + 1
+            turns = f"turn {first}" if first == last else f"turns {first}-{last}"
+            mark = "Q" if record["role"] == "user" else "A"
+            snippet = record["content"].strip().split("\n", 1)[0][:40]
+            label = Text(f"{turns}  {mark}: {snippet}")
+            if end in numbers:
+                label.append(f"  [branch {numbers[end]}]", style="cyan")
+            if index == current:
+                at = "" if log.head == end else f" (turn {depth[log.head] // 2 + 1})"
+                label.append(f"  <- current{at}", style="bold yellow")
+            if start in on_path:
+                label.stylize("green")
+            parent = tree if above < 0 else nodes[above]
+            nodes.append(parent.add(label))
+        return tree
+
+    def context_to_string(self) -> str:
+        if self.context_tokens > 0:
+            return f"{self.context_tokens // 1000}k tokens"
+        return str(self.context_len)
 
     def get_info_table(self) -> Table:
         table = Table(show_header=True, header_style="bold magenta")
@@ -67,60 +354,251 @@ class Agent:
             self.api_provider,
             self.model_id,
             self.instr_key,
-            str(self.context_len),
+            self.context_to_string(),
         )
         return table
 
-    def create_stream(self) -> Stream:
-        return self.client.chat.completions.create(
-            model=self.model_id,
-            messages=self.message.generate_messages(self.context_len),
-            stream=True,
-            temperature=1.0,
-            top_p=1.0,
+    def current_messages(self) -> list:
+        return self.message.generate_messages(
+            self.context_len,
+            self.context_tokens,
+            self.window_block,
+        )
+
+    # 命中缓存时返回 (思考内容, 回答), 否则返回None
+    def lookup_cache(
+        self,
+        messages: list,
+        *,
+        use_cache: bool = True,
+    ) -> tuple[str, str] | None:
+        self.cache_hit = False
+        self.cache_key = ""
+        if self.cache is None:
+            return None
+        self.cache_key = self.cache.make_key(
+            self.model_id,
+            self.temperature,
+            self.top_p,
+            messages,
+        )
+        cached = self.cache.get(self.cache_key) if use_cache else None
+        self.cache_hit = cached is not None
+        return cached
+
+    # 命中缓存时直接回放缓存内容, 否则发出请求
+    def create_stream(
+        self,
+        messages: list | None = None,
+        *,
+        use_cache: bool = True,
+    ) -> Iterable[tuple[str, str]]:
+        if messages is None:
+            messages = self.current_messages()
+        cached = self.lookup_cache(messages, use_cache=use_cache)
+        if cached is not None:
+            return iter((("reasoning", cached[0]), ("content", cached[1])))
+        return self.open_stream(messages)
+
+    # 记录提问(暂不写入日志), 返回本轮要发送的消息
+    def begin_chat(
+        self,
+        content: str,
+        console: Console,
+        files: list[FileInput] | None = None,
+    ) -> list:
+        self.dialog_count += 1
+        self.apply_summary(console)
+        if files:
+            from files import REFERENCE_NOTE, format_files
+
+            content = format_files(files) + "\n" + content
+        self.message.add_dialog("user", content)
+        messages = self.current_messages()
+        if files:
+            self.referenced_files = messages[-1]["content"].count(REFERENCE_NOTE)
+        return messages
+
+    # 撤回最后一个回答, 返回重新提问要发送的消息
+    # 记下撤回的回答及其记录编号, 请求失败时由restore_answer恢复
+    def begin_retry(self) -> list:
+        self.retried = (self.message.pop_dialog(), self.log.path[-1])
+        self.log.retry()
+        return self.current_messages()
+
+    # 重试的请求失败时放回原来的回答; 存档中的记录没有变, 只需恢复当前分支
+    def restore_answer(self) -> None:
+        if self.retried is None:
+            return
+        answer, node = self.retried
+        self.retried = None
+        self.message.add_dialog(answer["role"], answer["content"])
+        self.log.path.append(node)
+
+    # 请求失败时撤回本轮提问
+    def drop_question(self) -> None:
+        self.dialog_count -= 1
+        self.message.pop_dialog()
+        self.log.truncate_save(1)
+        self.log.commit()
+
+    def request_options(self) -> dict:
+        options = {
+            "model": self.model_id,
+            "stream": True,
+            "temperature": self.temperature,
+            "top_p": self.top_p,
+        }
+        if self.stream_usage:
+            options["stream_options"] = {"include_usage": True}
+        return options
+
+    def open_stream(self, messages: list) -> StreamRace:
+        # 先等待客户端就绪, 再开始计时
+        self.client  # noqa: B018
+        return StreamRace(
+            self.routes,
+            self.model_id,
+            lambda client, metrics: self.request(client, messages, metrics),
+            self.ttft_timeout,
+            self.stall_timeout,
+        )
+
+    # 在StreamRace的后台线程中调用
+    def request(
+        self,
+        client: OpenAI,
+        messages: list,
+        metrics: TurnMetrics,
+    ) -> tuple[Stream, Iterator[tuple[str, str]]]:
+        stream = client.chat.completions.create(
+            messages=messages,
+            **self.request_options(),
         )
+        keep_connection(stream)
+        return stream, iter_deltas(stream, metrics)
 
-    def read_stream(self, console: Console, stream: Stream) -> str:
+    # Ctrl-C取消请求并保留已输出的部分
+    def read_stream(
+        self,
+        console: Console,
+        deltas: Iterable[tuple[str, str]],
+    ) -> str:
         content_buffer = []
         reasoning_buffer = []
-        for chunk in stream:
-            if (
-                hasattr(chunk.choices[0].delta, "reasoning_content")
-                and chunk.choices[0].delta.reasoning_content
-            ):
-                reasoning_buffer.append(chunk.choices[0].delta.reasoning_content)
-                console.print(
-                    chunk.choices[0].delta.reasoning_content,
-                    style="dim magenta",
-                    end="",
-                )
-            elif chunk.choices[0].delta.content:
-                content_buffer.append(chunk.choices[0].delta.content)
-                console.print(
-                    chunk.choices[0].delta.content,
-                    style="cyan",
-                    end="",
-                )
+        renderer = (MarkdownRenderer if self.live_markdown else StreamRenderer)(console)
+        self.interrupted = False
+        try:
+            for kind, text in deltas:
+                if kind == "idle":
+                    renderer.tick()
+                    continue
+                if not text:
+                    continue
+                if kind == "reasoning":
+                    reasoning_buffer.append(text)
+                    renderer.feed_reasoning(text)
+                elif kind == "content":
+                    content_buffer.append(text)
+                    renderer.feed_content(text)
+                else:
+                    renderer.settle()
+                    if kind == "switch":
+                        content_buffer.clear()
+                        reasoning_buffer.clear()
+                        text = f"Switched to {text}, answer restarted"  # noqa: PLW2901
+                    console.print(f"\n[{text}]", style="yellow")
+        except KeyboardInterrupt:
+            self.interrupted = True
+        finally:
+            if isinstance(deltas, StreamRace):
+                deltas.close()
+                self.turn_metrics = deltas.metrics
+            renderer.close()
+            self.render_stats = renderer.stats()
+        self.last_reasoning = "".join(reasoning_buffer)
         return "".join(content_buffer) + "\n"
 
-    def chat(self, ask: str, file: str, console: Console) -> None:
-        self.dialog_count += 1
-        self.add_dialog("user", file + ask)
-        stream = self.create_stream()
+    def end_marker(self) -> str:
+        if self.interrupted:
+            return "\n--INTERRUPTED--\n"
+        if self.cache_hit:
+            return "\n--END-- (cached)\n"
+        return "\n--END--\n"
 
-        if self.dialog_count <= self.context_len:
+    # 被中断的回答照常记入上下文与日志, 但不计入延迟统计, 也不写入缓存
+    def finish_answer(self, answer: str) -> None:
+        if self.turn_metrics is not None and not self.cache_hit:
+            self.turn_metrics.finish()
+            if self.metrics is not None and not self.interrupted:
+                self.metrics.write(self.turn_metrics)
+            if self.turn_metrics.cache_ratio() is not None:
+                self.prompt_tokens += self.turn_metrics.prompt_tokens
+                self.cached_tokens += self.turn_metrics.cached_tokens
+        self.last_answer = answer
+        self.add_dialog("assistant", answer)
+        self.log.commit()
+        if (
+            self.cache is not None
+            and not self.cache_hit
+            and not self.interrupted
+            and self.cache_key
+        ):
+            self.cache.put(
+                self.cache_key,
+                self.model_id,
+                self.last_reasoning,
+                answer,
+            )
+        self.schedule_summary()
+
+    def chat(
+        self,
+        ask: str,
+        file: str,
+        console: Console,
+        files: list[FileInput] | None = None,
+    ) -> None:
+        # 先发出请求, 再把提问交给日志写入器
+        stream = self.create_stream(self.begin_chat(file + ask, console, files))
+        content = self.message.get_dialog(len(self.message) - 1)["content"]
+        self.log.write_dialog("user", content)
+
+        if self.context_tokens > 0:
+            expired = self.message.window_start // 2
+            console.print(
+                f"context: [{self.message.window_tokens}|{self.context_tokens}]"
+                " tokens" + (f"  {expired} context(s) expired" if expired else ""),
+                style="yellow" if expired else "green",
+            )
+        elif self.context_len <= 0 or self.message.window_start == 0:
             console.print(
                 f"context: [{self.dialog_count}|{self.context_len}]",
                 style="green",
             )
         else:
+            # 分块丢弃时窗口内的轮数会少于上限
+            expired = (self.message.window_start + 1) // 2
             console.print(
-                f"context: [{self.context_len}|{self.context_len}]"
-                f"  {self.dialog_count - self.context_len} context(s) expired",
+                f"context: [{self.dialog_count - expired}|{self.context_len}]"
+                f"  {expired} context(s) expired",
                 style="yellow",
             )
+        if self.message.summary:
+            console.print(
+                f"summary: {self.message.summary_covered // 2} context(s)"
+                f" in {self.message.summary_tokens} tokens",
+                style="green",
+            )
 
-        if file == "":
+        if files:
+            count = sum(not item.skipped for item in files)
+            console.print(
+                f"user:\n[{count} file(s), {self.referenced_files} unchanged]",
+                style="bold",
+            )
+            console.print(f"{ask}", style="blue")
+        elif file == "":
             console.print("user:", style="bold")
             console.print(f"{ask}", style="blue")
         else:
@@ -130,15 +608,74 @@ class Agent:
         console.print(f"{self.model_id}:", style="bold")
 
         answer = self.read_stream(console, stream)
-        console.print("\n--END--\n", style="yellow")
-        self.last_answer = answer
+        console.print(self.end_marker(), style="yellow")
+        self.finish_answer(answer)
+        self.show_prompt_cache(console)
 
+    # 服务商报告了缓存用量时显示本轮与本次会话的前缀缓存命中率
+    def show_prompt_cache(self, console: Console) -> None:
+        metrics = self.turn_metrics
+        if self.cache_hit or metrics is None or metrics.cache_ratio() is None:
+            return
+        console.print(
+            f"prompt cache: {metrics.cached_tokens}/{metrics.prompt_tokens} tokens"
+            f" ({metrics.cache_ratio():.0%}),"
+            f" session {self.cached_tokens / self.prompt_tokens:.0%}",
+            style="dim green",
+        )
+
+    # 超出上下文的大文件: 分块并发提问, 合并各块的回答, 只记录最终的一问一答
+    def chat_chunked(
+        self,
+        ask: str,
+        file_path: Path,
+        console: Console,
+        chunk_tokens: int,
+        workers: int,
+    ) -> None:
+        from mapreduce import MapReduce
+
+        runner = MapReduce(
+            self.client,
+            self.model_id,
+            self.instruction,
+            chunk_tokens,
+            workers,
+            console,
+        )
+        console.print(
+            f"Splitting {file_path.name} into chunks of ~{chunk_tokens} tokens,"
+            f" {workers} worker(s)",
+            style="green",
+        )
+        partials = runner.map_file(file_path, ask)
+        partials = runner.reduce_until_fits(partials, file_path.name, ask)
+        self.dialog_count += 1
+        self.add_dialog("user", f"[file {file_path.name}]\n{ask}")
+        self.cache_hit = False
+        self.cache_key = ""
+        stream = self.open_stream(
+            runner.reduce_messages(partials, file_path.name, ask),
+        )
+        console.print(f"{self.model_id}:", style="bold")
+        answer = self.read_stream(console, stream)
+        console.print(self.end_marker(), style="yellow")
+        self.finish_answer(answer)
+
+    # 采纳其他来源(如compare)得到的一问一答
+    def adopt(self, ask: str, answer: str) -> None:
+        self.dialog_count += 1
+        self.add_dialog("user", ask)
         self.add_dialog("assistant", answer)
+        self.log.commit()
+        self.last_answer = answer
 
     def show_markdown(self, console: Console) -> None:
         if self.last_answer == "":
             console.print("No content to show", style="red")
             return
+        from rich.markdown import Markdown
+
         console.print("Markdown:\n", style="green")
         console.print(Markdown(self.last_answer))
 
@@ -146,24 +683,30 @@ class Agent:
         if self.dialog_count == 0:
             console.print("No dialog to retry", style="red")
             return
-        self.message.dialogs.pop()
-        self.log.retry()
-        stream = self.create_stream()
+        # retry本就是为了重新采样, 因此不读取缓存
+        stream = self.create_stream(self.begin_retry(), use_cache=False)
         console.print(f"{self.model_id}:", style="bold")
         answer = self.read_stream(console, stream)
-        console.print("\n--END--\n", style="yellow")
-        self.last_answer = answer
-        self.add_dialog("assistant", answer)
+        console.print(self.end_marker(), style="yellow")
+        self.finish_answer(answer)
+        self.show_prompt_cache(console)
 
     def undo(self, console: Console) -> None:
         if self.dialog_count == 0:
             console.print("No dialog to undo", style="red")
             return
-        self.message.dialogs.pop()
-        self.message.dialogs.pop()
+        self.message.pop_dialog()
+        self.message.pop_dialog()
         self.log.undo()
+        # 撤回到后台摘要的范围内时丢弃其结果
+        if (
+            self.summarizer is not None
+            and self.summarizer.busy()
+            and len(self.message) < self.summarizer.target
+        ):
+            self.summarizer.cancel()
         self.dialog_count -= 1
         if self.dialog_count > 0:
-            self.last_answer = self.message.dialogs[-1]["content"]
+            self.last_answer = self.message.get_dialog(-1)["content"]
         else:
             self.last_answer = ""
@@ -0,0 +1,215 @@
+import json
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from pathlib import Path
+
+from openai import APIConnectionError, APIStatusError, OpenAI, RateLimitError
+from rich.console import Console
+
+from environment import Environment
+from message import count_tokens
+
+
+# 一分钟滑动窗口内的请求数/token数限制, 0表示不限制
+class RateLimiter:
+    def __init__(self, rpm: int, tpm: int) -> None:
+        self.rpm = rpm
+        self.tpm = tpm
+        self.events: deque[tuple[float, int]] = deque()
+        self.tokens = 0
+        self.lock = threading.Lock()
+        # 收到429后所有线程一起暂停到该时间
+        self.pause_until = 0.0
+
+    def acquire(self, tokens: int) -> None:
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                while self.events and now - self.events[0][0] >= 60:  # noqa: PLR2004
+                    self.tokens -= self.events.popleft()[1]
+                wait_time = self.pause_until - now
+                if wait_time <= 0 and self.events:
+                    if self.rpm and len(self.events) >= self.rpm:
+                        wait_time = 60 - (now - self.events[0][0])
+                    elif self.tpm and self.tokens + tokens > self.tpm:
+                        wait_time = 60 - (now - self.events[0][0])
+                if wait_time <= 0:
+                    self.events.append((now, tokens))
+                    self.tokens += tokens
+                    return
+            time.sleep(min(wait_time, 1.0))
+
+    def pause(self, seconds: float) -> None:
+        with self.lock:
+            self.pause_until = max(self.pause_until, time.monotonic() + seconds)
+
+
+@dataclass
+class BatchJob:
+    index: int
+    id: str
+    prompt: str
+    file: str = ""
+
+
+# 非交互批量运行: 读入JSONL提问, 用有界线程池并发请求, 结果逐条追加到输出文件
+# 输出文件同时作为检查点, 重新运行时跳过已完成的id
+class BatchRunner:
+    max_attempts = 6
+
+    def __init__(
+        self,
+        env: Environment,
+        workers: int,
+        rpm: int,
+        tpm: int,
+        console: Console,
+    ) -> None:
+        self.env = env
+        self.workers = max(workers, 1)
+        self.limiter = RateLimiter(rpm, tpm)
+        self.console = console
+        # 429与5xx由这里统一退避重试, 关闭客户端自带的重试
+        self.client: OpenAI = env.get_client(
+            env.config.url,
+            env.config.api,
+        ).with_options(max_retries=0)
+        self.model_id = env.config.model_id
+        self.instruction = env.instr_dict[env.config.instr_key].content
+        self.write_lock = threading.Lock()
+
+    @staticmethod
+    def read_jobs(input_path: Path) -> list[BatchJob]:
+        jobs = []
+        with input_path.open("r", encoding="utf-8") as f:
+            for index, line in enumerate(f):
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if isinstance(record, str):
+                    record = {"prompt": record}
+                jobs.append(
+                    BatchJob(
+                        index,
+                        str(record.get("id", index)),
+                        record["prompt"],
+                        record.get("file", ""),
+                    ),
+                )
+        return jobs
+
+    @staticmethod
+    def read_done(output_path: Path) -> set[str]:
+        done = set()
+        if output_path.exists():
+            with output_path.open("r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # 崩溃时可能留下写了一半的行
+                        continue
+                    if "answer" in record:
+                        done.add(record["id"])
+        return done
+
+    def ask(self, job: BatchJob) -> dict:
+        content = job.prompt
+        if job.file:
+            try:
+                file_content = Path(job.file).read_text(encoding="utf-8")
+            except (OSError, UnicodeDecodeError) as e:
+                return {"id": job.id, "error": str(e)}
+            content = file_content + "\n" + content
+        messages = [
+            {"role": "system", "content": self.instruction},
+            {"role": "user", "content": content},
+        ]
+        estimate = count_tokens(self.instruction) + count_tokens(content)
+        for attempt in range(self.max_attempts):
+            self.limiter.acquire(estimate)
+            start = time.monotonic()
+            try:
+                response = self.client.chat.completions.create(
+                    model=self.model_id,
+                    messages=messages,
+                    temperature=1.0,
+                    top_p=1.0,
+                )
+            except RateLimitError as e:
+                self.limiter.pause(
+                    self.backoff(attempt, e.response.headers.get("retry-after")),
+                )
+                continue
+            except (APIStatusError, APIConnectionError) as e:
+                status = getattr(e, "status_code", None)
+                retryable = status is None or status >= 500  # noqa: PLR2004
+                if not retryable or attempt == self.max_attempts - 1:
+                    return {"id": job.id, "error": str(e)}
+                time.sleep(self.backoff(attempt, None))
+                continue
+            usage = response.usage
+            return {
+                "id": job.id,
+                "model_id": self.model_id,
+                "prompt": job.prompt,
+                "answer": response.choices[0].message.content,
+                "prompt_tokens": usage.prompt_tokens if usage else None,
+                "completion_tokens": usage.completion_tokens if usage else None,
+                "duration": round(time.monotonic() - start, 3),
+            }
+        return {"id": job.id, "error": "rate limited"}
+
+    # 指数退避加随机抖动, 服务端给出retry-after时优先使用
+    @staticmethod
+    def backoff(attempt: int, retry_after: str | None) -> float:
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        return min(2**attempt, 60) + random.random()  # noqa: S311
+
+    def write_result(self, output_path: Path, result: dict) -> None:
+        with self.write_lock, output_path.open("a", encoding="utf-8") as f:
+            f.write(json.dumps(result, ensure_ascii=False) + "\n")
+
+    def run(self, input_path: Path, output_path: Path) -> None:
+        done = self.read_done(output_path)
+        jobs = [job for job in self.read_jobs(input_path) if job.id not in done]
+        self.console.print(
+            f"{len(jobs)} prompt(s) to run, {len(done)} already done, "
+            f"model {self.model_id}, {self.workers} worker(s)",
+            style="green",
+        )
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        finished = failed = 0
+        start = time.monotonic()
+        pending_jobs = iter(jobs)
+        with ThreadPoolExecutor(self.workers) as pool:
+            # 同时在途的任务数不超过worker数的两倍, 避免一次性提交全部提问
+            running = set()
+            for job in pending_jobs:
+                running.add(pool.submit(self.ask, job))
+                if len(running) >= self.workers * 2:
+                    break
+            while running:
+                completed, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in completed:
+                    result = future.result()
+                    self.write_result(output_path, result)
+                    finished += 1
+                    failed += "error" in result
+                    next_job = next(pending_jobs, None)
+                    if next_job is not None:
+                        running.add(pool.submit(self.ask, next_job))
+                elapsed = time.monotonic() - start
+                self.console.print(
+                    f"[{finished}/{len(jobs)}] {failed} failed, "
+                    f"{finished / max(elapsed, 1e-9) * 60:.1f} prompts/min",
+                    style="dim green",
+                )
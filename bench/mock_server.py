@@ -0,0 +1,262 @@
+import argparse
+import json
+import threading
+import time
+from dataclasses import asdict, dataclass, fields
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# 模拟服务端的行为参数, 请求体中的 "mock" 字段可以逐项覆盖
+# (用openai客户端时通过 extra_body={"mock": {...}} 传入)
+@dataclass
+class MockOptions:
+    chunks: int = 200
+    chunk_size: int = 8
+    reasoning_chunks: int = 0
+    # 每秒发送的块数, 0为不限速
+    rate: float = 0.0
+    ttft: float = 0.0
+    # 发送第stall_after个块之前停顿stall_seconds秒, -1为不停顿
+    stall_after: int = -1
+    stall_seconds: float = 0.0
+    prompt_tokens: int = 100
+    cached_tokens: int = 0
+    # 回答内容为循环的Markdown样例(段落、列表与代码块), 而不是重复的x
+    markdown: bool = False
+    # 按消息估算prompt_tokens, 并把与之前请求相同的最长消息前缀计为cached_tokens
+    prefix_cache: bool = False
+
+
+MARKDOWN_SAMPLE = """## Step {n}
+
+This paragraph explains the step in a few sentences, with `inline code`,
+**bold text** and a [link](https://example.com) to keep the parser busy.
+
+- first point about the change
+- second point, a bit longer than the first one
+  with a continuation line
+
+```python
+def step_{n}(items: list[int]) -> int:
+    total = 0
+    for item in items:
+        total += item * {n}
+    return total
+```
+
+"""
+
+# 模拟前缀缓存时保留的最近请求数
+PREFIX_HISTORY = 16
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # 缓冲写入, 不限速时一次发出多个块
+    wbufsize = 1 << 16
+    options = MockOptions()
+    # 之前请求的消息序列(各条消息的JSON), 用于模拟前缀缓存
+    seen: list[list[str]]
+    seen_lock: threading.Lock
+
+    def log_message(self, format: str, *args: object) -> None:  # noqa: A002
+        pass
+
+    def send_json(self, body: dict) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        self.wfile.flush()
+
+    def send_event(self, body: dict | str) -> None:
+        payload = body if isinstance(body, str) else json.dumps(body)
+        data = f"data: {payload}\n\n".encode()
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+
+    def do_HEAD(self) -> None:
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+        self.wfile.flush()
+
+    def do_GET(self) -> None:
+        if self.path.rstrip("/").endswith("/models"):
+            models = [
+                {"id": f"mock-{i}", "object": "model", "created": 0, "owned_by": "mock"}
+                for i in range(4)
+            ]
+            self.send_json({"object": "list", "data": models})
+        else:
+            self.send_json({})
+
+    # 返回 (prompt_tokens, cached_tokens), 按每4个字符一个token估算
+    def prefix_usage(self, messages: list[dict]) -> tuple[int, int]:
+        keys = [json.dumps(message, ensure_ascii=False) for message in messages]
+        sizes = [len(key) // 4 + 1 for key in keys]
+        with self.seen_lock:
+            common = 0
+            for previous in self.seen:
+                n = 0
+                for a, b in zip(previous, keys):
+                    if a != b:
+                        break
+                    n += 1
+                common = max(common, n)
+            self.seen.append(keys)
+            del self.seen[:-PREFIX_HISTORY]
+        return sum(sizes), sum(sizes[:common])
+
+    def do_POST(self) -> None:
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length))
+        known = {f.name for f in fields(MockOptions)}
+        overrides = {
+            k: v for k, v in request.get("mock", {}).items() if k in known
+        }
+        options = MockOptions(**{**asdict(self.options), **overrides})
+        model = request.get("model", "mock")
+        if options.prefix_cache:
+            options.prompt_tokens, options.cached_tokens = self.prefix_usage(
+                request.get("messages", []),
+            )
+        usage = {
+            "prompt_tokens": options.prompt_tokens,
+            "completion_tokens": options.chunks + options.reasoning_chunks,
+            "total_tokens": options.prompt_tokens
+            + options.chunks
+            + options.reasoning_chunks,
+            "prompt_tokens_details": {"cached_tokens": options.cached_tokens},
+        }
+        text = "x" * (options.chunk_size - 1) + " "
+        size = options.chunk_size
+        document = ""
+        if options.markdown:
+            parts = []
+            length = 0
+            while length < size * options.chunks:
+                parts.append(MARKDOWN_SAMPLE.format(n=len(parts) + 1))
+                length += len(parts[-1])
+            document = "".join(parts)
+        if not request.get("stream"):
+            time.sleep(options.ttft)
+            self.send_json(
+                {
+                    "id": "mock",
+                    "object": "chat.completion",
+                    "created": 0,
+                    "model": model,
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {
+                                "role": "assistant",
+                                "content": text * options.chunks,
+                            },
+                            "finish_reason": "stop",
+                        },
+                    ],
+                    "usage": usage,
+                },
+            )
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        self.wfile.flush()
+        time.sleep(options.ttft)
+        interval = 1 / options.rate if options.rate > 0 else 0
+        total = options.reasoning_chunks + options.chunks
+        try:
+            for i in range(total):
+                if i == options.stall_after:
+                    self.wfile.flush()
+                    time.sleep(options.stall_seconds)
+                key = "reasoning_content" if i < options.reasoning_chunks else "content"
+                if document and key == "content":
+                    j = i - options.reasoning_chunks
+                    text = document[j * size : (j + 1) * size]
+                self.send_event(
+                    {
+                        "id": "mock",
+                        "object": "chat.completion.chunk",
+                        "created": 0,
+                        "model": model,
+                        "choices": [
+                            {"index": 0, "delta": {key: text}, "finish_reason": None},
+                        ],
+                    },
+                )
+                if interval:
+                    self.wfile.flush()
+                    time.sleep(interval)
+            if request.get("stream_options", {}).get("include_usage"):
+                self.send_event(
+                    {
+                        "id": "mock",
+                        "object": "chat.completion.chunk",
+                        "created": 0,
+                        "model": model,
+                        "choices": [],
+                        "usage": usage,
+                    },
+                )
+            self.send_event("[DONE]")
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端取消了请求
+            pass
+
+
+def start_server(
+    options: MockOptions | None = None,
+    host: str = "127.0.0.1",
+    port: int = 0,
+) -> ThreadingHTTPServer:
+    handler = type(
+        "Handler",
+        (MockHandler,),
+        {
+            "options": options or MockOptions(),
+            "seen": [],
+            "seen_lock": threading.Lock(),
+        },
+    )
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def server_url(server: ThreadingHTTPServer) -> str:
+    host, port = server.server_address[:2]
+    return f"http://{host}:{port}/v1"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="OpenAI-compatible streaming mock server",
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    for f in fields(MockOptions):
+        parser.add_argument(
+            f"--{f.name.replace('_', '-')}",
+            type=type(f.default),
+            default=f.default,
+        )
+    args = parser.parse_args()
+    mock_options = MockOptions(
+        **{f.name: getattr(args, f.name) for f in fields(MockOptions)},
+    )
+    mock_server = start_server(mock_options, args.host, args.port)
+    print(f"Mock server listening on {server_url(mock_server)}")  # noqa: T201
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        mock_server.shutdown()
@@ -0,0 +1,355 @@
+import argparse
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from collections.abc import Callable
+from datetime import datetime
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from rich.console import Console  # noqa: E402
+from rich.table import Table  # noqa: E402
+
+from environment import Environment  # noqa: E402
+from mock_server import MockOptions, server_url, start_server  # noqa: E402
+
+RESULTS_PATH = Path(__file__).resolve().parent / "results"
+
+
+# 每个场景在独立的临时目录中运行, 配置指向本地模拟服务端
+# backup_url: 提供同一模型的第二个服务商; extra: 追加到config.toml的配置
+def make_env(
+    url: str,
+    context_len: int = 100,
+    backup_url: str = "",
+    extra: str = "",
+) -> Environment:
+    api_text = f'[Mock]\napi = "mock"\nurl = "{url}"\nmodels = ["mock-0"]\n'
+    if backup_url:
+        api_text += (
+            f'[Backup]\napi = "mock"\nurl = "{backup_url}"\nmodels = ["mock-0"]\n'
+        )
+    Path("api_bin.toml").write_text(api_text, encoding="utf-8")
+    Path("instr_bin.toml").write_text('[empty]\ncontent = ""\n', encoding="utf-8")
+    Path("config.toml").write_text(
+        'provider = "Mock"\napi = "mock"\n'
+        f'url = "{url}"\nmodel_id = "mock-0"\ninstr_key = "empty"\n'
+        f"context_len = {context_len}\n{extra}",
+        encoding="utf-8",
+    )
+    return Environment(
+        Path("api_bin.toml"),
+        Path("instr_bin.toml"),
+        Path("config.toml"),
+    )
+
+
+def timed(func: Callable[[], object]) -> float:
+    start = time.perf_counter()
+    func()
+    return (time.perf_counter() - start) * 1000
+
+
+def write_long_save(env: Environment, turns: int, answer_size: int) -> Path:
+    agent = env.init_agent()
+    answer = "a" * answer_size
+    for i in range(turns):
+        agent.log.write_dialog("user", f"question {i}")
+        agent.log.write_dialog("assistant", answer)
+    env.writer.release(agent.log.save_path)
+    save_path = Path("saves") / "long.apai"
+    agent.log.save_path.replace(save_path)
+    return save_path
+
+
+def bench_long_save(url: str, turns: int) -> dict:
+    env = make_env(url, context_len=10)
+    write_ms = timed(lambda: write_long_save(env, turns, 400))
+    save_path = Path("saves") / "long.apai"
+    agent = None
+
+    def load() -> None:
+        nonlocal agent
+        agent = env.read_save(save_path)
+
+    load_ms = timed(load)
+    generate_ms = timed(lambda: agent.message.generate_messages(10))
+    token_ms = timed(lambda: agent.message.generate_messages(10, 32000))
+    env.close()
+    return {
+        "turns": turns,
+        "write_ms": round(write_ms, 2),
+        "load_ms": round(load_ms, 2),
+        "generate_ms": round(generate_ms, 3),
+        "token_window_ms": round(token_ms, 3),
+        "save_mb": round(save_path.stat().st_size / 1024 / 1024, 2),
+    }
+
+
+def bench_retry_undo(url: str, turns: int, cycles: int) -> dict:
+    env = make_env(url, context_len=10)
+    write_long_save(env, turns, 400)
+    agent = env.read_save(Path("saves") / "long.apai")
+    log = agent.log
+
+    def cycle() -> None:
+        for _ in range(cycles):
+            log.retry()
+            log.write_dialog("assistant", "retried answer")
+            log.undo()
+            log.write_dialog("user", "question again")
+            log.write_dialog("assistant", "answer again")
+        log.flush()
+
+    cycle_ms = timed(cycle)
+    env.close()
+    return {
+        "turns": turns,
+        "cycles": cycles,
+        "total_ms": round(cycle_ms, 2),
+        "per_cycle_ms": round(cycle_ms / cycles, 4),
+    }
+
+
+def bench_huge_file(url: str, size_mb: int) -> dict:
+    env = make_env(url)
+    agent = env.init_agent()
+    line = "file line with some text 文件内容\n"
+    content = line * (size_mb * 1024 * 1024 // len(line.encode()))
+    enqueue_ms = timed(lambda: agent.log.write_dialog("user", content))
+    message_ms = timed(lambda: agent.message.add_dialog("user", content))
+    flush_ms = timed(agent.log.flush)
+    env.close()
+    return {
+        "size_mb": round(len(content.encode()) / 1024 / 1024, 2),
+        "write_dialog_ms": round(enqueue_ms, 2),
+        "add_dialog_ms": round(message_ms, 2),
+        "flush_ms": round(flush_ms, 2),
+    }
+
+
+# 滑动窗口与分块丢弃窗口各聊turns轮, 比较模拟服务端报告的前缀缓存命中率
+def bench_prefix_cache(url: str, turns: int) -> dict:
+    results = {}
+    for block in (0, 50):
+        env = make_env(url, context_len=10, extra=f"window_block = {block}\n")
+        agent = env.init_agent()
+        console = Console(file=io.StringIO(), width=120)
+        for i in range(turns):
+            agent.chat(f"question {i} with window block {block}", "", console)
+        env.close()
+        ratio = agent.cached_tokens / agent.prompt_tokens if agent.prompt_tokens else 0
+        results[f"block{block}_hit"] = round(ratio, 3)
+        results[f"block{block}_prompt_tokens"] = agent.prompt_tokens
+    return results
+
+
+# 附加一个files个文件的目录两次, 第二次的文件都已在窗口中, 只发送引用
+def bench_file_tree(url: str, files: int) -> dict:
+    from files import expand_paths, read_files
+    from message import count_tokens
+
+    for i in range(files):
+        path = Path("tree") / f"pkg{i % 20}" / f"module{i}.py"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(f"# module {i}\n" + "def f():\n    return 1\n" * 100)
+    env = make_env(url)
+    agent = env.init_agent()
+    console = Console(file=io.StringIO(), width=120)
+    # 首个请求要创建客户端, 不计入
+    agent.chat("warm up", "", console)
+    inputs = []
+
+    def read() -> None:
+        nonlocal inputs
+        inputs = read_files(expand_paths(["tree/**/*.py"])[0], 1 << 20)
+
+    read_ms = timed(read)
+    first_ms = timed(lambda: agent.chat("review", "", console, inputs))
+    # 对话中保存的是完整内容, 按实际发送的提问计算
+    first_tokens = count_tokens(agent.current_messages()[-2]["content"])
+    again_ms = timed(lambda: agent.chat("again", "", console, inputs))
+    env.close()
+    return {
+        "files": files,
+        "read_ms": round(read_ms, 2),
+        "first_chat_ms": round(first_ms, 2),
+        "again_chat_ms": round(again_ms, 2),
+        "first_tokens": first_tokens,
+        "again_tokens": count_tokens(agent.current_messages()[-2]["content"]),
+        "referenced": agent.referenced_files,
+    }
+
+
+def bench_stream(url: str, name: str, extra: str = "") -> dict:
+    return stream_once(make_env(url, extra=extra), name)
+
+
+# 主服务商卡住, 超过期限后向备用服务商发出对冲请求
+def bench_hedge(url: str, name: str) -> dict:
+    backup = start_server(MockOptions(chunks=100))
+    env = make_env(
+        url,
+        backup_url=server_url(backup),
+        extra="ttft_timeout = 0.3\nstall_timeout = 0.3\n",
+    )
+    try:
+        return stream_once(env, name)
+    finally:
+        backup.shutdown()
+
+
+def stream_once(env: Environment, name: str) -> dict:
+    agent = env.init_agent()
+    agent.client  # noqa: B018
+    console = Console(file=io.StringIO(), force_terminal=True, width=120)
+    agent.message.add_dialog("user", "benchmark question")
+    start = time.perf_counter()
+    stream = agent.create_stream()
+    agent.read_stream(console, stream)
+    total_ms = (time.perf_counter() - start) * 1000
+    metrics = agent.turn_metrics
+    metrics.finish()
+    env.close()
+    first = min(
+        v for v in (metrics.first_reasoning, metrics.first_content) if v is not None
+    )
+    return {
+        "scenario": name,
+        "chunks": metrics.chunks,
+        "ttft_ms": round(first * 1000, 2),
+        "total_ms": round(total_ms, 2),
+        "chunks_per_second": round(metrics.chunks / (total_ms / 1000), 1),
+        "frames": agent.render_stats.get("frames", 0),
+        **{
+            key: agent.render_stats[key]
+            for key in ("blocks",)
+            if key in agent.render_stats
+        },
+        "provider": metrics.provider,
+    }
+
+
+def git_commit() -> str:
+    result = subprocess.run(
+        ["git", "rev-parse", "--short", "HEAD"],  # noqa: S607
+        capture_output=True,
+        text=True,
+        check=False,
+        cwd=ROOT,
+    )
+    return result.stdout.strip() or "unknown"
+
+
+def run_scenarios(names: list[str], quick: bool) -> dict:
+    turns = 1000 if quick else 10000
+    flood = MockOptions(chunks=5000 if quick else 20000, chunk_size=4)
+    reasoning = MockOptions(chunks=300, reasoning_chunks=300, rate=2000)
+    markdown = MockOptions(chunks=2000 if quick else 10000, markdown=True)
+    stall = MockOptions(chunks=100, ttft=0.2, stall_after=50, stall_seconds=0.5)
+    hung = MockOptions(chunks=100, ttft=3)
+    stalled = MockOptions(chunks=100, stall_after=20, stall_seconds=3)
+    prefix = MockOptions(chunks=50, prefix_cache=True)
+    scenarios: dict[str, Callable[[str], dict]] = {
+        "long_save": lambda url: bench_long_save(url, turns),
+        "retry_undo": lambda url: bench_retry_undo(url, turns, 200),
+        "huge_file": lambda url: bench_huge_file(url, 5 if quick else 50),
+        "file_tree": lambda url: bench_file_tree(url, 500 if quick else 5000),
+        "chunk_flood": lambda url: bench_stream(url, "chunk_flood"),
+        "reasoning_stream": lambda url: bench_stream(url, "reasoning_stream"),
+        "stall_stream": lambda url: bench_stream(url, "stall_stream"),
+        "markdown_stream": lambda url: bench_stream(
+            url,
+            "markdown_stream",
+            "live_markdown = true\n",
+        ),
+        "hedge_ttft": lambda url: bench_hedge(url, "hedge_ttft"),
+        "hedge_stall": lambda url: bench_hedge(url, "hedge_stall"),
+        "prefix_cache": lambda url: bench_prefix_cache(url, 40 if quick else 200),
+    }
+    server_options = {
+        "chunk_flood": flood,
+        "reasoning_stream": reasoning,
+        "stall_stream": stall,
+        "markdown_stream": markdown,
+        "hedge_ttft": hung,
+        "hedge_stall": stalled,
+        "prefix_cache": prefix,
+    }
+    results = {}
+    for name in names or scenarios:
+        server = start_server(server_options.get(name, MockOptions()))
+        cwd = Path.cwd()
+        with tempfile.TemporaryDirectory() as temp:
+            os.chdir(temp)
+            try:
+                results[name] = scenarios[name](server_url(server))
+            finally:
+                os.chdir(cwd)
+                server.shutdown()
+    return results
+
+
+# 与上一次保存的结果比较, 打印各项数值及变化比例
+def print_report(console: Console, results: dict, previous: dict | None) -> None:
+    table = Table(show_header=True, header_style="bold magenta")
+    table.add_column("Scenario")
+    table.add_column("Metric")
+    table.add_column("Value", justify="right")
+    table.add_column("Previous", justify="right")
+    table.add_column("Change", justify="right")
+    for name, metrics in results.items():
+        for key, value in metrics.items():
+            if not isinstance(value, (int, float)):
+                continue
+            old = (previous or {}).get("scenarios", {}).get(name, {}).get(key)
+            change = ""
+            if isinstance(old, (int, float)) and old:
+                change = f"{(value - old) / old * 100:+.1f}%"
+            old_text = "" if old is None else str(old)
+            table.add_row(name, key, str(value), old_text, change)
+    console.print(table)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="APaI benchmark suite")
+    parser.add_argument("scenarios", nargs="*", help="Scenarios to run (default all)")
+    parser.add_argument("--quick", action="store_true", help="Smaller workloads")
+    args = parser.parse_args()
+
+    console = Console()
+    results = run_scenarios(args.scenarios, args.quick)
+
+    RESULTS_PATH.mkdir(parents=True, exist_ok=True)
+    # 只和同样规模(是否--quick)的上一次结果比较
+    previous = None
+    for path in sorted(RESULTS_PATH.glob("*.json"), reverse=True):
+        record = json.loads(path.read_text(encoding="utf-8"))
+        if record.get("quick") == args.quick:
+            previous = record
+            break
+    print_report(console, results, previous)
+
+    commit = git_commit()
+    record = {
+        "commit": commit,
+        "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "quick": args.quick,
+        "scenarios": results,
+    }
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    output = RESULTS_PATH / f"{stamp}-{commit}.json"
+    output.write_text(json.dumps(record, indent=2), encoding="utf-8")
+    console.print(f"Results saved to {output}", style="green")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+import hashlib
+import json
+import sqlite3
+import time
+from pathlib import Path
+
+
+# 按内容寻址的回答缓存, 键为 (model_id, temperature, top_p, messages) 的哈希
+# 按最后访问时间做LRU淘汰, 同时限制总大小与最长保存时间
+class ResponseCache:
+    def __init__(
+        self,
+        path: Path = Path("cache") / "responses.sqlite",
+        max_mb: int = 100,
+        max_days: int = 30,
+    ) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.max_bytes = max_mb * 1024 * 1024
+        self.max_age = max_days * 86400
+        self.hits = 0
+        self.misses = 0
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, model_id TEXT, reasoning TEXT, content TEXT, "
+            "size INTEGER, created REAL, accessed REAL)",
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)",
+        )
+        self.db.commit()
+
+    @staticmethod
+    def make_key(
+        model_id: str,
+        temperature: float,
+        top_p: float,
+        messages: list,
+    ) -> str:
+        payload = json.dumps(
+            [model_id, temperature, top_p, messages],
+            ensure_ascii=False,
+            separators=(",", ":"),
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    # 命中时返回 (思考内容, 回答内容)
+    def get(self, key: str) -> tuple[str, str] | None:
+        row = self.db.execute(
+            "SELECT reasoning, content, accessed FROM responses WHERE key = ?",
+            (key,),
+        ).fetchone()
+        now = time.time()
+        if row is None or now - row[2] > self.max_age:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+        self.db.commit()
+        return row[0], row[1]
+
+    def put(self, key: str, model_id: str, reasoning: str, content: str) -> None:
+        now = time.time()
+        size = len(reasoning.encode()) + len(content.encode())
+        self.db.execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (key, model_id, reasoning, content, size, now, now),
+        )
+        self.evict(now)
+        self.db.commit()
+
+    def evict(self, now: float) -> None:
+        self.db.execute(
+            "DELETE FROM responses WHERE accessed < ?",
+            (now - self.max_age,),
+        )
+        total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses")
+        excess = total.fetchone()[0] - self.max_bytes
+        if excess <= 0:
+            return
+        # 从最久未访问的开始删除, 直到总大小回到上限以内
+        keys = []
+        for key, size in self.db.execute(
+            "SELECT key, size FROM responses ORDER BY accessed",
+        ):
+            keys.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        self.db.executemany("DELETE FROM responses WHERE key = ?", keys)
+
+    def stats(self) -> dict:
+        entries, size = self.db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses",
+        ).fetchone()
+        return {
+            "entries": entries,
+            "size_mb": round(size / 1024 / 1024, 2),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def clear(self) -> None:
+        self.db.execute("DELETE FROM responses")
+        self.db.commit()
+        self.db.execute("VACUUM")
+
+    def close(self) -> None:
+        self.db.close()
@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+import json
+import os
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from concurrent.futures import Future
+
+    from openai import OpenAI
+
+CATALOG_PATH = Path("cache") / "models.json"
+FETCH_TIMEOUT = 10
+
+
+# 各服务商 /models 接口返回的模型列表, 缓存在磁盘上, 超过ttl后在后台刷新
+class ModelCatalog:
+    def __init__(self, ttl_hours: int = 24, path: Path = CATALOG_PATH) -> None:
+        self.path = path
+        self.ttl = ttl_hours * 3600
+        self.fetched = 0.0
+        self.providers: dict[str, list[str]] = {}
+        self.errors: dict[str, str] = {}
+        if path.exists():
+            try:
+                with path.open("r", encoding="utf-8") as f:
+                    data = json.load(f)
+                self.fetched = data["fetched"]
+                self.providers = data["providers"]
+            except (OSError, ValueError, KeyError):
+                pass
+
+    def stale(self) -> bool:
+        return time.time() - self.fetched > self.ttl
+
+    def save(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = self.path.with_suffix(".tmp")
+        with temp_path.open("w", encoding="utf-8") as f:
+            json.dump({"fetched": self.fetched, "providers": self.providers}, f)
+        os.replace(temp_path, self.path)
+
+    @staticmethod
+    def fetch(client: Future[OpenAI]) -> list[str]:
+        page = client.result().with_options(timeout=FETCH_TIMEOUT).models.list()
+        return sorted(model.id for model in page.data)
+
+    # 并行请求各服务商的模型列表; 失败的服务商保留上一次的结果
+    def refresh(self, clients: dict[str, Future[OpenAI]]) -> dict[str, list[str]]:
+        from concurrent.futures import ThreadPoolExecutor
+
+        from openai import OpenAIError
+
+        providers = dict(self.providers)
+        errors = {}
+        with ThreadPoolExecutor(max(len(clients), 1)) as pool:
+            futures = {
+                provider: pool.submit(self.fetch, client)
+                for provider, client in clients.items()
+            }
+            for provider, future in futures.items():
+                try:
+                    providers[provider] = future.result()
+                except (OpenAIError, OSError) as e:
+                    errors[provider] = str(e)
+        self.providers = providers
+        self.errors = errors
+        self.fetched = time.time()
+        self.save()
+        return providers
@@ -0,0 +1,159 @@
+import asyncio
+import time
+from dataclasses import dataclass, field
+
+from openai import AsyncOpenAI
+from rich.columns import Columns
+from rich.console import Console
+from rich.live import Live
+from rich.panel import Panel
+from rich.text import Text
+
+from message import count_tokens
+
+
+@dataclass
+class CompareTarget:
+    provider: str
+    api: str
+    url: str
+    model_id: str
+
+
+@dataclass
+class CompareResult:
+    target: CompareTarget
+    content: list[str] = field(default_factory=list)
+    reasoning: list[str] = field(default_factory=list)
+    start: float = 0.0
+    first_token: float | None = None
+    end: float | None = None
+    error: str = ""
+
+    @property
+    def answer(self) -> str:
+        return "".join(self.content)
+
+    def stats_to_string(self) -> str:
+        if self.error:
+            return "failed"
+        if self.first_token is None:
+            return f"waiting {time.monotonic() - self.start:.1f}s"
+        end = self.end if self.end is not None else time.monotonic()
+        tokens = count_tokens(self.answer + "".join(self.reasoning))
+        speed = tokens / max(end - self.first_token, 1e-9)
+        return (
+            f"ttft {self.first_token - self.start:.2f}s"
+            f"  total {end - self.start:.1f}s  {speed:.0f} tok/s"
+        )
+
+
+async def stream_one(
+    client: AsyncOpenAI,
+    result: CompareResult,
+    messages: list,
+) -> None:
+    result.start = time.monotonic()
+    try:
+        stream = await client.chat.completions.create(
+            model=result.target.model_id,
+            messages=messages,
+            stream=True,
+            temperature=1.0,
+            top_p=1.0,
+        )
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            reasoning = getattr(delta, "reasoning_content", None)
+            if reasoning or delta.content:
+                if result.first_token is None:
+                    result.first_token = time.monotonic()
+                if reasoning:
+                    result.reasoning.append(reasoning)
+                else:
+                    result.content.append(delta.content)
+    except Exception as e:  # noqa: BLE001
+        result.error = str(e)
+    result.end = time.monotonic()
+
+
+# 流式过程中每个面板只显示回答末尾能放下的部分
+def render_live(results: list[CompareResult], console: Console) -> Columns:
+    width = max(console.width // len(results) - 4, 10)
+    max_chars = width * max(console.height - 6, 4)
+    panels = []
+    for result in results:
+        text = Text()
+        if not result.content and result.reasoning:
+            text.append("".join(result.reasoning)[-max_chars:], style="dim magenta")
+        else:
+            text.append(result.answer[-max_chars:], style="cyan")
+        if result.error:
+            text.append(result.error, style="red")
+        panels.append(
+            Panel(
+                text,
+                title=result.target.model_id,
+                subtitle=result.stats_to_string(),
+                width=width + 4,
+            ),
+        )
+    return Columns(panels)
+
+
+async def compare_async(
+    targets: list[CompareTarget],
+    messages: list,
+    console: Console,
+) -> list[CompareResult]:
+    clients = {
+        (target.url, target.api): AsyncOpenAI(
+            api_key=target.api,
+            base_url=target.url,
+            timeout=1800,
+        )
+        for target in targets
+    }
+    results = [CompareResult(target) for target in targets]
+    try:
+        tasks = [
+            asyncio.create_task(
+                stream_one(clients[(r.target.url, r.target.api)], r, messages),
+            )
+            for r in results
+        ]
+        with Live(
+            render_live(results, console),
+            console=console,
+            transient=True,
+        ) as live:
+            while not all(task.done() for task in tasks):
+                live.update(render_live(results, console))
+                await asyncio.sleep(0.1)
+        await asyncio.gather(*tasks)
+    finally:
+        for client in clients.values():
+            await client.close()
+    return results
+
+
+# 把同一份消息同时发给多个模型, 总耗时取决于最慢的模型
+def compare(
+    targets: list[CompareTarget],
+    messages: list,
+    console: Console,
+) -> list[CompareResult]:
+    results = asyncio.run(compare_async(targets, messages, console))
+    for i, result in enumerate(results, 1):
+        console.print(
+            Panel(
+                Text(result.error, style="red")
+                if result.error
+                else Text(result.answer, style="cyan"),
+                title=f"[{i}] {result.target.model_id} ({result.target.provider})",
+                subtitle=result.stats_to_string(),
+            ),
+        )
+    return results
@@ -1,12 +1,43 @@
-import difflib
-from dataclasses import asdict, dataclass
-from pathlib import Path
+from __future__ import annotations
 
-import tomli_w
+import contextlib
 import tomllib
-from openai import OpenAI
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING
 
 from agent import Agent
+from fuzzy import FuzzyIndex
+from hedge import Route
+from log import Log
+from metrics import MetricsStore
+from save import is_v1, migrate_v1, read_header
+from segments import LogStore
+from writer import LogWriter
+
+# openai, tomli_w, difflib, sqlite3 等较慢的模块在第一次用到时才导入
+if TYPE_CHECKING:
+    from openai import OpenAI
+
+    from cache import ResponseCache
+    from catalog import ModelCatalog
+    from search import SearchIndex
+    from summary import Summarizer
+
+
+# 空闲连接的保活时间(秒), 切换指令或上下文长度后可以直接复用连接
+KEEPALIVE_EXPIRY = 300
+# 预热请求的超时(秒), 服务商不可达时不拖慢退出
+WARM_TIMEOUT = 5
+
+
+# 连接池上限; openai使用的HTTP库随版本而变(如httpx2), 取其默认上限的类型,
+# 不直接依赖该库
+def connection_limits(**limits: float) -> object:
+    from openai._constants import DEFAULT_CONNECTION_LIMITS
+
+    return type(DEFAULT_CONNECTION_LIMITS)(**limits)
 
 
 @dataclass
@@ -29,6 +60,43 @@ class Config:
     model_id: str
     instr_key: str
     context_len: int
+    context_tokens: int = 0
+    log_durability: str = "turn"
+    log_flush_ms: int = 1000
+    # 日志分段的最大大小与最长跨度(天, 0为不按日期切分)
+    log_segment_mb: int = 4
+    log_segment_days: int = 1
+    # 自动清理: 只保留最近若干天/总大小不超过若干MB的日志, 0为不限制
+    log_keep_days: int = 0
+    log_keep_mb: int = 0
+    cache: bool = False
+    cache_max_mb: int = 100
+    cache_max_days: int = 30
+    stream_usage: bool = True
+    live_markdown: bool = False
+    window_block: int = 0
+    # 创建Agent时在后台预先建立连接; warm_probe为True时改用 /models 请求, 同时校验密钥
+    warm_up: bool = True
+    warm_probe: bool = False
+    # 首个token/两个块之间超过该秒数时, 向提供同一模型的其他服务商发出对冲请求, 0为不启用
+    ttft_timeout: float = 30
+    stall_timeout: float = 30
+    serve_host: str = "127.0.0.1"
+    serve_port: int = 8765
+    serve_idle_minutes: float = 10
+    # 用于压缩过期上下文的模型, 为空时不做摘要
+    summary_model: str = ""
+    # 大于0时, 早于该轮数的问答即使仍在窗口内也会被摘要
+    summary_age: int = 0
+    # 写入对话时同步更新全文搜索索引
+    search_index: bool = True
+    # 超出该token数的文件分块提问, 以及并发的请求数
+    file_chunk_tokens: int = 32000
+    file_workers: int = 8
+    file_max_kb: int = 1024
+    # 启动时在后台获取各服务商的 /models 列表, 缓存models_ttl_hours小时
+    discover_models: bool = False
+    models_ttl_hours: int = 24
 
 
 class Environment:
@@ -40,114 +108,329 @@ class Environment:
         with config_path.open("rb") as f:
             self.config = Config(**tomllib.load(f))
         self.config_path = config_path
-        self.model_id_list = [
+        self.configured_models = [
             name for api in self.api_dict.values() for name in api.models
         ]
+        self.model_id_list = list(self.configured_models)
         self.instr_key_list = list(self.instr_dict.keys())
+        self.model_index = FuzzyIndex(self.model_id_list)
+        self.instr_index = FuzzyIndex(self.instr_key_list)
+        # 从 /models 接口发现的模型, 按服务商分组
+        self.discovered: dict[str, list[str]] = {}
+        self.catalog: ModelCatalog | None = None
+        self.catalog_future: Future | None = None
+        self.writer = LogWriter(self.config.log_durability, self.config.log_flush_ms)
+        self.log_stores: dict[str, LogStore] = {}
+        # 按 (url, api) 复用的客户端, 不同Agent之间共享连接池
+        # 客户端在后台线程中创建, 不阻塞启动与用户输入
+        self.clients: dict[tuple[str, str], Future[OpenAI]] = {}
+        self.executor = ThreadPoolExecutor(thread_name_prefix="client")
+        self.metrics = MetricsStore(self.writer)
+        self.cache: ResponseCache | None = None
+        if self.config.cache:
+            self.open_cache()
+        self.search: SearchIndex | None = None
+        if self.config.search_index:
+            self.open_search()
+        if self.config.discover_models:
+            self.open_catalog()
 
     def match_model_id(self, model_id: str) -> str:
-        match_list = difflib.get_close_matches(
-            model_id,
-            self.model_id_list,
-            cutoff=0.2,
-        )
-        if match_list:
-            return match_list[0]
-        return ""
+        return self.model_index.match(model_id)
 
     def match_instr_key(self, instr_key: str) -> str:
-        match_list = difflib.get_close_matches(
-            instr_key,
-            self.instr_key_list,
-            cutoff=0.2,
+        return self.instr_index.match(instr_key)
+
+    # 先用磁盘上的缓存, 过期时在后台刷新, 不等待网络
+    def open_catalog(self) -> ModelCatalog:
+        if self.catalog is None:
+            from catalog import ModelCatalog
+
+            self.catalog = ModelCatalog(self.config.models_ttl_hours)
+            self.apply_catalog(self.catalog.providers)
+            if self.catalog.stale():
+                self.refresh_catalog()
+        return self.catalog
+
+    def refresh_catalog(self) -> Future:
+        catalog = self.open_catalog()
+        if self.catalog_future is not None and not self.catalog_future.done():
+            return self.catalog_future
+        # 客户端先于刷新任务提交, 刷新任务等待它们时不会占满线程池
+        clients = {
+            provider: self.client_future(api.url, api.api)
+            for provider, api in self.api_dict.items()
+        }
+        self.catalog_future = self.executor.submit(catalog.refresh, clients)
+        self.catalog_future.add_done_callback(self.catalog_refreshed)
+        return self.catalog_future
+
+    def catalog_refreshed(self, future: Future[dict[str, list[str]]]) -> None:
+        if not future.cancelled() and future.exception() is None:
+            self.apply_catalog(future.result())
+
+    # 在后台线程中调用时整体替换列表与索引, 不修改正在使用的对象
+    def apply_catalog(self, providers: dict[str, list[str]]) -> None:
+        self.discovered = {
+            provider: models
+            for provider, models in providers.items()
+            if provider in self.api_dict
+        }
+        model_id_list = list(
+            dict.fromkeys(
+                self.configured_models
+                + [name for models in self.discovered.values() for name in models],
+            ),
         )
-        if match_list:
-            return match_list[0]
-        return ""
+        self.model_index = FuzzyIndex(model_id_list)
+        self.model_id_list = model_id_list
 
     def save_config(self) -> None:
+        import tomli_w
+
         with self.config_path.open("wb") as f:
             tomli_w.dump(asdict(self.config), f)
 
     # 修改配置:
     # 1. 修改config
     # 2. 保存config
-    # 3. 重建Agent对象(Log Message OpenAI)
-
-    def change_model(self, model_id: str) -> bool:
-        if model_id:
-            for provider, api in self.api_dict.items():
-                if model_id in api.models:
-                    self.config.provider = provider
-                    self.config.api = api.api
-                    self.config.url = api.url
-                    self.config.model_id = model_id
-                    self.save_config()
-                    return True
-        return False
+    # 3. 重建Agent对象(Log Message), OpenAI客户端从连接池复用
 
-    def change_instr_key(self, instr_key: str) -> bool:
+    def find_api(self, model_id: str) -> tuple[str, Api] | None:
+        found = self.find_apis(model_id)
+        return found[0] if found else None
+
+    # 提供该模型的全部服务商, 配置文件中列出的在前
+    def find_apis(self, model_id: str) -> list[tuple[str, Api]]:
+        if not model_id:
+            return []
+        found = [
+            (provider, api)
+            for provider, api in self.api_dict.items()
+            if model_id in api.models
+        ]
+        for provider, models in self.discovered.items():
+            if model_id in models and all(provider != p for p, _ in found):
+                found.append((provider, self.api_dict[provider]))
+        return found
+
+    # persist为False时只修改本次运行的配置, 不写回config.toml
+    def change_model(self, model_id: str, *, persist: bool = True) -> bool:
+        found = self.find_api(model_id)
+        if found is None:
+            return False
+        provider, api = found
+        self.config.provider = provider
+        self.config.api = api.api
+        self.config.url = api.url
+        self.config.model_id = model_id
+        if persist:
+            self.save_config()
+        return True
+
+    def change_instr_key(self, instr_key: str, *, persist: bool = True) -> bool:
         if instr_key:
             self.config.instr_key = instr_key
-            self.save_config()
+            if persist:
+                self.save_config()
             return True
         return False
 
     def change_context_len(self, context_len: int) -> None:
         self.config.context_len = context_len
+        self.config.context_tokens = 0
         self.save_config()
 
-    def init_agent(self) -> Agent:
-        return Agent(
-            OpenAI(
-                api_key=self.config.api,
-                base_url=self.config.url,
-                timeout=1800,
+    def change_context_tokens(self, context_tokens: int) -> None:
+        self.config.context_tokens = context_tokens
+        self.save_config()
+
+    def open_cache(self) -> ResponseCache:
+        if self.cache is None:
+            from cache import ResponseCache
+
+            self.cache = ResponseCache(
+                max_mb=self.config.cache_max_mb,
+                max_days=self.config.cache_max_days,
+            )
+        return self.cache
+
+    # 只创建对象, 数据库在第一次写入或查询时才连接
+    def open_search(self) -> SearchIndex:
+        if self.search is None:
+            from search import SearchIndex
+
+            self.search = SearchIndex()
+        return self.search
+
+    def change_cache(self, enabled: bool) -> None:
+        self.config.cache = enabled
+        self.save_config()
+
+    def change_live_markdown(self, enabled: bool) -> None:
+        self.config.live_markdown = enabled
+        self.save_config()
+
+    @staticmethod
+    def create_client(url: str, api: str) -> OpenAI:
+        from openai import DefaultHttpxClient, OpenAI
+
+        return OpenAI(
+            api_key=api,
+            base_url=url,
+            timeout=1800,
+            http_client=DefaultHttpxClient(
+                limits=connection_limits(
+                    max_connections=100,
+                    max_keepalive_connections=20,
+                    keepalive_expiry=KEEPALIVE_EXPIRY,
+                ),
             ),
-            self.config.provider,
+        )
+
+    def client_future(self, url: str, api: str) -> Future[OpenAI]:
+        future = self.clients.get((url, api))
+        if future is None:
+            future = self.executor.submit(self.create_client, url, api)
+            self.clients[(url, api)] = future
+        return future
+
+    def get_client(self, url: str, api: str) -> OpenAI:
+        return self.client_future(url, api).result()
+
+    # 用户输入问题的同时完成DNS、TCP与TLS握手, 连接留在连接池中供第一次提问复用
+    def warm_up(self, url: str, api: str) -> Future[None]:
+        return self.executor.submit(
+            self.warm_connection,
+            self.client_future(url, api),
+            probe=self.config.warm_probe,
+        )
+
+    @staticmethod
+    def warm_connection(client_future: Future[OpenAI], *, probe: bool) -> None:
+        from openai import OpenAIError
+
+        client = client_future.result().with_options(
+            max_retries=0,
+            timeout=WARM_TIMEOUT,
+        )
+        # 只需要建立连接, 返回404等错误状态也不影响; 按bytes读取响应,
+        # 不解析内容, 也不依赖openai所用HTTP库的响应类
+        with contextlib.suppress(OpenAIError):
+            if probe:
+                client.models.list()
+            else:
+                client.get("", cast_to=bytes)
+
+    def create_summarizer(self) -> Summarizer | None:
+        found = self.find_api(self.config.summary_model)
+        if found is None:
+            return None
+        from summary import Summarizer
+
+        api = found[1]
+        return Summarizer(
+            self.client_future(api.url, api.api),
+            self.config.summary_model,
+        )
+
+    # 同一模型的Agent共用一个LogStore, 保证分段与manifest一致
+    def log_store(self, model_id: str) -> LogStore:
+        store = self.log_stores.get(model_id)
+        if store is None:
+            store = LogStore(
+                Path("logs") / model_id,
+                self.config.log_segment_mb,
+                self.config.log_segment_days,
+                self.config.log_keep_mb,
+                self.config.log_keep_days,
+            )
+            self.log_stores[model_id] = store
+        return store
+
+    def init_agent(self) -> Agent:
+        return self.create_agent(
             self.config.model_id,
-            (
-                self.config.instr_key,
-                self.instr_dict[self.config.instr_key].content,
-            ),
+            self.config.instr_key,
             self.config.context_len,
+            self.config.context_tokens,
+            provider=self.config.provider,
         )
 
+    # 服务模式下每个会话有各自的模型、指令、上下文与存档, 不修改config
+    def create_agent(
+        self,
+        model_id: str,
+        instr_key: str,
+        context_len: int,
+        context_tokens: int = 0,
+        *,
+        provider: str = "",
+        save_path: Path = Log.autosave_path,
+        warm_up: bool = True,
+    ) -> Agent:
+        if provider not in self.api_dict:
+            provider = self.find_api(model_id)[0]
+        api = self.api_dict[provider]
+        self.writer.flush()
+        if warm_up and self.config.warm_up:
+            self.warm_up(api.url, api.api)
+        return Agent(
+            self.client_future(api.url, api.api),
+            provider,
+            model_id,
+            (instr_key, self.instr_dict[instr_key].content),
+            context_len,
+            context_tokens,
+            self.writer,
+            self.log_store(model_id),
+            self.cache if self.config.cache else None,
+            self.metrics,
+            stream_usage=self.config.stream_usage,
+            live_markdown=self.config.live_markdown,
+            window_block=self.config.window_block,
+            summarizer=self.create_summarizer(),
+            summary_age=self.config.summary_age,
+            search=self.search,
+            backups=[
+                Route(other, self.client_future(other_api.url, other_api.api))
+                for other, other_api in self.find_apis(model_id)
+                if other != provider
+            ],
+            ttft_timeout=self.config.ttft_timeout,
+            stall_timeout=self.config.stall_timeout,
+            save_path=save_path,
+        )
+
+    def close(self) -> None:
+        for future in self.clients.values():
+            if future.exception() is None:
+                future.result().close()
+        self.clients.clear()
+        # 不等待后台的客户端创建与模型列表刷新, 未开始的任务直接取消
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        if self.cache is not None:
+            self.cache.close()
+        self.writer.close()
+        if self.search is not None:
+            self.search.close()
+
     def config_to_string(self) -> str:
         return (
             f"model: {self.config.model_id}\n"
             f"instruction: {self.config.instr_key}\n"
             f"context length: {self.config.context_len}\n"
+            f"context tokens: {self.config.context_tokens}\n"
         )
 
     # 保证存档文件存在
     def read_save(self, save_path: Path) -> Agent:
-        dialogs = []
-        with save_path.open("r", encoding="utf-8") as f:
-            model_id, instr_key = f.readline().split(", ")
-            model_id = model_id.strip()
-            instr_key = instr_key.strip()
-            f.readline()
-            while True:
-                role = f.readline().strip()
-                if not role:
-                    break
-                lines = []
-                while True:
-                    line = f.readline()
-                    if line.strip() == "===APaI===":
-                        break
-                    lines.append(line)
-                dialogs.append(
-                    {
-                        "role": role,
-                        "content": "".join(lines).strip(),
-                    },
-                )
-        self.change_model(model_id)
-        self.change_instr_key(instr_key)
+        self.writer.release(save_path)
+        if is_v1(save_path):
+            migrate_v1(save_path)
+        header = read_header(save_path)
+        self.change_model(header["model_id"])
+        self.change_instr_key(header["instr_key"])
         agent = self.init_agent()
-        agent.message.dialogs = dialogs
-        agent.dialog_count = len(dialogs) // 2
-        agent.change_log(save_path)
+        agent.attach_save(save_path)
         return agent
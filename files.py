@@ -0,0 +1,163 @@
+from __future__ import annotations
+
+import codecs
+import glob
+import hashlib
+import os
+import re
+import subprocess
+import sys
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+
+READ_BLOCK = 1 << 16
+# 内容哈希取前16位十六进制, 足以区分上下文中的文件
+DIGEST_LENGTH = 16
+GLOB_CHARS = re.compile(r"[*?[]")
+# 文件块的首行; chars为其后文件内容的字符数, 据此跳过内容找到</file>
+FILE_HEADER = re.compile(
+    rf'^<file path="(?P<path>[^"\n]*)"'
+    rf' sha256="(?P<digest>[0-9a-f]{{{DIGEST_LENGTH}}})"'
+    r' chars="(?P<chars>\d+)">\n',
+    re.MULTILINE,
+)
+FILE_END = "</file>"
+REFERENCE_NOTE = "unchanged, same as the earlier file with this sha256"
+
+
+# 读取的文件; 跳过的文件text为空, skipped为原因
+@dataclass
+class FileInput:
+    path: Path
+    size: int
+    text: str = ""
+    digest: str = ""
+    skipped: str = ""
+
+
+# 展开路径与通配符(支持**), 目录展开为其下的全部文件; 返回 (文件, 没有匹配的参数)
+def expand_paths(patterns: Iterable[str]) -> tuple[list[Path], list[str]]:
+    paths: dict[Path, None] = {}
+    missing = []
+    for pattern in patterns:
+        if Path(pattern).is_dir():
+            query = str(Path(glob.escape(pattern)) / "**" / "*")
+        elif GLOB_CHARS.search(pattern):
+            query = pattern
+        else:
+            query = ""
+        if query:
+            matches = sorted(glob.glob(query, recursive=True))  # noqa: PTH207
+        else:
+            matches = [pattern]
+        files = [Path(match) for match in matches if Path(match).is_file()]
+        if not files:
+            missing.append(pattern)
+        for path in files:
+            paths.setdefault(path, None)
+    return list(paths), missing
+
+
+# 按块读取并增量解码, 同时计算哈希; 含NUL或不是UTF-8的文件视为二进制文件跳过
+def read_file(path: Path, max_bytes: int) -> FileInput:
+    try:
+        size = path.stat().st_size
+        if size > max_bytes:
+            return FileInput(path, size, skipped=f"larger than {max_bytes // 1024} KB")
+        decoder = codecs.getincrementaldecoder("utf-8-sig")()
+        digest = hashlib.sha256()
+        parts = []
+        with path.open("rb") as f:
+            while block := f.read(READ_BLOCK):
+                if b"\0" in block:
+                    return FileInput(path, size, skipped="binary")
+                digest.update(block)
+                parts.append(decoder.decode(block))
+        parts.append(decoder.decode(b"", final=True))
+    except UnicodeDecodeError:
+        return FileInput(path, size, skipped="not UTF-8")
+    except OSError as e:
+        return FileInput(path, 0, skipped=e.strerror or str(e))
+    return FileInput(path, size, "".join(parts), digest.hexdigest()[:DIGEST_LENGTH])
+
+
+def read_files(paths: list[Path], max_bytes: int) -> list[FileInput]:
+    from concurrent.futures import ThreadPoolExecutor
+
+    if len(paths) <= 1:
+        return [read_file(path, max_bytes) for path in paths]
+    with ThreadPoolExecutor() as pool:
+        return list(pool.map(lambda path: read_file(path, max_bytes), paths))
+
+
+# 文件以 <file path= sha256= chars=> 块保存在对话中, 总是包含完整内容
+def format_files(files: list[FileInput]) -> str:
+    blocks = []
+    for file in files:
+        if file.skipped:
+            continue
+        path = file.path.as_posix().replace('"', "&quot;")
+        text = file.text if file.text.endswith("\n") else file.text + "\n"
+        blocks.append(
+            f'<file path="{path}" sha256="{file.digest}" chars="{len(text)}">\n'
+            f"{text}{FILE_END}",
+        )
+    return "\n".join(blocks)
+
+
+def reference_line(path: str, digest: str) -> str:
+    return f'<file path="{path}" sha256="{digest}" note="{REFERENCE_NOTE}"/>'
+
+
+# 发送前处理: 同一内容的文件在这批消息中只保留最早的一份完整内容, 之后的改为引用
+# 窗口滑过最早的一份后, 下一份就成为完整的, 引用总能在同一请求中找到原文
+def reference_files(messages: list[dict]) -> list[dict]:
+    seen: set[str] = set()
+    result = []
+    for message in messages:
+        content = message["content"]
+        if "<file path=" not in content:
+            result.append(message)
+            continue
+        parts = []
+        pos = 0
+        while match := FILE_HEADER.search(content, pos):
+            end = match.end() + int(match["chars"])
+            if not content.startswith(FILE_END, end):
+                # 不是完整的文件块(如文件内容中引用了首行)
+                parts.append(content[pos : match.end()])
+                pos = match.end()
+                continue
+            end += len(FILE_END)
+            if match["digest"] in seen:
+                parts.append(content[pos : match.start()])
+                parts.append(reference_line(match["path"], match["digest"]))
+            else:
+                seen.add(match["digest"])
+                parts.append(content[pos:end])
+            pos = end
+        parts.append(content[pos:])
+        result.append({**message, "content": "".join(parts)})
+    return result
+
+
+# 用系统默认程序打开文件; 没有可用的程序时返回False
+def open_path(path: Path) -> bool:
+    try:
+        if sys.platform == "win32":
+            os.startfile(path)  # noqa: S606
+        elif sys.platform == "darwin":
+            subprocess.Popen(["open", str(path)])  # noqa: S603, S607
+        else:
+            subprocess.Popen(  # noqa: S603
+                ["xdg-open", str(path)],  # noqa: S607
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+    except OSError:
+        return False
+    return True
@@ -0,0 +1,87 @@
+from bisect import bisect_left
+from collections import Counter
+from difflib import SequenceMatcher, get_close_matches
+
+RERANK = 20
+
+
+def ngrams(text: str, n: int = 3) -> list[str]:
+    text = f" {text.lower()} "
+    return [text[i : i + n] for i in range(max(len(text) - n + 1, 1))]
+
+
+# 预先建好的三元组倒排索引, 用于在大量模型名/指令名中做模糊匹配与前缀补全
+# 相似度为Dice系数, 完全相同、前缀与子串匹配额外加分
+class FuzzyIndex:
+    def __init__(self, names: list[str]) -> None:
+        self.names = list(dict.fromkeys(names))
+        self.lowered = [name.lower() for name in self.names]
+        self.sizes = []
+        self.postings: dict[str, list[int]] = {}
+        for i, name in enumerate(self.lowered):
+            grams = set(ngrams(name))
+            self.sizes.append(len(grams))
+            for gram in grams:
+                self.postings.setdefault(gram, []).append(i)
+        # 按小写名排序的下标, 用于前缀补全
+        self.sorted = sorted(range(len(self.names)), key=lambda i: self.lowered[i])
+        self.sorted_keys = [self.lowered[i] for i in self.sorted]
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def scores(self, query: str) -> list[tuple[float, int]]:
+        query = query.lower()
+        grams = set(ngrams(query))
+        common: Counter[int] = Counter()
+        for gram in grams:
+            common.update(self.postings.get(gram, ()))
+        results = []
+        for i, count in common.items():
+            score = 2 * count / (len(grams) + self.sizes[i])
+            name = self.lowered[i]
+            if name == query:
+                score += 3
+            elif name.startswith(query):
+                score += 1
+            elif query in name:
+                score += 0.5
+            results.append((score, i))
+        results.sort(key=lambda r: -r[0])
+        # 得分相同的候选(如mock-1与mock-2)再按编辑相似度排序, 只处理前几名
+        head = results[:RERANK]
+        head.sort(
+            key=lambda r: (
+                -r[0],
+                -SequenceMatcher(None, query, self.lowered[r[1]]).ratio(),
+                len(self.names[r[1]]),
+            ),
+        )
+        return head + results[RERANK:]
+
+    # 返回最相近的名字, 没有达到cutoff时返回空字符串
+    # 太短或缩写的输入(如o、dsk)与名字没有共同的三元组, 退回逐个比较的difflib
+    def match(self, query: str, cutoff: float = 0.2) -> str:
+        if not query:
+            return ""
+        results = self.scores(query)
+        if results and results[0][0] >= cutoff:
+            return self.names[results[0][1]]
+        matches = get_close_matches(query, self.names, n=1, cutoff=cutoff)
+        return matches[0] if matches else ""
+
+    def closest(self, query: str, limit: int = 5) -> list[str]:
+        results = self.scores(query)
+        if not results:
+            return get_close_matches(query, self.names, n=limit, cutoff=0)
+        return [self.names[i] for _, i in results[:limit]]
+
+    def complete(self, prefix: str) -> list[str]:
+        prefix = prefix.lower()
+        start = bisect_left(self.sorted_keys, prefix)
+        matches = []
+        for j in range(start, len(self.sorted_keys)):
+            if not self.sorted_keys[j].startswith(prefix):
+                break
+            matches.append(self.names[self.sorted[j]])
+        return matches
@@ -0,0 +1,223 @@
+from __future__ import annotations
+
+import contextlib
+import queue
+import threading
+import time
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+
+from metrics import TurnMetrics
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Iterator
+    from concurrent.futures import Future
+
+    from openai import OpenAI, Stream
+
+    OpenRoute = Callable[
+        [OpenAI, TurnMetrics],
+        tuple[Stream, Iterator[tuple[str, str]]],
+    ]
+
+# 等待增量的最长间隔(秒); 阻塞的读取放在后台线程中, 主线程也能及时响应Ctrl-C,
+# 每次等待超时产出一个idle, 渲染器借此输出停顿之前攒下的文本
+POLL_INTERVAL = 0.05
+
+
+# 提供同一模型的服务商
+@dataclass
+class Route:
+    provider: str
+    client: Future[OpenAI]
+
+
+def retryable(error: Exception) -> bool:
+    from openai import APIConnectionError, APIStatusError
+
+    if isinstance(error, APIConnectionError):
+        return True
+    if isinstance(error, APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500  # noqa: PLR2004
+    return False
+
+
+# 在后台线程中读取一个流式请求, 把 (racer, 类型, 文本) 放入共享队列
+# 类型除reasoning/content外还有done与error
+class Racer:
+    def __init__(
+        self,
+        route: Route,
+        open_route: OpenRoute,
+        metrics: TurnMetrics,
+        events: queue.SimpleQueue,
+    ) -> None:
+        self.route = route
+        self.open_route = open_route
+        self.metrics = metrics
+        self.events = events
+        self.stream: Stream | None = None
+        self.chunks = 0
+        self.cancelled = False
+        self.thread = threading.Thread(
+            target=self.run,
+            name=f"Stream-{route.provider}",
+            daemon=True,
+        )
+        self.thread.start()
+
+    def run(self) -> None:
+        try:
+            client = self.route.client.result()
+            self.stream, deltas = self.open_route(client, self.metrics)
+            if self.cancelled:
+                self.stream.close()
+                return
+            for kind, text in deltas:
+                if self.cancelled:
+                    return
+                self.events.put((self, kind, text))
+        except Exception as e:  # noqa: BLE001
+            if not self.cancelled:
+                self.events.put((self, "error", e))
+            return
+        self.events.put((self, "done", ""))
+
+    # 在主线程中关闭响应, 阻塞在读取中的后台线程随之退出
+    def cancel(self) -> None:
+        self.cancelled = True
+        if self.stream is not None:
+            with contextlib.suppress(Exception):
+                self.stream.close()
+
+
+# 对冲请求: 首个token超过ttft_timeout秒或两个块之间超过stall_timeout秒时,
+# 把同一请求发给下一个服务商(没有其他服务商时重发给原服务商), 先产出token的一方胜出,
+# 另一方被取消; 可重试的错误(连接错误、429、5xx)直接切换到下一个服务商
+# 迭代得到 (类型, 文本), 除reasoning/content外还有:
+#   hedge:  发出了对冲请求, 文本为说明
+#   switch: 已输出的部分作废, 之后的内容来自文本所示的服务商
+#   idle:   POLL_INTERVAL内没有新的块, 文本为空
+class StreamRace:
+    def __init__(
+        self,
+        routes: list[Route],
+        model_id: str,
+        open_route: OpenRoute,
+        ttft_timeout: float = 0,
+        stall_timeout: float = 0,
+    ) -> None:
+        self.model_id = model_id
+        self.open_route = open_route
+        self.ttft_timeout = ttft_timeout
+        self.stall_timeout = stall_timeout
+        self.hedges = routes[1:] or routes[:1]
+        self.events: queue.SimpleQueue = queue.SimpleQueue()
+        self.start = time.monotonic()
+        # 最近一次收到当前领先者的块的时刻
+        self.last = self.start
+        self.reason = ""
+        self.racers: list[Racer] = []
+        self.leader = self.launch(routes[0])
+        # 已输出内容所属的请求
+        self.shown: Racer | None = None
+
+    def launch(self, route: Route) -> Racer:
+        metrics = TurnMetrics(route.provider, self.model_id)
+        # 各请求的延迟都从最初发出请求时算起
+        metrics.start = metrics.last_chunk = self.start
+        racer = Racer(route, self.open_route, metrics, self.events)
+        self.racers.append(racer)
+        return racer
+
+    @property
+    def metrics(self) -> TurnMetrics:
+        self.leader.metrics.hedge = self.reason
+        return self.leader.metrics
+
+    @property
+    def racing(self) -> bool:
+        return len(self.racers) > 1
+
+    def deadline(self) -> float | None:
+        if self.racing or not self.hedges:
+            return None
+        timeout = self.stall_timeout if self.leader.chunks else self.ttft_timeout
+        if timeout <= 0:
+            return None
+        return self.last + timeout
+
+    def close(self) -> None:
+        for racer in self.racers:
+            racer.cancel()
+        self.racers = []
+
+    def hedge(self) -> str:
+        waited = time.monotonic() - self.last
+        route = self.hedges.pop(0)
+        self.reason += f"{'stall' if self.leader.chunks else 'ttft'}>{route.provider};"
+        self.launch(route)
+        what = "new tokens" if self.leader.chunks else "first token"
+        return f"No {what} for {waited:.1f}s, also asking {route.provider}"
+
+    # 某个请求出错: 还有其他请求在进行时交给它们, 否则切换到下一个服务商
+    def fail(self, racer: Racer, error: Exception) -> str:
+        self.racers.remove(racer)
+        if racer is not self.leader:
+            return ""
+        if self.racers:
+            self.leader = self.racers[0]
+            self.last = time.monotonic()
+            return ""
+        if not self.hedges or not retryable(error):
+            raise error
+        route = self.hedges.pop(0)
+        self.reason += f"error>{route.provider};"
+        self.last = time.monotonic()
+        self.leader = self.launch(route)
+        return f"{racer.route.provider} failed ({error}), retrying on {route.provider}"
+
+    def __iter__(self) -> Iterator[tuple[str, str]]:
+        try:
+            while True:
+                deadline = self.deadline()
+                timeout = POLL_INTERVAL
+                if deadline is not None:
+                    timeout = min(max(deadline - time.monotonic(), 0), timeout)
+                try:
+                    racer, kind, text = self.events.get(timeout=timeout)
+                except queue.Empty:
+                    if deadline is not None and time.monotonic() >= deadline:
+                        yield "hedge", self.hedge()
+                    else:
+                        yield "idle", ""
+                    continue
+                if racer.cancelled:
+                    continue
+                if kind == "error":
+                    notice = self.fail(racer, text)
+                    if notice:
+                        yield "hedge", notice
+                    continue
+                if kind == "done":
+                    if racer is self.leader:
+                        return
+                    # 对冲请求没有产出任何内容就结束了
+                    self.racers.remove(racer)
+                    continue
+                # 先产出token的一方胜出, 取消其余请求
+                if self.racing:
+                    for other in self.racers:
+                        if other is not racer:
+                            other.cancel()
+                    self.racers = [racer]
+                    self.leader = racer
+                if racer is not self.shown:
+                    if self.shown is not None:
+                        yield "switch", racer.route.provider
+                    self.shown = racer
+                racer.chunks += 1
+                self.last = time.monotonic()
+                yield kind, text
+        finally:
+            self.close()
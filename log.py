@@ -1,5 +1,23 @@
+from __future__ import annotations
+
+import json
 from datetime import datetime
 from pathlib import Path
+from typing import TYPE_CHECKING
+
+from save import (
+    head_line,
+    header_line,
+    read_records,
+    record_line,
+    scan_offsets,
+    summary_line,
+)
+
+if TYPE_CHECKING:
+    from search import SearchIndex
+    from segments import LogStore
+    from writer import LogWriter
 
 
 class Log:
@@ -11,25 +29,61 @@ class Log:
         self,
         model_id: str,
         instr_key: str,
-        log_path: Path,
+        store: LogStore,
+        writer: LogWriter,
         save_path: Path = autosave_path,
+        index: SearchIndex | None = None,
     ) -> None:
         self.model_id = model_id
         self.instr_key = instr_key
-        self.log_path = log_path
+        self.store = store
+        self.writer = writer
         self.save_path = save_path
+        self.index = index
         self.header_written = False
+        # 存档中每条对话记录起始位置的字节偏移与父记录编号, 以及存档当前的字节长度
+        self.offsets: list[int] = []
+        self.parents: list[int] = []
+        self.save_size = 0
+        # 当前分支从根到末尾的记录编号, 第i条对话即path[i]
+        self.path: list[int] = []
+        # 全部摘要记录的 (偏移, 内容), 以及对当前分支有效的最后一条
+        self.summaries: list[tuple[int, bytes]] = []
+        self.summary_entry: tuple[int, bytes] | None = None
+        self.summary = ""
+        self.summary_covered = 0
+
+    def log_header(self) -> str:
+        return (
+            f"{self.double_line}\n\n"
+            f"model_id: {self.model_id}\n"
+            f"Instr_key: {self.instr_key}\n\n"
+        )
+
+    # 日志写入当前分段, 切换到新分段时先写入头部
+    def write_log(self, text: str) -> None:
+        self.store.write(self.writer, text, self.log_header())
 
     def write_header(self) -> None:
-        self.log_path.parent.mkdir(parents=True, exist_ok=True)
-        self.save_path.parent.mkdir(parents=True, exist_ok=True)
-        with self.log_path.open("a", encoding="utf-8") as f:
-            f.write(f"{self.double_line}\n\n")
-            f.write(f"model_id: {self.model_id}\n")
-            f.write(f"Instr_key: {self.instr_key}\n\n")
-        with self.save_path.open("w", encoding="utf-8") as f:
-            f.write(f"{self.model_id}, {self.instr_key}\n")
-            f.write("===APaI===\n")
+        self.store.write(self.writer, self.log_header())
+        header = header_line(self.model_id, self.instr_key)
+        self.writer.reset(self.save_path, header)
+        self.update_index("detach", str(self.save_path))
+        self.clear_tree()
+        self.save_size = len(header)
+
+    def clear_tree(self) -> None:
+        self.offsets = []
+        self.parents = []
+        self.path = []
+        self.summaries = []
+        self.summary_entry = None
+        self.summary = ""
+        self.summary_covered = 0
+
+    @property
+    def head(self) -> int:
+        return self.path[-1] if self.path else -1
 
     def write_dialog(self, role: str, content: str) -> None:
         if not self.header_written:
@@ -37,49 +91,195 @@ class Log:
             self.header_written = True
 
         time_string = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        with self.log_path.open("a", encoding="utf-8") as f:
-            f.write(f"{self.single_line}\n\n")
-            f.write(f"{time_string}\n")
-            f.write(f"{role}:\n")
-            f.write(f"{content.strip()}\n\n")
-        with self.save_path.open("a", encoding="utf-8") as f:
-            f.write(f"{role}\n")
-            f.write(f"{content.strip()}\n")
-            f.write("===APaI===\n")
-
-    def clean(self) -> None:
-        self.log_path.unlink(missing_ok=True)
+        # 存档保存原文, 读回的对话与内存中的一致, 请求的前缀与缓存键不会因此改变;
+        # 只有供人阅读的日志去掉首尾空白
+        self.write_log(
+            f"{self.single_line}\n\n{time_string}\n{role}:\n{content.strip()}\n\n",
+        )
+        # 接在上一条记录之后时不写父记录
+        node = len(self.offsets)
+        parent = self.head
+        record = record_line(
+            role,
+            content,
+            time_string,
+            parent if parent != node - 1 else None,
+        )
+        self.writer.write(self.save_path, record)
+        self.offsets.append(self.save_size)
+        self.parents.append(parent)
+        self.path.append(node)
+        self.save_size += len(record)
+        self.update_index(
+            "add",
+            self.model_id,
+            role,
+            content,
+            time_string,
+            str(self.save_path),
+            node,
+        )
+
+    # 摘要记录追加在存档末尾, 读取时取对当前分支有效的最后一条
+    def write_summary(self, summary: str, covered: int) -> None:
+        time_string = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        last = self.path[covered - 1] if covered > 0 else -1
+        self.append_summary(summary_line(summary, covered, last, time_string))
+        self.summary = summary
+        self.summary_covered = covered
+
+    def append_summary(self, record: bytes) -> None:
+        self.writer.write(self.save_path, record)
+        self.summary_entry = (self.save_size, record)
+        self.summaries.append(self.summary_entry)
+        self.save_size += len(record)
+
+    # 记录当前分支的末尾, 重新载入时回到这里
+    def write_head(self) -> None:
+        time_string = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        record = head_line(self.head, time_string)
+        self.writer.write(self.save_path, record)
+        self.save_size += len(record)
+
+    # 一轮对话结束, 按写入器的持久化模式落盘
+    def commit(self) -> None:
+        self.update_index("commit")
+        self.writer.commit()
+
+    def flush(self) -> None:
+        self.writer.flush()
 
+    # 搜索索引同样交给写入器线程更新, 与存档的写入与截断保持顺序一致
+    def update_index(self, name: str, *args: object) -> None:
+        if self.index is not None:
+            self.writer.call(self.index.apply, name, *args)
+
+    # 扫描一次存档, 重建对话树与记录偏移索引
+    def index_save(self) -> None:
+        index = scan_offsets(self.save_path)
+        # 崩溃可能在末尾留下半行记录, 截掉它, 之后追加的记录才会从新的一行开始
+        if 0 < index.size < self.save_path.stat().st_size:
+            self.writer.truncate(self.save_path, index.size)
+        self.offsets = index.offsets
+        self.parents = index.parents
+        self.save_size = index.size
+        self.summaries = index.summaries
+        self.path = self.branch_path(index.head)
+        self.select_summary()
+
+    # 从根到node的记录编号; 父记录总在子记录之前, 沿父记录走到根即可
+    def branch_path(self, node: int) -> list[int]:
+        path = []
+        while node >= 0:
+            path.append(node)
+            node = self.parents[node]
+        path.reverse()
+        return path
+
+    # 摘要覆盖的对话都在当前分支上时才有效; 旧存档的摘要记录没有last, 以最后一条为准
+    def summary_valid(self, record: dict) -> bool:
+        covered = record["covered"]
+        if covered > len(self.path):
+            return False
+        last = record.get("last")
+        return last is None or last == (self.path[covered - 1] if covered else -1)
+
+    def select_summary(self) -> None:
+        self.summary_entry = None
+        self.summary = ""
+        self.summary_covered = 0
+        for entry in reversed(self.summaries):
+            record = json.loads(entry[1])
+            if self.summary_valid(record):
+                self.summary_entry = entry
+                self.summary = record["content"]
+                self.summary_covered = record["covered"] if self.summary else 0
+                return
+
+    def leaves(self) -> list[int]:
+        parents = set(self.parents)
+        return [node for node in range(len(self.parents)) if node not in parents]
+
+    def read_nodes(self, nodes: list[int]) -> list[dict]:
+        self.flush()
+        return read_records(self.save_path, [self.offsets[node] for node in nodes])
+
+    # 按需从存档中读取当前分支的第start到stop条对话
+    def read_dialogs(self, start: int, stop: int) -> list[dict]:
+        return [
+            {"role": record["role"], "content": record["content"]}
+            for record in self.read_nodes(self.path[start:stop])
+        ]
+
+    def change_save(self, save_path: Path, header_written: bool) -> None:
+        self.flush()
+        self.save_path = save_path
+        self.header_written = header_written
+        if header_written:
+            self.index_save()
+        else:
+            self.clear_tree()
+            self.save_size = 0
+
+    # 存档被复制为新文件后改写新文件, 索引中的对话随之指向新存档
+    def move_save(self, save_path: Path, header_written: bool) -> None:
+        old_path = self.save_path
+        self.change_save(save_path, header_written)
+        self.update_index("move", str(old_path), str(save_path))
+        self.update_index("commit")
+
+    # 不指定策略时删除全部日志, 否则只删除过旧或超出总大小的分段; 返回删除的分段数
+    def clean(self, max_days: int = 0, max_mb: int = 0) -> int:
+        if max_days <= 0 and max_mb <= 0:
+            count = len(self.store.segments)
+            self.store.clear(self.writer)
+            return count
+        self.flush()
+        return self.store.clean(max_days, max_mb)
+
+    # 截断存档末尾的count条对话记录, 只用于撤回刚写入、请求失败的提问
+    def truncate_save(self, count: int) -> None:
+        if count > len(self.offsets):
+            count = len(self.offsets)
+        if count == 0:
+            return
+        self.save_size = self.offsets[-count]
+        del self.offsets[-count:]
+        del self.parents[-count:]
+        while self.path and self.path[-1] >= len(self.offsets):
+            self.path.pop()
+        self.writer.truncate(self.save_path, self.save_size)
+        self.update_index("drop", str(self.save_path), len(self.offsets))
+        # 摘要记录被一并截掉时, 若仍有效则重新追加
+        active = self.summary_entry
+        self.summaries = [
+            entry for entry in self.summaries if entry[0] < self.save_size
+        ]
+        self.select_summary()
+        if (
+            active is not None
+            and active[0] >= self.save_size
+            and self.summary_valid(json.loads(active[1]))
+        ):
+            self.append_summary(active[1])
+            self.select_summary()
+
+    # 重试与撤销只移动当前分支的末尾, 原来的回答作为另一个分支保留在存档中
     def retry(self) -> None:
-        with self.log_path.open("a", encoding="utf-8") as f:
-            f.write(f"{self.single_line}\n\n")
-            f.write("[retry]\n\n")
-        with self.save_path.open("r", encoding="utf-8") as f:
-            lines = f.readlines()
-        delete_count = 0
-        one = 1
-        for i in range(len(lines) - 1, -1, -1):
-            if lines[i].strip() == "===APaI===":
-                if delete_count == one:
-                    lines = lines[: i + 1]
-                    break
-                delete_count += 1
-        with self.save_path.open("w", encoding="utf-8") as f:
-            f.writelines(lines)
+        self.write_log(f"{self.single_line}\n\n[retry]\n\n")
+        self.path.pop()
+        self.commit()
 
     def undo(self) -> None:
-        with self.log_path.open("a", encoding="utf-8") as f:
-            f.write(f"{self.single_line}\n\n")
-            f.write("[undo]\n\n")
-        with self.save_path.open("r", encoding="utf-8") as f:
-            lines = f.readlines()
-        delete_count = 0
-        two = 2
-        for i in range(len(lines) - 1, -1, -1):
-            if lines[i].strip() == "===APaI===":
-                if delete_count == two:
-                    lines = lines[: i + 1]
-                    break
-                delete_count += 1
-        with self.save_path.open("w", encoding="utf-8") as f:
-            f.writelines(lines)
+        self.write_log(f"{self.single_line}\n\n[undo]\n\n")
+        del self.path[-2:]
+        self.write_head()
+        self.select_summary()
+        self.commit()
+
+    # 切换到以node结尾的分支, -1为空对话
+    def checkout(self, node: int) -> None:
+        self.path = self.branch_path(node)
+        self.write_head()
+        self.select_summary()
+        self.commit()
@@ -0,0 +1,230 @@
+from __future__ import annotations
+
+import time
+from collections.abc import Iterator
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+from openai import APIConnectionError, APIStatusError, OpenAI, RateLimitError
+from rich.console import Console
+
+from batch import BatchRunner
+from message import MESSAGE_OVERHEAD, count_tokens
+
+MAP_PROMPT = (
+    "You are reading part {part} of the file '{name}', which was too large to "
+    "send at once and has been split into parts. Answer the question using only "
+    "this part, keeping concrete details such as names, numbers and short quotes. "
+    "If this part contains nothing relevant to the question, reply exactly: "
+    "NOTHING"
+)
+REDUCE_PROMPT = (
+    "Below are answers to the same question, each written from a different part "
+    "of the file '{name}'. Combine them into one complete answer to the question. "
+    "Merge duplicates, resolve overlaps and keep concrete details."
+)
+NOTHING = "NOTHING"
+
+
+def estimate_tokens(text: str) -> int:
+    return count_tokens(text) - MESSAGE_OVERHEAD
+
+
+# 按每4字节1个token估算已超出limit时不必读取文件; 否则文件不大, 读出后按内容估算
+# (中文等非ASCII字符每字约1个token, 只看字节数会少算)
+def estimate_file_tokens(path: Path, limit: int) -> int:
+    size = path.stat().st_size
+    if size // 4 > limit:
+        return size // 4
+    return estimate_tokens(path.read_text(encoding="utf-8", errors="replace"))
+
+
+# 把超出budget的行切成若干段, 每段按估算不超过budget
+# 先按每4个字符1个token取一段, 超出时按比例缩短, 对中文等字符也不会超出
+def split_line(line: str, budget: int) -> list[str]:
+    pieces = []
+    while estimate_tokens(line) > budget:
+        n = min(len(line), budget * 4)
+        while n > 1 and (tokens := estimate_tokens(line[:n])) > budget:
+            n = max(n * budget // tokens, 1)
+        pieces.append(line[:n])
+        line = line[n:]
+    if line:
+        pieces.append(line)
+    return pieces
+
+
+# 逐行读取文件, 按token预算切块; 超出预算时优先在段落(空行)处切分, 超长的单行硬切
+def iter_chunks(path: Path, max_tokens: int) -> Iterator[str]:
+    lines: list[str] = []
+    sizes: list[int] = []
+    tokens = 0
+    # lines[:paragraph]以空行结尾
+    paragraph = 0
+    with path.open("r", encoding="utf-8", errors="replace") as f:
+        for line in f:
+            for piece in split_line(line, max_tokens - 1):
+                # 逐行估算会向下取整, 每行多算1个token, 保证整块不超出预算
+                size = estimate_tokens(piece) + 1
+                while lines and tokens + size > max_tokens:
+                    cut = paragraph if paragraph > len(lines) // 2 else len(lines)
+                    yield "".join(lines[:cut])
+                    del lines[:cut], sizes[:cut]
+                    tokens = sum(sizes)
+                    paragraph = 0
+                lines.append(piece)
+                sizes.append(size)
+                tokens += size
+                if not piece.strip():
+                    paragraph = len(lines)
+    if lines:
+        yield "".join(lines)
+
+
+# 超出上下文的大文件: 每块分别提问(map), 再把各块的回答合并(reduce)
+# 合并前的回答总量仍超出预算时分组合并, 直到可以一次发送
+class MapReduce:
+    max_attempts = 4
+
+    def __init__(
+        self,
+        client: OpenAI,
+        model_id: str,
+        instruction: str,
+        chunk_tokens: int,
+        workers: int,
+        console: Console,
+    ) -> None:
+        # 429与5xx由这里退避重试, 关闭客户端自带的重试
+        self.client = client.with_options(max_retries=0)
+        self.model_id = model_id
+        self.instruction = instruction
+        self.chunk_tokens = max(chunk_tokens, 256)
+        self.workers = max(workers, 1)
+        self.console = console
+
+    def complete(self, system: str, content: str) -> str:
+        messages = [
+            {"role": "system", "content": system},
+            {"role": "user", "content": content},
+        ]
+        for attempt in range(self.max_attempts):
+            try:
+                response = self.client.chat.completions.create(
+                    model=self.model_id,
+                    messages=messages,
+                )
+            except RateLimitError as e:
+                retry_after = e.response.headers.get("retry-after")
+                time.sleep(BatchRunner.backoff(attempt, retry_after))
+                continue
+            except (APIStatusError, APIConnectionError) as e:
+                status = getattr(e, "status_code", None)
+                retryable = status is None or status >= 500  # noqa: PLR2004
+                if not retryable or attempt == self.max_attempts - 1:
+                    raise
+                time.sleep(BatchRunner.backoff(attempt, None))
+                continue
+            return (response.choices[0].message.content or "").strip()
+        msg = "rate limited"
+        raise RuntimeError(msg)
+
+    def system_prompt(self, prompt: str) -> str:
+        if self.instruction:
+            return f"{self.instruction}\n\n{prompt}"
+        return prompt
+
+    def map_chunk(self, part: int, chunk: str, name: str, ask: str) -> str:
+        system = self.system_prompt(MAP_PROMPT.format(part=part, name=name))
+        return self.complete(system, f"{chunk}\n\n[question]\n{ask}")
+
+    # 边读文件边提交, 同时在途的块数不超过worker数的两倍, 内存中不保留整个文件
+    def map_file(self, path: Path, ask: str) -> list[str]:
+        answers: dict[int, str] = {}
+        failed = []
+        chunks = enumerate(iter_chunks(path, self.chunk_tokens), 1)
+        start = last_report = time.monotonic()
+        with ThreadPoolExecutor(self.workers) as pool:
+            running = {}
+            for part, chunk in chunks:
+                future = pool.submit(self.map_chunk, part, chunk, path.name, ask)
+                running[future] = part
+                if len(running) >= self.workers * 2:
+                    break
+            while running:
+                completed, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in completed:
+                    part = running.pop(future)
+                    try:
+                        answers[part] = future.result()
+                    except (APIStatusError, APIConnectionError, RuntimeError) as e:
+                        failed.append(part)
+                        answers[part] = NOTHING
+                        self.console.print(f"Part {part} failed: {e}", style="red")
+                    next_chunk = next(chunks, None)
+                    if next_chunk is not None:
+                        part, chunk = next_chunk
+                        running[
+                            pool.submit(self.map_chunk, part, chunk, path.name, ask)
+                        ] = part
+                now = time.monotonic()
+                if now - last_report >= 1 or not running:
+                    last_report = now
+                    self.console.print(
+                        f"[{len(answers)}/{len(answers) + len(running)}] chunks done"
+                        f", {len(failed)} failed, {now - start:.1f}s",
+                        style="dim green",
+                    )
+        return [
+            answers[part]
+            for part in sorted(answers)
+            if answers[part].strip() != NOTHING
+        ]
+
+    def reduce_content(self, partials: list[str], ask: str) -> str:
+        parts = "\n\n".join(
+            f"[answer {i}]\n{partial}" for i, partial in enumerate(partials, 1)
+        )
+        return f"{parts}\n\n[question]\n{ask}"
+
+    # 按token预算把回答分组, 每组合并为一条, 直到总量可以一次发送
+    def reduce_until_fits(self, partials: list[str], name: str, ask: str) -> list[str]:
+        system = self.system_prompt(REDUCE_PROMPT.format(name=name))
+        while sum(estimate_tokens(p) for p in partials) > self.chunk_tokens:
+            groups: list[list[str]] = [[]]
+            tokens = 0
+            for partial in partials:
+                size = estimate_tokens(partial)
+                if groups[-1] and tokens + size > self.chunk_tokens:
+                    groups.append([])
+                    tokens = 0
+                groups[-1].append(partial)
+                tokens += size
+            # 单条回答本身超出预算时无法再合并
+            if len(groups) == len(partials):
+                break
+            self.console.print(
+                f"Merging {len(partials)} answers in {len(groups)} group(s)...",
+                style="dim green",
+            )
+            with ThreadPoolExecutor(self.workers) as pool:
+                partials = list(
+                    pool.map(
+                        lambda group: self.complete(
+                            system,
+                            self.reduce_content(group, ask),
+                        ),
+                        groups,
+                    ),
+                )
+        return partials
+
+    # 最后一次合并由Agent以流式请求发出
+    def reduce_messages(self, partials: list[str], name: str, ask: str) -> list[dict]:
+        return [
+            {
+                "role": "system",
+                "content": self.system_prompt(REDUCE_PROMPT.format(name=name)),
+            },
+            {"role": "user", "content": self.reduce_content(partials, ask)},
+        ]
@@ -1,13 +1,217 @@
+from bisect import bisect_left
+from collections.abc import Callable
+
+from files import reference_files
+from summary import SUMMARY_HEADER
+
+# 每条消息的格式开销
+MESSAGE_OVERHEAD = 4
+# 窗口之前的对话超过这么多条或这么多token时移出内存, 需要时再从存档读回
+SPILL_DIALOGS = 64
+SPILL_TOKENS = 32000
+# 窗口之前保留的对话数; 窗口起点只会后移, 保留两条就不必为判断起点而读回存档
+SPILL_MARGIN = 2
+
+
+# 估算token数: 非ASCII字符(中文等)按每字1个token, 其余按每4个字符1个token
+# 只用到encode和len, 对大文件也足够快
+def count_tokens(text: str) -> int:
+    non_ascii = (len(text.encode()) - len(text)) // 2
+    return (len(text) - non_ascii) // 4 + non_ascii + MESSAGE_OVERHEAD
+
+
+# 内存中的一条对话, 用__slots__省去每条记录的字典
+class Dialog:
+    __slots__ = ("role", "content", "tokens")
+
+    def __init__(self, role: str, content: str) -> None:
+        self.role = role
+        self.content = content
+        self.tokens = count_tokens(content)
+
+    def message(self) -> dict:
+        return {"role": self.role, "content": self.content}
+
+
 # 生成对话消息
 class Message:
-    def __init__(self, instruction: str) -> None:
-        self.dialogs: list[dict] = []
+    def __init__(
+        self,
+        instruction: str,
+        loader: Callable[[int, int], list[dict]] | None = None,
+    ) -> None:
+        # dialogs只保存已载入内存的最近对话, 更早的archived条留在存档中按需读取
+        # 有loader时滑出窗口的对话会被移出内存
+        self.dialogs: list[Dialog] = []
+        self.archived = 0
+        self.loader = loader
         self.instruction: dict = {"role": "system", "content": instruction}
+        self.instruction_tokens = count_tokens(instruction)
+        # 前summary_covered条对话已被压缩为摘要, 摘要接在系统指令之后发送
+        self.summary = ""
+        self.summary_covered = 0
+        self.summary_tokens = 0
+        # prefix[i]为dialogs[:i]的token总数, 在add_dialog时增量维护
+        self.prefix: list[int] = [0]
+        # 上一次generate_messages选出的窗口起点(含archived)与token数
+        self.window_start = 0
+        self.window_tokens = 0
+
+    def __len__(self) -> int:
+        return self.archived + len(self.dialogs)
+
+    def set_summary(self, summary: str, covered: int) -> None:
+        self.summary = summary
+        self.summary_covered = covered if summary else 0
+        self.summary_tokens = count_tokens(SUMMARY_HEADER + summary) if summary else 0
+
+    def system_message(self) -> dict:
+        if not self.summary:
+            return self.instruction
+        content = self.instruction["content"]
+        if content:
+            content += "\n\n"
+        return {"role": "system", "content": content + SUMMARY_HEADER + self.summary}
+
+    def rebuild_prefix(self) -> None:
+        self.prefix = [0]
+        for dialog in self.dialogs:
+            self.prefix.append(self.prefix[-1] + dialog.tokens)
+
+    @staticmethod
+    def load(records: list[dict]) -> list[Dialog]:
+        return [Dialog(record["role"], record["content"]) for record in records]
+
+    # 关联存档, 只载入最后keep条对话
+    def attach(
+        self,
+        loader: Callable[[int, int], list[dict]],
+        total: int,
+        keep: int,
+    ) -> None:
+        self.loader = loader
+        self.archived = max(total - keep, 0) if keep > 0 else 0
+        self.dialogs = self.load(loader(self.archived, total))
+        self.rebuild_prefix()
+
+    # 从存档中再载入count条更早的对话
+    def fetch(self, count: int) -> None:
+        if self.loader is None or self.archived == 0:
+            return
+        start = max(self.archived - count, 0)
+        self.dialogs = self.load(self.loader(start, self.archived)) + self.dialogs
+        self.archived = start
+        self.rebuild_prefix()
+
+    # 把前count条对话移出内存, 它们已经写入存档
+    def spill(self, count: int) -> None:
+        if self.loader is None or count <= 0:
+            return
+        del self.dialogs[:count]
+        self.archived += count
+        shift = self.prefix[count]
+        self.prefix = [tokens - shift for tokens in self.prefix[count:]]
+
+    def get_dialog(self, index: int) -> dict:
+        if index < 0:
+            index += len(self)
+        if index < self.archived:
+            self.fetch(self.archived - index)
+        return self.dialogs[index - self.archived].message()
+
+    # 读取第start到stop条对话, 不把存档中的对话载入内存
+    def read_range(self, start: int, stop: int) -> list[dict]:
+        if start >= self.archived or self.loader is None:
+            dialogs = self.dialogs[start - self.archived : stop - self.archived]
+            return [dialog.message() for dialog in dialogs]
+        if stop <= self.archived:
+            return self.loader(start, stop)
+        return self.loader(start, self.archived) + [
+            dialog.message() for dialog in self.dialogs[: stop - self.archived]
+        ]
 
     # role只能为user或者assistant
     def add_dialog(self, role: str, content: str) -> None:
-        self.dialogs.append({"role": role, "content": content})
+        dialog = Dialog(role, content)
+        self.dialogs.append(dialog)
+        self.prefix.append(self.prefix[-1] + dialog.tokens)
+
+    def pop_dialog(self) -> dict:
+        if not self.dialogs:
+            self.fetch(1)
+        self.prefix.pop()
+        dialog = self.dialogs.pop()
+        # 撤回到摘要覆盖的范围内时摘要失效
+        if len(self) < self.summary_covered:
+            self.set_summary("", 0)
+        return dialog.message()
 
-    def generate_messages(self, context_len: int) -> list:
+    # 按token预算选出窗口起点: 二分查找满足预算的最早一条, 并对齐到提问
+    def token_window(self, context_tokens: int) -> int:
+        budget = context_tokens - self.instruction_tokens - self.summary_tokens
+        while True:
+            total = self.prefix[-1]
+            start = bisect_left(self.prefix, total - budget, 0, len(self.dialogs))
+            if start > 0 or self.archived == 0:
+                break
+            self.fetch(max(len(self.dialogs), 16))
+        if start < len(self.dialogs) and self.dialogs[start].role == "assistant":
+            start += 1
+        return min(start, max(len(self.dialogs) - 1, 0))
+
+    # 满足上限的最早起点(相对dialogs)
+    def limit_window(self, context_len: int, context_tokens: int) -> int:
+        if context_tokens > 0:
+            return self.token_window(context_tokens)
         # dialogs存储的是单次对话 而content_len以一问一答计数 因此要乘二
-        return [self.instruction] + self.dialogs[-context_len * 2 :]
+        if context_len <= 0:
+            self.fetch(self.archived)
+            return 0
+        if len(self.dialogs) < context_len * 2:
+            self.fetch(context_len * 2 - len(self.dialogs))
+        return max(len(self.dialogs) - context_len * 2, 0)
+
+    # block为0时窗口每轮滑动, 起点一变请求的前缀就变了, 服务商的前缀缓存无法命中
+    # block>0时窗口起点保持不变, 直到超出上限才一次丢弃block%的上下文,
+    # 并对齐到提问, 之后的多轮请求共用同一前缀
+    def generate_messages(
+        self,
+        context_len: int,
+        context_tokens: int = 0,
+        block: int = 0,
+    ) -> list:
+        start = self.limit_window(context_len, context_tokens)
+        if block > 0 and (context_len > 0 or context_tokens > 0):
+            previous = self.window_start - self.archived
+            if start <= previous < len(self.dialogs):
+                start = previous
+            else:
+                keep = max(100 - block, 1)
+                start = self.limit_window(
+                    max(context_len * keep // 100, 1),
+                    -(-context_tokens * keep // 100),
+                )
+                if (self.archived + start) % 2 and start < len(self.dialogs) - 1:
+                    start += 1
+        # 已被摘要覆盖的对话不再原样发送
+        covered = self.summary_covered - self.archived
+        if covered > start:
+            start = min(covered, max(len(self.dialogs) - 1, 0))
+        self.window_start = self.archived + start
+        self.window_tokens = (
+            self.instruction_tokens
+            + self.summary_tokens
+            + self.prefix[-1]
+            - self.prefix[start]
+        )
+        messages = [self.system_message()]
+        messages += reference_files(
+            [dialog.message() for dialog in self.dialogs[start:]],
+        )
+        # 最后一条提问此时还没有写入存档, 而start不会超过它
+        spilled = start - SPILL_MARGIN
+        if spilled >= SPILL_DIALOGS or (
+            spilled > 0 and self.prefix[spilled] >= SPILL_TOKENS
+        ):
+            self.spill(spilled)
+        return messages
@@ -0,0 +1,200 @@
+from __future__ import annotations
+
+import json
+import time
+from bisect import bisect_left
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from rich.table import Table
+
+    from writer import LogWriter
+
+# 相邻两个块之间间隔的直方图分桶上界(毫秒), 最后一个桶为超出上界的部分
+GAP_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+METRICS_PATH = Path("logs") / "metrics.jsonl"
+
+
+# 单轮请求的延迟数据, 时间均为相对发送请求时刻的秒数
+@dataclass
+class TurnMetrics:
+    provider: str
+    model_id: str
+    time: str = ""
+    first_reasoning: float | None = None
+    first_content: float | None = None
+    total: float = 0.0
+    chunks: int = 0
+    gap_histogram: list[int] = field(
+        default_factory=lambda: [0] * (len(GAP_BUCKETS_MS) + 1),
+    )
+    prompt_tokens: int | None = None
+    completion_tokens: int | None = None
+    # 命中服务商前缀缓存的提示token数
+    cached_tokens: int | None = None
+    # 发出过的对冲请求, 如 "ttft>Backup;"
+    hedge: str = ""
+
+    def __post_init__(self) -> None:
+        self.time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.start = time.monotonic()
+        self.last_chunk = self.start
+
+    def on_chunk(self, kind: str) -> None:
+        now = time.monotonic()
+        elapsed = now - self.start
+        if kind == "reasoning" and self.first_reasoning is None:
+            self.first_reasoning = elapsed
+        elif kind == "content" and self.first_content is None:
+            self.first_content = elapsed
+        if self.chunks > 0:
+            gap_ms = (now - self.last_chunk) * 1000
+            self.gap_histogram[bisect_left(GAP_BUCKETS_MS, gap_ms)] += 1
+        self.chunks += 1
+        self.last_chunk = now
+
+    # OpenAI为prompt_tokens_details.cached_tokens, DeepSeek为prompt_cache_hit_tokens
+    def on_usage(self, usage: object) -> None:
+        self.prompt_tokens = getattr(usage, "prompt_tokens", None)
+        self.completion_tokens = getattr(usage, "completion_tokens", None)
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached = getattr(details, "cached_tokens", None)
+        if cached is None:
+            cached = getattr(usage, "prompt_cache_hit_tokens", None)
+        self.cached_tokens = cached
+
+    def cache_ratio(self) -> float | None:
+        if not self.prompt_tokens or self.cached_tokens is None:
+            return None
+        return self.cached_tokens / self.prompt_tokens
+
+    def finish(self) -> None:
+        self.total = time.monotonic() - self.start
+
+    def to_record(self) -> dict:
+        record = asdict(self)
+        for key in ("first_reasoning", "first_content", "total"):
+            if record[key] is not None:
+                record[key] = round(record[key], 4)
+        return record
+
+
+class MetricsStore:
+    def __init__(self, writer: LogWriter, path: Path = METRICS_PATH) -> None:
+        self.writer = writer
+        self.path = path
+
+    # 交给日志写入器在后台追加, 不占用对话线程
+    def write(self, metrics: TurnMetrics) -> None:
+        self.writer.write(
+            self.path,
+            json.dumps(metrics.to_record(), ensure_ascii=False) + "\n",
+        )
+
+    def load(self) -> list[dict]:
+        self.writer.flush()
+        if not self.path.exists():
+            return []
+        # 写入中断时最后一行可能不完整(甚至截断在多字节字符中间), 跳过解析失败的行
+        records = []
+        with self.path.open("r", encoding="utf-8", errors="replace") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+        return records
+
+
+def percentile(values: list[float], p: float) -> float | None:
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(int(round(p / 100 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+# 由合并后的直方图估计间隔的分位数, 返回所在桶的上界
+def histogram_percentile(histogram: list[int], p: float) -> str:
+    total = sum(histogram)
+    if total == 0:
+        return "-"
+    target = p / 100 * total
+    count = 0
+    for i, n in enumerate(histogram):
+        count += n
+        if count >= target:
+            if i < len(GAP_BUCKETS_MS):
+                return f"<{GAP_BUCKETS_MS[i]}ms"
+            return f">{GAP_BUCKETS_MS[-1]}ms"
+    return "-"
+
+
+def stats_table(records: list[dict]) -> Table:
+    from rich.table import Table
+
+    groups: dict[tuple[str, str], list[dict]] = {}
+    for record in records:
+        key = (record["provider"], record["model_id"])
+        groups.setdefault(key, []).append(record)
+
+    def seconds(values: list[float]) -> str:
+        return "/".join(
+            "-" if (v := percentile(values, p)) is None else f"{v:.2f}"
+            for p in (50, 95, 99)
+        )
+
+    table = Table(
+        show_header=True,
+        header_style="bold magenta",
+        caption="latencies in seconds, shown as p50/p95/p99",
+    )
+    table.add_column("Provider")
+    table.add_column("Model ID")
+    table.add_column("Turns", justify="right")
+    table.add_column("TTFT")
+    table.add_column("Content TTFT")
+    table.add_column("Total")
+    table.add_column("Tok/s p50", justify="right")
+    table.add_column("Gap p95/p99")
+    table.add_column("Cache hit", justify="right")
+    for (provider, model_id), group in sorted(groups.items()):
+        ttft, content_ttft, speed = [], [], []
+        for r in group:
+            firsts = [
+                v for v in (r["first_reasoning"], r["first_content"]) if v is not None
+            ]
+            if not firsts:
+                continue
+            ttft.append(min(firsts))
+            if r["first_content"] is not None:
+                content_ttft.append(r["first_content"])
+            if r["completion_tokens"] and r["total"] > min(firsts):
+                speed.append(r["completion_tokens"] / (r["total"] - min(firsts)))
+        histogram = [
+            sum(bucket) for bucket in zip(*(r["gap_histogram"] for r in group))
+        ]
+        tokens_per_second = percentile(speed, 50)
+        # 旧记录没有cached_tokens, 只统计报告了缓存用量的请求
+        reported = [r for r in group if r.get("cached_tokens") is not None]
+        prompt = sum(r["prompt_tokens"] or 0 for r in reported)
+        cached = sum(r["cached_tokens"] for r in reported)
+        cache_hit = cached / prompt if prompt else None
+        table.add_row(
+            provider,
+            model_id,
+            str(len(group)),
+            seconds(ttft),
+            seconds(content_ttft),
+            seconds([r["total"] for r in group]),
+            "-" if tokens_per_second is None else f"{tokens_per_second:.1f}",
+            f"{histogram_percentile(histogram, 95)}/"
+            f"{histogram_percentile(histogram, 99)}",
+            "-" if cache_hit is None else f"{cache_hit:.0%}",
+        )
+    return table
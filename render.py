@@ -0,0 +1,241 @@
+from __future__ import annotations
+
+import re
+import time
+from typing import TYPE_CHECKING
+
+from rich.text import Text
+
+if TYPE_CHECKING:
+    from rich.console import Console
+    from rich.live import Live
+    from rich.segment import Segments
+
+# 列表项: "- ", "* ", "+ ", "1. ", "1) "
+LIST_ITEM = re.compile(r"\s{0,3}([-*+]|\d{1,9}[.)])(\s|$)")
+FENCE = re.compile(r"\s{0,3}(`{3,}|~{3,})")
+
+
+# 流式输出渲染器: 先攒下增量文本, 按帧率上限(或遇到换行时)一次性输出到终端
+# 思考内容与回答内容各自保留样式
+class StreamRenderer:
+    reasoning_style = "dim magenta"
+    content_style = "cyan"
+
+    def __init__(self, console: Console, fps: int = 30) -> None:
+        self.console = console
+        self.frame_interval = 1 / fps
+        # 换行触发输出时的最小间隔, 防止逐行的块把帧率上限打穿
+        self.line_interval = self.frame_interval / 4
+        # 待输出的 (样式, 文本片段列表), 相同样式的连续片段合并到一起
+        self.pending: list[tuple[str, list[str]]] = []
+        self.last_flush = time.monotonic()
+        self.start = self.last_flush
+        self.chunks = 0
+        self.chars = 0
+        self.frames = 0
+
+    def feed_reasoning(self, text: str) -> None:
+        self.feed(text, self.reasoning_style)
+
+    def feed_content(self, text: str) -> None:
+        self.feed(text, self.content_style)
+
+    def feed(self, text: str, style: str) -> None:
+        self.chunks += 1
+        self.chars += len(text)
+        if self.pending and self.pending[-1][0] == style:
+            self.pending[-1][1].append(text)
+        else:
+            self.pending.append((style, [text]))
+        now = time.monotonic()
+        elapsed = now - self.last_flush
+        if elapsed >= self.frame_interval or (
+            "\n" in text and elapsed >= self.line_interval
+        ):
+            self.flush(now)
+
+    # 流停顿时由读取方定时调用, 攒下的文本不必等到下一个块才输出
+    def tick(self) -> None:
+        now = time.monotonic()
+        if self.pending and now - self.last_flush >= self.frame_interval:
+            self.flush(now)
+
+    def flush(self, now: float | None = None) -> None:
+        if self.pending:
+            text = Text.assemble(
+                *(("".join(parts), style) for style, parts in self.pending),
+            )
+            self.console.print(text, end="", soft_wrap=True)
+            self.pending = []
+            self.frames += 1
+        self.last_flush = now if now is not None else time.monotonic()
+
+    # 插入提示信息之前调用, 之后的输出另起一段
+    def settle(self) -> None:
+        self.flush()
+
+    def close(self) -> None:
+        self.flush()
+
+    # 吞吐量统计: 块数/秒 与 帧数
+    def stats(self) -> dict:
+        duration = max(time.monotonic() - self.start, 1e-9)
+        return {
+            "chunks": self.chunks,
+            "chars": self.chars,
+            "frames": self.frames,
+            "duration": duration,
+            "chunks_per_second": self.chunks / duration,
+        }
+
+
+# 流式Markdown渲染器: 回答按块(段落、列表、围栏代码块)增量解析,
+# 已结束的块渲染一次后输出到终端, 只有末尾仍未结束的块在Live区域中按帧重绘
+# 每帧的开销只与未结束的块的长度有关, 与回答总长度无关; 思考内容仍按纯文本输出
+class MarkdownRenderer(StreamRenderer):
+    def __init__(self, console: Console, fps: int = 15) -> None:
+        super().__init__(console, fps)
+        self.live: Live | None = None
+        # 未结束的块中已完整的行, 以及最后一行未完的部分
+        self.lines: list[str] = []
+        self.partial = ""
+        self.fence = ""
+        self.in_list = False
+        self.blank = False
+        self.blocks = 0
+        # 思考内容停在行中间时, 回答另起一行
+        self.midline = False
+
+    def flush(self, now: float | None = None) -> None:
+        if self.pending:
+            for style, parts in self.pending:
+                if style == self.content_style:
+                    self.feed_markdown("".join(parts))
+                else:
+                    self.print_text("".join(parts), style)
+            self.pending = []
+            self.frames += 1
+            if self.live is not None:
+                self.live.update(self.render_open(), refresh=True)
+        self.last_flush = now if now is not None else time.monotonic()
+
+    def print_text(self, text: str, style: str) -> None:
+        self.console.print(Text(text, style=style), end="", soft_wrap=True)
+        self.midline = not text.endswith("\n")
+
+    def start_live(self) -> None:
+        from rich.live import Live
+
+        if self.midline:
+            self.console.print()
+            self.midline = False
+        self.live = Live(
+            console=self.console,
+            auto_refresh=False,
+            transient=True,
+            # 超出屏幕的部分若留在回滚区, 会与commit输出的完整块重复
+            vertical_overflow="crop",
+        )
+        self.live.start()
+
+    def feed_markdown(self, text: str) -> None:
+        if self.live is None:
+            self.start_live()
+        *complete, self.partial = (self.partial + text).split("\n")
+        for line in complete:
+            self.add_line(line)
+
+    def add_line(self, line: str) -> None:
+        if self.fence:
+            self.lines.append(line)
+            if line.strip().startswith(self.fence) and not line.strip().strip(
+                self.fence[0],
+            ):
+                self.commit()
+            return
+        if not line.strip():
+            if self.lines:
+                self.blank = True
+                self.lines.append(line)
+            return
+        fence = FENCE.match(line)
+        # 空行之后的列表项或缩进行仍属于同一个列表
+        continues = self.in_list and (
+            LIST_ITEM.match(line) is not None or line[:1] in (" ", "\t")
+        )
+        if self.lines and (fence or (self.blank and not continues)):
+            self.commit()
+        if not self.lines:
+            self.in_list = LIST_ITEM.match(line) is not None
+            if fence:
+                self.fence = fence.group(1)
+        self.blank = False
+        self.lines.append(line)
+
+    # 渲染为行并去掉首尾空行(代码块带背景色的空行除外), 块之间统一空一行,
+    # 与整篇渲染时的间距一致; 给出height时只保留最后height行
+    def render_block(
+        self,
+        lines: list[str],
+        height: int | None = None,
+    ) -> Segments | None:
+        from rich.markdown import Markdown
+        from rich.segment import Segment, Segments
+
+        text = "\n".join(lines).strip("\n")
+        if not text:
+            return None
+        rendered = self.console.render_lines(Markdown(text), pad=False, new_lines=True)
+
+        def blank(line: list[Segment]) -> bool:
+            return all(
+                not segment.text.strip()
+                and (segment.style is None or segment.style.bgcolor is None)
+                for segment in line
+            )
+
+        start, stop = 0, len(rendered)
+        while start < stop and blank(rendered[start]):
+            start += 1
+        while stop > start and blank(rendered[stop - 1]):
+            stop -= 1
+        if height is not None:
+            start = max(start, stop - height)
+        segments = [Segment.line()] if self.blocks else []
+        for line in rendered[start:stop]:
+            segments += line
+        return Segments(segments)
+
+    # 块高于屏幕时显示正在输出的末尾部分
+    def render_open(self) -> Segments | Text:
+        lines = [*self.lines, self.partial] if self.partial else self.lines
+        height = max(self.console.height - 1, 1)
+        return self.render_block(lines, height) or Text()
+
+    # 已结束的块输出到Live区域之上, 之后不再重绘
+    def commit(self) -> None:
+        block = self.render_block(self.lines)
+        if block is not None:
+            self.console.print(block, end="")
+            self.blocks += 1
+        self.lines = []
+        self.fence = ""
+        self.in_list = False
+        self.blank = False
+
+    def settle(self) -> None:
+        self.flush()
+        if self.partial:
+            self.lines.append(self.partial)
+            self.partial = ""
+        self.commit()
+        if self.live is not None:
+            self.live.stop()
+            self.live = None
+
+    def close(self) -> None:
+        self.settle()
+
+    def stats(self) -> dict:
+        return {**super().stats(), "blocks": self.blocks}
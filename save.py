@@ -0,0 +1,154 @@
+import json
+import mmap
+import os
+from dataclasses import dataclass, field
+from pathlib import Path
+
+# 存档格式 v2 (JSONL):
+# 第一行为头部 {"apai": 2, "model_id": ..., "instr_key": ...}
+# 之后每行一条对话记录 {"role": ..., "content": ..., "time": ...}
+# 对话记录按在存档中的顺序编号, 组成一棵树: 父记录默认为上一条对话记录,
+# 不是时(重试与分支)在行首记录 {"parent": 编号, ...}, 各分支共用前面的记录
+# 摘要记录 {"role": "summary", "content": ..., "covered": ..., "last": ...}
+# 覆盖当前分支的前covered条对话, last为其中最后一条的编号
+# 当前分支记录 {"role": "head", "id": ...}, 与最后一条对话记录相比以后写入的为准
+# JSON会转义换行, 因此记录的偏移表只需按换行符扫描即可得到, 无需解析内容
+SAVE_VERSION = 2
+V1_SENTINEL = "===APaI==="
+SUMMARY_PREFIX = b'{"role": "summary"'
+HEAD_PREFIX = b'{"role": "head"'
+PARENT_PREFIX = b'{"parent": '
+
+
+def header_line(model_id: str, instr_key: str) -> bytes:
+    header = {"apai": SAVE_VERSION, "model_id": model_id, "instr_key": instr_key}
+    return (json.dumps(header, ensure_ascii=False) + "\n").encode()
+
+
+def record_line(
+    role: str,
+    content: str,
+    time: str,
+    parent: int | None = None,
+) -> bytes:
+    record = {"role": role, "content": content, "time": time}
+    if parent is not None:
+        record = {"parent": parent, **record}
+    return (json.dumps(record, ensure_ascii=False) + "\n").encode()
+
+
+# covered为摘要覆盖的对话条数(从头开始), last为其中最后一条对话记录的编号
+def summary_line(summary: str, covered: int, last: int, time: str) -> bytes:
+    record = {
+        "role": "summary",
+        "content": summary,
+        "covered": covered,
+        "last": last,
+        "time": time,
+    }
+    return (json.dumps(record, ensure_ascii=False) + "\n").encode()
+
+
+def head_line(head: int, time: str) -> bytes:
+    record = {"role": "head", "id": head, "time": time}
+    return (json.dumps(record, ensure_ascii=False) + "\n").encode()
+
+
+@dataclass
+class SaveIndex:
+    # 每条对话记录的起始偏移与父记录编号(-1为根)
+    offsets: list[int] = field(default_factory=list)
+    parents: list[int] = field(default_factory=list)
+    # 最后一条完整记录的结束位置
+    size: int = 0
+    # 全部摘要记录的 (偏移, 内容), 按写入顺序
+    summaries: list[tuple[int, bytes]] = field(default_factory=list)
+    # 当前分支最后一条对话记录的编号
+    head: int = -1
+
+
+def is_v1(save_path: Path) -> bool:
+    with save_path.open("rb") as f:
+        return not f.readline().lstrip().startswith(b"{")
+
+
+def read_header(save_path: Path) -> dict:
+    with save_path.open("rb") as f:
+        return json.loads(f.readline())
+
+
+# 扫描存档, 得到对话树的结构与摘要记录, 只解析行首
+def scan_offsets(save_path: Path) -> SaveIndex:
+    index = SaveIndex()
+    if not save_path.exists() or save_path.stat().st_size == 0:
+        return index
+    with save_path.open("rb") as f, mmap.mmap(
+        f.fileno(),
+        0,
+        access=mmap.ACCESS_READ,
+    ) as mm:
+        position = mm.find(b"\n") + 1
+        if position == 0:
+            return index
+        while True:
+            end = mm.find(b"\n", position)
+            if end == -1:
+                break
+            start = mm[position : position + len(SUMMARY_PREFIX)]
+            if start == SUMMARY_PREFIX:
+                index.summaries.append((position, mm[position : end + 1]))
+            elif start.startswith(HEAD_PREFIX):
+                index.head = json.loads(mm[position : end + 1])["id"]
+            else:
+                parent = len(index.offsets) - 1
+                if start.startswith(PARENT_PREFIX):
+                    value = position + len(PARENT_PREFIX)
+                    parent = int(mm[value : mm.find(b",", value)])
+                index.head = len(index.offsets)
+                index.offsets.append(position)
+                index.parents.append(parent)
+            position = end + 1
+    index.size = position
+    return index
+
+
+# 读取从各偏移处开始的一行记录
+def read_records(save_path: Path, offsets: list[int]) -> list[dict]:
+    if not offsets:
+        return []
+    with save_path.open("rb") as f, mmap.mmap(
+        f.fileno(),
+        0,
+        access=mmap.ACCESS_READ,
+    ) as mm:
+        return [json.loads(mm[start : mm.find(b"\n", start)]) for start in offsets]
+
+
+def parse_v1(save_path: Path) -> tuple[str, str, list[dict]]:
+    dialogs = []
+    with save_path.open("r", encoding="utf-8") as f:
+        model_id, instr_key = f.readline().split(", ")
+        f.readline()
+        while True:
+            role = f.readline().strip()
+            if not role:
+                break
+            lines = []
+            while True:
+                line = f.readline()
+                if not line or line.strip() == V1_SENTINEL:
+                    break
+                lines.append(line)
+            dialogs.append({"role": role, "content": "".join(lines).strip()})
+    return model_id.strip(), instr_key.strip(), dialogs
+
+
+# 将v1存档原地转换为v2格式
+def migrate_v1(save_path: Path) -> None:
+    model_id, instr_key, dialogs = parse_v1(save_path)
+    temp_path = save_path.with_suffix(".apai.tmp")
+    with temp_path.open("wb") as f:
+        f.write(header_line(model_id, instr_key))
+        for dialog in dialogs:
+            f.write(record_line(dialog["role"], dialog["content"], ""))
+    os.replace(temp_path, save_path)
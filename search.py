@@ -0,0 +1,274 @@
+from __future__ import annotations
+
+import hashlib
+import re
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from save import is_v1, parse_v1, read_header, read_records, scan_offsets
+
+if TYPE_CHECKING:
+    import sqlite3
+
+SEARCH_PATH = Path("cache") / "search.sqlite"
+# 日志中每条记录以分隔线开头, 见Log.write_header与Log.write_dialog
+LOG_BLOCK = re.compile(r"^(?:-{50}|={50})\n\n", re.MULTILINE)
+SNIPPET_CHARS = 40
+
+
+@dataclass
+class SearchHit:
+    model_id: str
+    time: str
+    role: str
+    save: str | None
+    snippet: str
+
+
+# 基于SQLite FTS5(trigram分词, 支持中文子串)的对话全文索引
+# turns中每条对话以 (role, time, content) 的哈希去重, 同一条对话同时出现在日志与存档中
+# 时只索引一次, save/position指向可以载入的存档与其中的位置
+class SearchIndex:
+    def __init__(self, path: Path = SEARCH_PATH) -> None:
+        self.path = path
+        self._db: sqlite3.Connection | None = None
+        self.error: Exception | None = None
+        # 日志写入器的后台线程与主线程(或服务器的会话线程)共用同一个连接, 逐次加锁
+        self.lock = threading.Lock()
+
+    # 第一次用到时才连接, 通常发生在日志写入器的后台线程中
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self._db is None:
+            import sqlite3
+
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(self.path, check_same_thread=False)
+            db.execute("PRAGMA journal_mode = WAL")
+            db.execute("PRAGMA synchronous = NORMAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS turns ("
+                "id INTEGER PRIMARY KEY, key TEXT UNIQUE, model_id TEXT, role TEXT, "
+                "time TEXT, save TEXT, position INTEGER)",
+            )
+            db.execute(
+                "CREATE INDEX IF NOT EXISTS turns_save ON turns (save, position)",
+            )
+            db.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS entries "
+                "USING fts5(content, tokenize = 'trigram')",
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "path TEXT PRIMARY KEY, size INTEGER, mtime REAL, count INTEGER)",
+            )
+            db.commit()
+            self._db = db
+        return self._db
+
+    # 供日志写入器在后台调用, 索引出错不影响日志与存档的写入
+    def apply(self, name: str, *args: object) -> None:
+        try:
+            with self.lock:
+                getattr(self, name)(*args)
+        except Exception as e:  # noqa: BLE001
+            self.error = e
+
+    @staticmethod
+    def make_key(role: str, content: str, time: str) -> str:
+        return hashlib.sha1(  # noqa: S324
+            f"{role}\0{time}\0{content}".encode(),
+        ).hexdigest()
+
+    def add(
+        self,
+        model_id: str,
+        role: str,
+        content: str,
+        time: str,
+        save: str | None = None,
+        position: int = 0,
+    ) -> None:
+        key = self.make_key(role, content, time)
+        row = self.db.execute("SELECT id FROM turns WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            if save is not None:
+                self.db.execute(
+                    "UPDATE turns SET save = ?, position = ? WHERE id = ?",
+                    (save, position, row[0]),
+                )
+            return
+        cursor = self.db.execute(
+            "INSERT INTO turns (key, model_id, role, time, save, position) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (key, model_id, role, time, save, position),
+        )
+        self.db.execute(
+            "INSERT INTO entries (rowid, content) VALUES (?, ?)",
+            (cursor.lastrowid, content),
+        )
+
+    # 删除存档中第start条及之后的对话(retry/undo截断存档时)
+    def drop(self, save: str, start: int) -> None:
+        ids = self.db.execute(
+            "SELECT id FROM turns WHERE save = ? AND position >= ?",
+            (save, start),
+        ).fetchall()
+        self.db.executemany("DELETE FROM turns WHERE id = ?", ids)
+        self.db.executemany("DELETE FROM entries WHERE rowid = ?", ids)
+
+    # 存档被重写, 原有对话只保留在日志中
+    def detach(self, save: str) -> None:
+        self.db.execute("UPDATE turns SET save = NULL WHERE save = ?", (save,))
+
+    def move(self, old: str, new: str) -> None:
+        self.db.execute("UPDATE turns SET save = ? WHERE save = ?", (new, old))
+
+    def commit(self) -> None:
+        self.db.commit()
+
+    # 扫描logs与saves, 只处理大小或修改时间有变化的文件; 返回 (文件数, 对话数)
+    def reindex(
+        self,
+        log_dir: Path = Path("logs"),
+        save_dir: Path = Path("saves"),
+    ) -> tuple[int, int]:
+        files = 0
+        entries = 0
+        paths = sorted(log_dir.glob("**/*.log")) + sorted(log_dir.glob("**/*.log.gz"))
+        for path in paths + sorted(save_dir.glob("*.apai")):
+            stat = path.stat()
+            with self.lock:
+                row = self.db.execute(
+                    "SELECT size, mtime, count FROM files WHERE path = ?",
+                    (str(path),),
+                ).fetchone()
+                if row is not None and tuple(row[:2]) == (stat.st_size, stat.st_mtime):
+                    continue
+                size, _, count = row or (0, 0, 0)
+                if stat.st_size < size:
+                    size, count = 0, 0
+                if path.suffix == ".apai":
+                    added, count = self.index_save(path, count)
+                else:
+                    # 分段存放在logs/<model_id>/中, 旧版本为logs/<model_id>.log
+                    model_id = str(path.parent.relative_to(log_dir))
+                    if model_id == ".":
+                        model_id = path.name.removesuffix(".log")
+                    added, count = self.index_log(path, size, model_id), 0
+                self.db.execute(
+                    "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                    (str(path), stat.st_size, stat.st_mtime, count),
+                )
+                self.db.commit()
+            files += 1
+            entries += added
+        return files, entries
+
+    # 日志只会追加, 从上次索引到的位置继续解析, 并按[retry]/[undo]标记丢弃被撤回的对话
+    # 压缩的分段不会再变化, 整个解压读取
+    def index_log(self, path: Path, start: int, model_id: str) -> int:
+        if path.suffix == ".gz":
+            import gzip
+
+            with gzip.open(path, "rb") as f:
+                text = f.read().decode("utf-8", errors="replace")
+        else:
+            with path.open("rb") as f:
+                f.seek(start)
+                text = f.read().decode("utf-8", errors="replace")
+        dialogs: list[tuple[str, str, str]] = []
+        for block in LOG_BLOCK.split(text):
+            block = block.strip()  # noqa: PLW2901
+            if block == "[retry]":
+                del dialogs[-1:]
+            elif block == "[undo]":
+                del dialogs[-2:]
+            elif block.startswith("model_id: "):
+                model_id = block.splitlines()[0].removeprefix("model_id: ")
+            else:
+                lines = block.split("\n", 2)
+                if len(lines) == 3 and lines[1].endswith(":"):  # noqa: PLR2004
+                    dialogs.append((lines[1][:-1], lines[2].strip(), lines[0]))
+        for role, content, time in dialogs:
+            self.add(model_id, role, content, time)
+        return len(dialogs)
+
+    # 存档被截断或重写时全部重新索引, 只有追加时才从上次的条数继续
+    def index_save(self, path: Path, count: int) -> tuple[int, int]:
+        save = str(path)
+        if is_v1(path):
+            model_id, _, dialogs = parse_v1(path)
+            records = [{**dialog, "time": ""} for dialog in dialogs]
+            count = 0
+        else:
+            model_id = read_header(path)["model_id"]
+            offsets = scan_offsets(path).offsets
+            if count > len(offsets):
+                count = 0
+            records = read_records(path, offsets[count:])
+        if count == 0:
+            self.detach(save)
+        for i, record in enumerate(records, count):
+            role, content, time = record["role"], record["content"], record["time"]
+            self.add(model_id, role, content, time, save, i)
+        return len(records), count + len(records)
+
+    def search(self, query: str, limit: int = 20) -> list[SearchHit]:
+        # trigram分词要求每个词至少3个字符, 更短的词退回逐条的子串匹配
+        # 按写入顺序从新到旧返回, FTS5取够limit条即可停止, 无需为全部匹配排序
+        terms = query.split()
+        long_terms = [t for t in terms if len(t) >= 3]  # noqa: PLR2004
+        conditions = []
+        params: list[object] = []
+        if long_terms:
+            conditions.append("entries MATCH ?")
+            params.append(
+                " ".join('"' + t.replace('"', '""') + '"' for t in long_terms),
+            )
+        for term in terms:
+            if len(term) < 3:  # noqa: PLR2004
+                conditions.append("instr(lower(entries.content), ?) > 0")
+                params.append(term.lower())
+        if not conditions:
+            return []
+        snippet = (
+            "snippet(entries, 0, '[', ']', '…', 16)"
+            if long_terms
+            else "entries.content"
+        )
+        sql = (
+            "SELECT turns.model_id, turns.time, turns.role, turns.save, "  # noqa: S608
+            f"{snippet} FROM entries JOIN turns ON turns.id = entries.rowid "
+            f"WHERE {' AND '.join(conditions)} ORDER BY entries.rowid DESC LIMIT ?"
+        )
+        with self.lock:
+            rows = self.db.execute(sql, (*params, limit)).fetchall()
+        hits = []
+        for model_id, time, role, save, text in rows:
+            if not long_terms:
+                text = self.make_snippet(text, terms[0])  # noqa: PLW2901
+            hits.append(SearchHit(model_id, time, role, save, text))
+        return hits
+
+    @staticmethod
+    def make_snippet(content: str, term: str) -> str:
+        index = content.lower().find(term.lower())
+        start = max(index - SNIPPET_CHARS, 0)
+        end = index + len(term)
+        snippet = (
+            content[start:index]
+            + f"[{content[index:end]}]"
+            + content[end : end + SNIPPET_CHARS]
+        )
+        prefix = "…" if start > 0 else ""
+        suffix = "…" if end + SNIPPET_CHARS < len(content) else ""
+        return prefix + snippet + suffix
+
+    def close(self) -> None:
+        with self.lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
@@ -0,0 +1,214 @@
+from __future__ import annotations
+
+import json
+import os
+import threading
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from writer import LogWriter
+
+MANIFEST_NAME = "manifest.json"
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+NAME_FORMAT = "%Y%m%d-%H%M%S"
+
+
+@dataclass
+class Segment:
+    file: str
+    start: str
+    end: str = ""
+    # 未压缩的大小与磁盘上的实际大小
+    size: int = 0
+    stored: int = 0
+
+    @property
+    def compressed(self) -> bool:
+        return self.file.endswith(".gz")
+
+
+# 每个模型的日志按大小或日期切分为多个分段, 存放在logs/<model_id>/中
+# 只有最后一个分段在写入, 关闭的分段在后台线程中gzip压缩
+# manifest.json记录每个分段的起止时间与大小, 按日期查找时不必解压
+class LogStore:
+    def __init__(
+        self,
+        directory: Path,
+        segment_mb: int = 4,
+        segment_days: int = 1,
+        keep_mb: int = 0,
+        keep_days: int = 0,
+    ) -> None:
+        self.directory = directory
+        self.max_size = max(segment_mb, 1) * 1024 * 1024
+        self.segment_days = segment_days
+        self.keep_mb = keep_mb
+        self.keep_days = keep_days
+        self.lock = threading.Lock()
+        self.manifest_path = directory / MANIFEST_NAME
+        self.segments: list[Segment] = []
+        if self.manifest_path.exists():
+            with self.manifest_path.open("r", encoding="utf-8") as f:
+                self.segments = [Segment(**s) for s in json.load(f)["segments"]]
+        self.adopt_legacy(directory.with_suffix(".log"))
+        if not self.segments or self.segments[-1].end:
+            self.new_segment(datetime.now())
+        current = self.segments[-1]
+        # 当前分段的路径在每次写入时都会用到, 只在切换分段时更新
+        self.current = directory / current.file
+        self.current_size = (
+            self.current.stat().st_size if self.current.exists() else 0
+        )
+        self.start_date = datetime.strptime(current.start, TIME_FORMAT).date()
+        # 上次运行中关闭但还没来得及压缩的分段
+        for segment in self.segments[:-1]:
+            if not segment.compressed:
+                self.compress_later(segment)
+
+    def save_manifest(self) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        temp_path = self.manifest_path.with_suffix(".tmp")
+        with temp_path.open("w", encoding="utf-8") as f:
+            json.dump({"segments": [asdict(s) for s in self.segments]}, f, indent=1)
+        os.replace(temp_path, self.manifest_path)
+
+    # 把旧版本的 logs/<model_id>.log 作为一个已关闭的分段并入
+    def adopt_legacy(self, legacy_path: Path) -> None:
+        if not legacy_path.is_file():
+            return
+        modified = datetime.fromtimestamp(legacy_path.stat().st_mtime)
+        name = f"{modified.strftime(NAME_FORMAT)}-legacy.log"
+        self.directory.mkdir(parents=True, exist_ok=True)
+        os.replace(legacy_path, self.directory / name)
+        size = (self.directory / name).stat().st_size
+        segment = Segment(name, "", modified.strftime(TIME_FORMAT), size, size)
+        with self.lock:
+            self.segments.insert(0, segment)
+            self.save_manifest()
+
+    def new_segment(self, now: datetime) -> None:
+        name = f"{now.strftime(NAME_FORMAT)}.log"
+        if any(s.file.startswith(name) for s in self.segments):
+            name = f"{now.strftime(NAME_FORMAT)}-{len(self.segments)}.log"
+        with self.lock:
+            self.segments.append(Segment(name, now.strftime(TIME_FORMAT)))
+            self.save_manifest()
+        self.current = self.directory / name
+        self.current_size = 0
+        self.start_date = now.date()
+
+    def should_rotate(self, incoming: int, now: datetime) -> bool:
+        if self.current_size == 0:
+            return False
+        if self.current_size + incoming > self.max_size:
+            return True
+        if self.segment_days > 0:
+            return (now.date() - self.start_date).days >= self.segment_days
+        return False
+
+    # 写入一段日志, 必要时先切换到新分段; 空分段以header开头, 以便单独阅读
+    def write(self, writer: LogWriter, text: str, header: str = "") -> None:
+        data = text.encode()
+        now = datetime.now()
+        if self.should_rotate(len(data), now):
+            self.rotate(writer, now)
+        if header and self.current_size == 0:
+            self.append(writer, header.encode())
+        self.append(writer, data)
+
+    def append(self, writer: LogWriter, data: bytes) -> None:
+        writer.write(self.current, data)
+        self.current_size += len(data)
+
+    def rotate(self, writer: LogWriter, now: datetime) -> None:
+        segment = self.segments[-1]
+        with self.lock:
+            segment.end = now.strftime(TIME_FORMAT)
+            segment.size = segment.stored = self.current_size
+        old_path = self.current
+        self.new_segment(now)
+        # 写入器处理完旧分段的全部写入并关闭文件后才开始压缩
+        writer.release(old_path, wait=False)
+        writer.call(self.compress_later, segment)
+
+    def compress_later(self, segment: Segment) -> None:
+        threading.Thread(
+            target=self.compress,
+            args=(segment,),
+            name="LogCompress",
+            daemon=True,
+        ).start()
+
+    # 先写临时文件再替换, 中途退出时原分段保持完整, 下次启动重新压缩
+    def compress(self, segment: Segment) -> None:
+        import gzip
+        import shutil
+
+        path = self.directory / segment.file
+        if not path.exists():
+            return
+        gz_path = path.with_name(path.name + ".gz")
+        temp_path = path.with_name(path.name + ".gz.tmp")
+        with path.open("rb") as src, gzip.open(temp_path, "wb") as dst:
+            shutil.copyfileobj(src, dst, 1 << 20)
+        os.replace(temp_path, gz_path)
+        with self.lock:
+            segment.file = gz_path.name
+            segment.size = path.stat().st_size
+            segment.stored = gz_path.stat().st_size
+            self.save_manifest()
+        path.unlink()
+        if self.keep_mb > 0 or self.keep_days > 0:
+            self.clean(self.keep_days, self.keep_mb)
+
+    # 删除超过max_days天或超出max_mb总大小的最旧分段, 当前分段不删除; 返回删除的个数
+    def clean(self, max_days: int = 0, max_mb: int = 0) -> int:
+        removed = []
+        with self.lock:
+            # 还未压缩完成的分段留到下一次
+            closed = [s for s in self.segments[:-1] if s.compressed]
+            if max_days > 0:
+                limit = datetime.now() - timedelta(days=max_days)
+                limit_text = limit.strftime(TIME_FORMAT)
+                removed += [s for s in closed if s.end < limit_text]
+            if max_mb > 0:
+                total = sum(s.stored for s in self.segments) + self.current_size
+                for segment in closed:
+                    if total <= max_mb * 1024 * 1024:
+                        break
+                    if segment not in removed:
+                        removed.append(segment)
+                    total -= segment.stored
+            for segment in removed:
+                (self.directory / segment.file).unlink(missing_ok=True)
+            self.segments = [s for s in self.segments if s not in removed]
+            self.save_manifest()
+        return len(removed)
+
+    # 删除全部分段(含当前分段), 之后从新分段开始写入
+    def clear(self, writer: LogWriter) -> None:
+        writer.remove(self.current)
+        writer.flush()
+        with self.lock:
+            for segment in self.segments[:-1]:
+                (self.directory / segment.file).unlink(missing_ok=True)
+            self.segments = []
+        self.new_segment(datetime.now())
+
+    # 查找与 [start, end] 日期区间有重叠的分段, 日期格式为YYYY-MM-DD
+    def find(self, start: str, end: str = "") -> list[Segment]:
+        end = (end or start) + " 99"
+        now = datetime.now().strftime(TIME_FORMAT)
+        with self.lock:
+            return [
+                s
+                for s in self.segments
+                if (s.start or "") <= end and (s.end or now) >= start
+            ]
+
+    def total_size(self) -> int:
+        with self.lock:
+            return sum(s.stored for s in self.segments[:-1]) + self.current_size
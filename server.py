@@ -0,0 +1,752 @@
+from __future__ import annotations
+
+import asyncio
+import base64
+import contextlib
+import hashlib
+import json
+import secrets
+import shutil
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import TYPE_CHECKING
+from urllib.parse import urlsplit
+
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, OpenAIError
+from rich.console import Console
+
+from agent import chunk_delta
+from environment import connection_limits
+from metrics import TurnMetrics
+from save import read_header
+
+if TYPE_CHECKING:
+    from collections.abc import Awaitable, Callable
+
+    from agent import Agent
+    from environment import Environment
+
+    Send = Callable[[dict], Awaitable[None]]
+
+SESSION_DIR = Path("saves") / "sessions"
+MAX_BODY = 64 * 1024 * 1024
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+STATUS_TEXT = {
+    101: "Switching Protocols",
+    200: "OK",
+    201: "Created",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    409: "Conflict",
+    413: "Payload Too Large",
+    502: "Bad Gateway",
+}
+# 会话线程中的提示信息不输出
+QUIET = Console(quiet=True)
+
+
+class HttpError(Exception):
+    def __init__(self, status: int, message: str) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+@dataclass
+class Request:
+    method: str
+    path: str
+    headers: dict[str, str]
+    body: bytes
+
+    def json(self) -> dict:
+        if not self.body:
+            return {}
+        try:
+            data = json.loads(self.body)
+        except ValueError as e:
+            raise HttpError(400, f"invalid JSON: {e}") from e
+        if not isinstance(data, dict):
+            raise HttpError(400, "expected a JSON object")
+        return data
+
+
+async def read_request(reader: asyncio.StreamReader) -> Request | None:
+    line = await reader.readline()
+    if not line.strip():
+        return None
+    try:
+        method, target, _ = line.decode("latin-1").split(" ", 2)
+    except ValueError as e:
+        raise HttpError(400, "malformed request line") from e
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get("content-length", 0) or 0)
+    except ValueError as e:
+        raise HttpError(400, "malformed Content-Length") from e
+    if length < 0:
+        raise HttpError(400, "malformed Content-Length")
+    if length > MAX_BODY:
+        raise HttpError(413, "request body too large")
+    body = await reader.readexactly(length) if length else b""
+    return Request(method.upper(), urlsplit(target).path, headers, body)
+
+
+def response_head(status: int, headers: dict[str, str | int]) -> bytes:
+    lines = [f"HTTP/1.1 {status} {STATUS_TEXT.get(status, '')}"]
+    lines += [f"{name}: {value}" for name, value in headers.items()]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+async def send_json(writer: asyncio.StreamWriter, status: int, body: object) -> None:
+    data = json.dumps(body, ensure_ascii=False).encode()
+    writer.write(
+        response_head(
+            status,
+            {"Content-Type": "application/json", "Content-Length": len(data)},
+        )
+        + data,
+    )
+    await writer.drain()
+
+
+# WebSocket(RFC 6455)只实现文本帧、分片、ping与close
+def websocket_frame(opcode: int, payload: bytes) -> bytes:
+    length = len(payload)
+    if length < 126:  # noqa: PLR2004
+        head = struct.pack("!BB", 0x80 | opcode, length)
+    elif length < 1 << 16:
+        head = struct.pack("!BBH", 0x80 | opcode, 126, length)
+    else:
+        head = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+    return head + payload
+
+
+async def read_frame(reader: asyncio.StreamReader) -> tuple[bool, int, bytes]:
+    first, second = await reader.readexactly(2)
+    length = second & 0x7F
+    if length == 126:  # noqa: PLR2004
+        (length,) = struct.unpack("!H", await reader.readexactly(2))
+    elif length == 127:  # noqa: PLR2004
+        (length,) = struct.unpack("!Q", await reader.readexactly(8))
+    if length > MAX_BODY:
+        raise HttpError(413, "frame too large")
+    mask = await reader.readexactly(4) if second & 0x80 else b""
+    payload = await reader.readexactly(length)
+    if mask and payload:
+        # 整段异或, 比逐字节快得多
+        repeated = (mask * (length // 4 + 1))[:length]
+        payload = (
+            int.from_bytes(payload, "big") ^ int.from_bytes(repeated, "big")
+        ).to_bytes(length, "big")
+    return bool(first & 0x80), first & 0x0F, payload
+
+
+# 读取一条完整的消息, 返回 (opcode, 内容); 控制帧原样返回
+async def read_message(reader: asyncio.StreamReader) -> tuple[int, bytes]:
+    fin, opcode, payload = await read_frame(reader)
+    parts = [payload]
+    while not fin:
+        fin, _, payload = await read_frame(reader)
+        parts.append(payload)
+    return opcode, b"".join(parts)
+
+
+def parse_context(value: object, default: tuple[int, int]) -> tuple[int, int]:
+    if value is None or value == "":
+        return default
+    text = str(value).strip().lower()
+    try:
+        if text.endswith("k"):
+            return default[0], int(float(text[:-1]) * 1000)
+        return int(text), 0
+    except ValueError as e:
+        raise HttpError(400, f"invalid context '{value}'") from e
+
+
+# 会话的设置与状态; agent为None时会话已被换出内存, 对话只保存在存档中
+@dataclass
+class Session:
+    id: str
+    model_id: str
+    instr_key: str
+    context_len: int
+    context_tokens: int = 0
+    agent: Agent | None = None
+    dialogs: int = 0
+    last_used: float = field(default_factory=time.monotonic)
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+
+    @property
+    def save_path(self) -> Path:
+        return SESSION_DIR / f"{self.id}.apai"
+
+    # 存档头只记录模型与指令, 上下文设置另存一个小文件, 重启或换出后按它恢复
+    @property
+    def settings_path(self) -> Path:
+        return SESSION_DIR / f"{self.id}.json"
+
+    def write_settings(self) -> None:
+        SESSION_DIR.mkdir(parents=True, exist_ok=True)
+        settings = {
+            "context_len": self.context_len,
+            "context_tokens": self.context_tokens,
+        }
+        self.settings_path.write_text(json.dumps(settings), encoding="utf-8")
+
+    def info(self) -> dict:
+        return {
+            "id": self.id,
+            "model_id": self.model_id,
+            "instr_key": self.instr_key,
+            "context_len": self.context_len,
+            "context_tokens": self.context_tokens,
+            "dialogs": self.agent.dialog_count if self.agent else self.dialogs,
+            "loaded": self.agent is not None,
+            "busy": self.lock.locked(),
+        }
+
+
+# 本地多会话服务: 所有会话共用客户端、指令、日志写入器、缓存与搜索索引
+# 请求以异步方式流式转发; Agent的上下文、日志与缓存操作不是线程安全的,
+# 全部交给同一个线程依次执行, 不阻塞事件循环
+class Server:
+    def __init__(self, env: Environment, idle_seconds: float) -> None:
+        self.env = env
+        self.idle_seconds = idle_seconds
+        self.sessions: dict[str, Session] = {}
+        self.clients: dict[tuple[str, str], AsyncOpenAI] = {}
+        self.state = ThreadPoolExecutor(1, thread_name_prefix="session")
+        self.streams = 0
+
+    async def run_state(self, func: Callable[..., object], *args: object) -> object:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.state, func, *args)
+
+    def client(self, url: str, api: str) -> AsyncOpenAI:
+        client = self.clients.get((url, api))
+        if client is None:
+            client = AsyncOpenAI(
+                api_key=api,
+                base_url=url,
+                timeout=1800,
+                http_client=DefaultAsyncHttpxClient(
+                    limits=connection_limits(
+                        max_connections=1000,
+                        max_keepalive_connections=100,
+                    ),
+                    timeout=1800,
+                ),
+            )
+            self.clients[(url, api)] = client
+        return client
+
+    # ---- 会话管理 ----
+    def create_session(self, options: dict) -> Session:
+        config = self.env.config
+        model_id = config.model_id
+        if options.get("model"):
+            model_id = self.env.match_model_id(options["model"])
+        if not model_id or self.env.find_api(model_id) is None:
+            raise HttpError(400, f"model '{options.get('model', '')}' not found")
+        instr_key = config.instr_key
+        if options.get("instr"):
+            instr_key = self.env.match_instr_key(options["instr"])
+            if not instr_key:
+                raise HttpError(400, f"instruction '{options['instr']}' not found")
+        context_len, context_tokens = parse_context(
+            options.get("context"),
+            (config.context_len, config.context_tokens),
+        )
+        session = Session(
+            secrets.token_hex(8),
+            model_id,
+            instr_key,
+            context_len,
+            context_tokens,
+        )
+        session.write_settings()
+        self.sessions[session.id] = session
+        return session
+
+    # 内存中没有时从 saves/sessions/<id>.apai 恢复
+    def get_session(self, session_id: str) -> Session:
+        session = self.sessions.get(session_id)
+        if session is not None:
+            return session
+        path = SESSION_DIR / f"{session_id}.apai"
+        if not session_id.isalnum() or not path.is_file():
+            raise HttpError(404, f"session '{session_id}' not found")
+        header = read_header(path)
+        config = self.env.config
+        session = Session(
+            session_id,
+            header["model_id"],
+            header["instr_key"],
+            config.context_len,
+            config.context_tokens,
+        )
+        # 没有设置文件(旧版本创建的会话)时沿用配置中的上下文
+        with contextlib.suppress(OSError, ValueError, KeyError):
+            settings = json.loads(session.settings_path.read_text(encoding="utf-8"))
+            session.context_len = int(settings["context_len"])
+            session.context_tokens = int(settings["context_tokens"])
+        self.sessions[session_id] = session
+        return session
+
+    # 以下方法在会话线程中执行
+    def load_agent(self, session: Session) -> Agent:
+        if session.agent is None:
+            self.env.writer.release(session.save_path)
+            agent = self.env.create_agent(
+                session.model_id,
+                session.instr_key,
+                session.context_len,
+                session.context_tokens,
+                save_path=session.save_path,
+                warm_up=False,
+            )
+            if session.save_path.is_file():
+                agent.attach_save(session.save_path)
+            session.agent = agent
+        return session.agent
+
+    def evict(self, session: Session) -> None:
+        agent = session.agent
+        if agent is None:
+            return
+        session.agent = None
+        session.dialogs = agent.dialog_count
+        if agent.summarizer is not None:
+            agent.summarizer.cancel()
+        # 关闭存档的文件句柄, 数百个会话也不会耗尽句柄
+        self.env.writer.release(agent.log.save_path)
+
+    def prepare_chat(self, agent: Agent, content: str) -> tuple[list, object]:
+        messages = agent.begin_chat(content, QUIET)
+        cached = agent.lookup_cache(messages)
+        agent.log.write_dialog("user", content)
+        return messages, cached
+
+    def prepare_retry(self, agent: Agent) -> tuple[list, object]:
+        messages = agent.begin_retry()
+        return messages, agent.lookup_cache(messages, use_cache=False)
+
+    # 各分支的编号、轮数与最后一个问题
+    def tree(self, agent: Agent) -> dict:
+        log = agent.log
+        paths = [log.branch_path(leaf) for leaf in agent.branches()]
+        # 分支上的记录从提问开始一问一答交替
+        asks = log.read_nodes([path[(len(path) - 1) // 2 * 2] for path in paths])
+        return {
+            "branches": [
+                {
+                    "branch": number,
+                    "turns": (len(path) + 1) // 2,
+                    "current": path[-1] == log.head,
+                    "ask": ask["content"],
+                }
+                for number, (path, ask) in enumerate(zip(paths, asks), 1)
+            ],
+        }
+
+    def save_copy(self, session: Session, name: str) -> Path:
+        path = Path("saves") / f"{name}.apai"
+        self.env.writer.flush()
+        if not session.save_path.is_file():
+            raise HttpError(409, "nothing to save yet")
+        shutil.copy(session.save_path, path)
+        return path
+
+    # 用已有存档替换会话的内容, 会话的模型与指令随存档改变
+    def load_copy(self, session: Session, name: str) -> None:
+        path = Path("saves") / f"{name}.apai"
+        if not path.is_file():
+            raise HttpError(404, f"save '{name}' not found")
+        self.evict(session)
+        self.env.writer.release(session.save_path)
+        SESSION_DIR.mkdir(parents=True, exist_ok=True)
+        shutil.copy(path, session.save_path)
+        header = read_header(session.save_path)
+        session.model_id = header["model_id"]
+        session.instr_key = header["instr_key"]
+        self.load_agent(session)
+
+    # ---- 对话 ----
+    async def stream_answer(
+        self,
+        agent: Agent,
+        messages: list,
+        cached: tuple[str, str] | None,
+        send: Send,
+    ) -> str:
+        content: list[str] = []
+        reasoning: list[str] = []
+        agent.interrupted = False
+        try:
+            if cached is not None:
+                reasoning.append(cached[0])
+                content.append(cached[1])
+                await send({"type": "reasoning", "text": cached[0]})
+                await send({"type": "content", "text": cached[1]})
+            else:
+                api = self.env.api_dict[agent.api_provider]
+                metrics = TurnMetrics(agent.api_provider, agent.model_id)
+                agent.turn_metrics = metrics
+                stream = await self.client(api.url, api.api).chat.completions.create(
+                    messages=messages,
+                    **agent.request_options(),
+                )
+                self.streams += 1
+                try:
+                    async for chunk in stream:
+                        delta = chunk_delta(chunk, metrics)
+                        if delta is None:
+                            continue
+                        kind, text = delta
+                        (reasoning if kind == "reasoning" else content).append(text)
+                        await send({"type": kind, "text": text})
+                finally:
+                    self.streams -= 1
+                    await stream.close()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            # 客户端断开, 与Ctrl-C一样保留已收到的部分
+            agent.interrupted = True
+        agent.last_reasoning = "".join(reasoning)
+        return "".join(content) + "\n"
+
+    async def answer(
+        self,
+        session: Session,
+        agent: Agent,
+        prepared: tuple[list, object],
+        send: Send,
+        *,
+        retry: bool = False,
+    ) -> None:
+        messages, cached = prepared
+        try:
+            answer = await self.stream_answer(agent, messages, cached, send)
+        except OpenAIError as e:
+            if retry:
+                await self.run_state(agent.restore_answer)
+            else:
+                await self.run_state(agent.drop_question)
+            await send({"type": "error", "message": str(e)})
+            return
+        await self.run_state(agent.finish_answer, answer)
+        session.last_used = time.monotonic()
+        metrics = agent.turn_metrics
+        usage = metrics is not None and not agent.cache_hit
+        with contextlib.suppress(ConnectionError):
+            await send(
+                {
+                    "type": "end",
+                    "answer": answer,
+                    "cached": agent.cache_hit,
+                    "interrupted": agent.interrupted,
+                    "dialogs": agent.dialog_count,
+                    "prompt_tokens": metrics.prompt_tokens if usage else None,
+                    "cached_tokens": metrics.cached_tokens if usage else None,
+                },
+            )
+
+    # HTTP与WebSocket共用的操作; chat与retry通过send流式返回, 其余返回结果
+    async def act(
+        self,
+        session: Session,
+        action: str,
+        options: dict,
+        send: Send,
+    ) -> dict | None:
+        if session.lock.locked():
+            raise HttpError(409, "session is busy")
+        # 其余操作在释放锁之后返回会话信息, 附带extra
+        extra: dict = {}
+        async with session.lock:
+            session.last_used = time.monotonic()
+            agent = await self.run_state(self.load_agent, session)
+            if action == "chat":
+                ask = options.get("ask", "")
+                file = options.get("file", "")
+                if not isinstance(ask, str) or not ask.strip():
+                    raise HttpError(400, "'ask' is required")
+                if file:
+                    file = f"[file content]\n{file}\n\n"
+                prepared = await self.run_state(self.prepare_chat, agent, file + ask)
+                await self.answer(session, agent, prepared, send)
+                return None
+            if action == "retry":
+                if agent.dialog_count == 0:
+                    raise HttpError(409, "no dialog to retry")
+                prepared = await self.run_state(self.prepare_retry, agent)
+                await self.answer(session, agent, prepared, send, retry=True)
+                return None
+            if action == "undo":
+                if agent.dialog_count == 0:
+                    raise HttpError(409, "no dialog to undo")
+                await self.run_state(agent.undo, QUIET)
+            elif action == "reset":
+                await self.run_state(agent.reset_message)
+            elif action == "tree":
+                extra = await self.run_state(self.tree, agent)
+            elif action == "checkout":
+                branches = agent.branches()
+                number = options.get("branch")
+                if not isinstance(number, int) or not 1 <= number <= len(branches):
+                    raise HttpError(400, f"'branch' must be 1-{len(branches)}")
+                await self.run_state(agent.checkout, branches[number - 1])
+            elif action == "branch":
+                turn = options.get("turn")
+                if agent.dialog_count == 0:
+                    raise HttpError(409, "no dialog to branch from")
+                if not isinstance(turn, int) or not await self.run_state(
+                    agent.fork,
+                    turn,
+                ):
+                    raise HttpError(400, f"'turn' must be 0-{agent.dialog_count - 1}")
+            elif action == "save":
+                name = self.save_name(options)
+                path = await self.run_state(self.save_copy, session, name)
+                return {"saved": str(path)}
+            elif action == "load":
+                name = self.save_name(options)
+                await self.run_state(self.load_copy, session, name)
+            elif action != "info":
+                raise HttpError(404, f"unknown action '{action}'")
+        return {**session.info(), **extra}
+
+    @staticmethod
+    def save_name(options: dict) -> str:
+        name = str(options.get("name", ""))
+        if not name or Path(name).name != name:
+            raise HttpError(400, "a plain save 'name' is required")
+        return name
+
+    # 定期把长时间空闲的会话换出内存, 只保留设置
+    async def evict_idle(self) -> None:
+        interval = max(min(self.idle_seconds / 2, 60), 1)
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            for session in list(self.sessions.values()):
+                if (
+                    session.agent is not None
+                    and not session.lock.locked()
+                    and now - session.last_used > self.idle_seconds
+                ):
+                    await self.run_state(self.evict, session)
+
+    # ---- HTTP ----
+    async def handle(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+    ) -> None:
+        try:
+            while True:
+                request = None
+                try:
+                    request = await read_request(reader)
+                    if request is None:
+                        break
+                    keep_alive = await self.route(request, reader, writer)
+                except HttpError as e:
+                    await send_json(writer, e.status, {"error": str(e)})
+                    # 请求本身无法解析(或请求体过大未读取)时, 之后的字节无法分帧, 关闭连接
+                    keep_alive = request is not None
+                if not keep_alive or request.headers.get("connection") == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+            with contextlib.suppress(ConnectionError):
+                await writer.wait_closed()
+
+    # 返回是否保持连接; 流式响应与WebSocket结束后关闭连接
+    async def route(
+        self,
+        request: Request,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+    ) -> bool:
+        parts = [part for part in request.path.split("/") if part]
+        method = request.method
+        if parts == ["sessions"]:
+            if method == "GET":
+                await send_json(
+                    writer,
+                    200,
+                    [session.info() for session in self.sessions.values()],
+                )
+            elif method == "POST":
+                session = self.create_session(request.json())
+                await send_json(writer, 201, session.info())
+            else:
+                raise HttpError(405, "use GET or POST")
+            return True
+        if parts == ["status"]:
+            await send_json(
+                writer,
+                200,
+                {
+                    "sessions": len(self.sessions),
+                    "loaded": sum(s.agent is not None for s in self.sessions.values()),
+                    "streams": self.streams,
+                },
+            )
+            return True
+        if len(parts) < 2 or parts[0] != "sessions":  # noqa: PLR2004
+            raise HttpError(404, f"no route for {request.path}")
+        session = self.get_session(parts[1])
+        if len(parts) == 2:  # noqa: PLR2004
+            if method == "GET":
+                await send_json(writer, 200, session.info())
+            elif method == "DELETE":
+                if session.lock.locked():
+                    raise HttpError(409, "session is busy")
+                await self.run_state(self.evict, session)
+                del self.sessions[session.id]
+                await send_json(writer, 200, {"closed": session.id})
+            else:
+                raise HttpError(405, "use GET or DELETE")
+            return True
+        action = parts[2]
+        if action == "ws":
+            await self.websocket(session, request, reader, writer)
+            return False
+        if method != "POST":
+            raise HttpError(405, "use POST")
+        if action in ("chat", "retry"):
+            await self.event_stream(session, action, request.json(), writer)
+            return False
+        result = await self.act(session, action, request.json(), self.no_events)
+        await send_json(writer, 200, result)
+        return True
+
+    @staticmethod
+    async def no_events(event: dict) -> None:
+        pass
+
+    # 以Server-Sent Events返回增量, 每个事件为一行JSON
+    async def event_stream(
+        self,
+        session: Session,
+        action: str,
+        options: dict,
+        writer: asyncio.StreamWriter,
+    ) -> None:
+        started = False
+
+        async def send(event: dict) -> None:
+            nonlocal started
+            if not started:
+                writer.write(
+                    response_head(
+                        200,
+                        {
+                            "Content-Type": "text/event-stream",
+                            "Cache-Control": "no-cache",
+                            "Connection": "close",
+                        },
+                    ),
+                )
+                started = True
+            data = json.dumps(event, ensure_ascii=False)
+            writer.write(f"data: {data}\n\n".encode())
+            await writer.drain()
+
+        await self.act(session, action, options, send)
+        if not started:
+            await send({"type": "end"})
+
+    async def websocket(
+        self,
+        session: Session,
+        request: Request,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+    ) -> None:
+        key = request.headers.get("sec-websocket-key", "")
+        if request.headers.get("upgrade", "").lower() != "websocket" or not key:
+            raise HttpError(400, "expected a WebSocket upgrade")
+        accept = base64.b64encode(
+            hashlib.sha1((key + WS_GUID).encode()).digest(),  # noqa: S324
+        ).decode()
+        writer.write(
+            response_head(
+                101,
+                {
+                    "Upgrade": "websocket",
+                    "Connection": "Upgrade",
+                    "Sec-WebSocket-Accept": accept,
+                },
+            ),
+        )
+        await writer.drain()
+
+        async def send(event: dict) -> None:
+            data = json.dumps(event, ensure_ascii=False).encode()
+            writer.write(websocket_frame(0x1, data))
+            await writer.drain()
+
+        while True:
+            opcode, payload = await read_message(reader)
+            if opcode == 0x8:  # noqa: PLR2004
+                writer.write(websocket_frame(0x8, payload[:2]))
+                await writer.drain()
+                return
+            if opcode == 0x9:  # noqa: PLR2004
+                writer.write(websocket_frame(0xA, payload))
+                await writer.drain()
+                continue
+            if opcode != 0x1:
+                continue
+            try:
+                options = Request("", "", {}, payload).json()
+                result = await self.act(
+                    session,
+                    str(options.get("action", "")),
+                    options,
+                    send,
+                )
+                if result is not None:
+                    await send({"type": "result", **result})
+            except HttpError as e:
+                await send({"type": "error", "status": e.status, "message": str(e)})
+
+    async def close(self) -> None:
+        for session in list(self.sessions.values()):
+            await self.run_state(self.evict, session)
+        for client in self.clients.values():
+            await client.close()
+        self.state.shutdown()
+
+
+async def serve(
+    env: Environment,
+    host: str,
+    port: int,
+    idle_seconds: float,
+    console: Console,
+) -> None:
+    server = Server(env, idle_seconds)
+    listener = await asyncio.start_server(server.handle, host, port, limit=MAX_BODY)
+    evictor = asyncio.create_task(server.evict_idle())
+    console.print(f"Serving on http://{host}:{port}", style="bold green")
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        evictor.cancel()
+        await server.close()
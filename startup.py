@@ -0,0 +1,116 @@
+import json
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+from rich.console import Console
+from rich.table import Table
+
+# 从启动进程到出现 "> " 提示符的时间预算(毫秒)
+STARTUP_BUDGET_MS = 400
+PROMPT_MARKER = "[apai-prompt-ready]"
+HISTORY_PATH = Path("logs") / "startup.jsonl"
+APAI_PATH = Path(__file__).with_name("APaI.py")
+
+
+# 启动一个子进程运行到提示符为止, 返回耗时(毫秒)与子进程的stderr
+def time_to_prompt(*python_flags: str) -> tuple[float | None, str]:
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, *python_flags, str(APAI_PATH), "--exit-at-prompt"],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        encoding="utf-8",
+    )
+    elapsed = None
+    for line in process.stdout:
+        if PROMPT_MARKER in line:
+            elapsed = (time.perf_counter() - start) * 1000
+            break
+    process.stdout.close()
+    _, stderr = process.communicate()
+    return elapsed, stderr
+
+
+# 解析 -X importtime 的输出, 返回累计耗时最多的顶层模块
+def slowest_imports(importtime: str, count: int = 10) -> list[tuple[str, int]]:
+    imports = []
+    for line in importtime.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        # 只统计顶层导入(模块名前没有额外缩进)
+        if cumulative.strip().isdigit() and not name.startswith("   "):
+            imports.append((name.strip(), int(cumulative)))
+    imports.sort(key=lambda item: item[1], reverse=True)
+    return imports[:count]
+
+
+def git_commit() -> str:
+    try:
+        result = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],  # noqa: S607
+            capture_output=True,
+            text=True,
+            check=False,
+            cwd=APAI_PATH.parent,
+        )
+    except OSError:
+        return ""
+    return result.stdout.strip()
+
+
+def profile_startup(console: Console, runs: int = 5) -> None:
+    samples = []
+    for _ in range(runs):
+        elapsed, stderr = time_to_prompt()
+        if elapsed is None:
+            console.print("APaI exited before showing the prompt:", style="red")
+            console.print(stderr)
+            return
+        samples.append(elapsed)
+    _, importtime = time_to_prompt("-X", "importtime")
+    median = statistics.median(samples)
+
+    # 后台线程中的导入(如openai)同样会出现在这里, 但不在提示符之前的关键路径上
+    table = Table(
+        show_header=True,
+        header_style="bold magenta",
+        caption="includes imports done in background threads",
+    )
+    table.add_column("Module")
+    table.add_column("Cumulative import (ms)", justify="right")
+    for name, microseconds in slowest_imports(importtime):
+        table.add_row(name, f"{microseconds / 1000:.1f}")
+    console.print(table)
+
+    within = median <= STARTUP_BUDGET_MS
+    console.print(
+        f"time to prompt: {median:.0f} ms (median of {runs}, "
+        f"min {min(samples):.0f} ms), budget {STARTUP_BUDGET_MS} ms",
+        style="green" if within else "bold red",
+    )
+
+    HISTORY_PATH.parent.mkdir(parents=True, exist_ok=True)
+    history = []
+    if HISTORY_PATH.exists():
+        with HISTORY_PATH.open("r", encoding="utf-8") as f:
+            history = [json.loads(line) for line in f if line.strip()]
+    record = {
+        "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "commit": git_commit(),
+        "median_ms": round(median, 1),
+        "budget_ms": STARTUP_BUDGET_MS,
+    }
+    with HISTORY_PATH.open("a", encoding="utf-8") as f:
+        f.write(json.dumps(record) + "\n")
+    for past in [*history[-4:], record]:
+        console.print(
+            f"  {past['time']}  {past['commit'] or '-':>8}  {past['median_ms']} ms",
+            style="dim green",
+        )
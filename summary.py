@@ -0,0 +1,95 @@
+from __future__ import annotations
+
+import threading
+from concurrent.futures import Future
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from openai import OpenAI
+
+SUMMARY_PROMPT = (
+    "Summarise the conversation below so it can replace the original messages "
+    "as context for later turns. Keep facts, decisions, names, numbers, code "
+    "identifiers and open questions; drop greetings and repetition. If a previous "
+    "summary is given, merge it into the new one. Reply with the summary only, "
+    "in the language of the conversation."
+)
+SUMMARY_HEADER = "Summary of the earlier conversation:\n"
+# 单条对话送去摘要时保留的最大字符数, 避免把整份文件再发一遍
+MAX_DIALOG_CHARS = 8000
+
+
+# 在后台用一个便宜的模型把滑出窗口的对话压缩为摘要, 同一时间只有一个任务
+# 任务在守护线程中运行, 退出时不等待未完成的摘要请求
+class Summarizer:
+    def __init__(self, client: Future[OpenAI], model_id: str) -> None:
+        self.client_future = client
+        self.model_id = model_id
+        self.pending: Future[tuple[str, int]] | None = None
+        self.target = 0
+        self.error: BaseException | None = None
+
+    def busy(self) -> bool:
+        return self.pending is not None
+
+    def submit(self, previous: str, dialogs: list[dict], covered: int) -> None:
+        self.target = covered
+        self.pending = Future()
+        threading.Thread(
+            target=self.run,
+            args=(self.pending, previous, dialogs, covered),
+            name="Summarizer",
+            daemon=True,
+        ).start()
+
+    def run(
+        self,
+        future: Future[tuple[str, int]],
+        previous: str,
+        dialogs: list[dict],
+        covered: int,
+    ) -> None:
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(self.summarize(previous, dialogs, covered))
+        except Exception as e:  # noqa: BLE001
+            future.set_exception(e)
+
+    # 任务完成时返回 (摘要, 覆盖的对话条数), 未完成或失败时返回None
+    def poll(self) -> tuple[str, int] | None:
+        if self.pending is None or not self.pending.done():
+            return None
+        future, self.pending = self.pending, None
+        self.error = future.exception()
+        if self.error is not None:
+            return None
+        return future.result()
+
+    def cancel(self) -> None:
+        if self.pending is not None:
+            self.pending.cancel()
+            self.pending = None
+
+    def summarize(
+        self,
+        previous: str,
+        dialogs: list[dict],
+        covered: int,
+    ) -> tuple[str, int]:
+        parts = []
+        if previous:
+            parts.append(f"[previous summary]\n{previous}")
+        for dialog in dialogs:
+            content = dialog["content"]
+            if len(content) > MAX_DIALOG_CHARS:
+                content = content[:MAX_DIALOG_CHARS] + "\n[...truncated]"
+            parts.append(f"[{dialog['role']}]\n{content}")
+        response = self.client_future.result().chat.completions.create(
+            model=self.model_id,
+            messages=[
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": "\n\n".join(parts)},
+            ],
+        )
+        return (response.choices[0].message.content or "").strip(), covered
@@ -0,0 +1,172 @@
+import atexit
+import os
+import queue
+import threading
+import time
+from collections.abc import Callable
+from pathlib import Path
+from typing import BinaryIO
+
+DURABILITY_MODES = ("turn", "interval", "fsync")
+
+
+# 常驻的日志写入器: 每个文件只打开一次, 写操作排队交给后台线程批量完成
+# turn:     每轮对话结束时flush
+# interval: 每隔flush_ms毫秒flush
+# fsync:    每轮对话结束时flush并fsync
+class LogWriter:
+    def __init__(self, durability: str = "turn", flush_ms: int = 1000) -> None:
+        if durability not in DURABILITY_MODES:
+            durability = "turn"
+        self.durability = durability
+        self.flush_interval = max(flush_ms, 1) / 1000
+        self.files: dict[Path, BinaryIO] = {}
+        self.queue: queue.Queue[tuple[Callable[..., None], tuple] | None] = (
+            queue.Queue()
+        )
+        self.error: Exception | None = None
+        self.dirty = False
+        self.last_flush = time.monotonic()
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name="LogWriter", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    # 以下方法在调用线程中执行, 只负责排队
+    def write(self, path: Path, data: str | bytes) -> None:
+        self.queue.put((self._write, (path, data)))
+
+    def reset(self, path: Path, data: str | bytes) -> None:
+        self.queue.put((self._reset, (path, data)))
+
+    def truncate(self, path: Path, size: int) -> None:
+        self.queue.put((self._truncate, (path, size)))
+
+    def remove(self, path: Path) -> None:
+        self.queue.put((self._remove, (path,)))
+
+    # 在后台线程中按顺序执行任意操作(如更新搜索索引)
+    def call(self, func: Callable[..., None], *args: object) -> None:
+        self.queue.put((func, args))
+
+    # 关闭文件句柄但保留文件, 以便外部替换; wait为False时只排队, 不等待
+    def release(self, path: Path, *, wait: bool = True) -> None:
+        self.queue.put((self._release, (path,)))
+        if wait:
+            self.flush()
+
+    def commit(self) -> None:
+        self.queue.put((self._commit, ()))
+
+    # 等待此前排队的写操作全部落盘
+    def flush(self) -> None:
+        if self.closed:
+            return
+        done = threading.Event()
+        self.queue.put((self._flush_event, (done,)))
+        done.wait()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+        atexit.unregister(self.close)
+
+    # 以下方法只在后台线程中执行
+    def run(self) -> None:
+        while True:
+            timeout = None
+            if self.durability == "interval" and self.dirty:
+                elapsed = time.monotonic() - self.last_flush
+                timeout = max(self.flush_interval - elapsed, 0)
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = ()
+            # 一次取空队列, 合并成一批处理
+            batch = [item]
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            for op in batch:
+                if op is None:
+                    self.execute(self._flush_all, ())
+                    for f in self.files.values():
+                        self.execute(f.close, ())
+                    self.files.clear()
+                    return
+                if op:
+                    self.execute(*op)
+            if (
+                self.durability == "interval"
+                and self.dirty
+                and time.monotonic() - self.last_flush >= self.flush_interval
+            ):
+                self.execute(self._flush_all, ())
+
+    # 任何异常都记下, 在下一次flush时抛出; 后台线程只在收到None时退出,
+    # 否则之后的flush会一直等下去
+    def execute(self, func: Callable[..., None], args: tuple) -> None:
+        try:
+            func(*args)
+        except Exception as e:  # noqa: BLE001
+            self.error = e
+
+    def _open(self, path: Path) -> BinaryIO:
+        f = self.files.get(path)
+        if f is None:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            f = path.open("ab")
+            self.files[path] = f
+        return f
+
+    def _write(self, path: Path, data: str | bytes) -> None:
+        if isinstance(data, str):
+            data = data.encode()
+        self._open(path).write(data)
+        self.dirty = True
+
+    def _reset(self, path: Path, data: str | bytes) -> None:
+        f = self._open(path)
+        f.truncate(0)
+        self._write(path, data)
+
+    def _truncate(self, path: Path, size: int) -> None:
+        self._open(path).truncate(size)
+        self.dirty = True
+
+    def _release(self, path: Path) -> None:
+        f = self.files.pop(path, None)
+        if f is not None:
+            f.close()
+
+    def _remove(self, path: Path) -> None:
+        self._release(path)
+        path.unlink(missing_ok=True)
+
+    def _commit(self) -> None:
+        if self.durability == "turn":
+            self._flush_all()
+        elif self.durability == "fsync":
+            self._flush_all(sync=True)
+
+    def _flush_event(self, done: threading.Event) -> None:
+        try:
+            self._flush_all(sync=self.durability == "fsync")
+        finally:
+            done.set()
+
+    def _flush_all(self, *, sync: bool = False) -> None:
+        for f in self.files.values():
+            f.flush()
+            if sync:
+                os.fsync(f.fileno())
+        self.dirty = False
+        self.last_flush = time.monotonic()